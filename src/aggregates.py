@@ -0,0 +1,220 @@
+import argparse
+import datetime
+import os
+import re
+import numpy as np
+
+import radiometer_binary
+import radiometer_index
+import radiometer_loader
+
+# Aggregates hold the minimum, mean and maximum of the lux, visible and IR readings and the number of readings in
+# each interval, starting at the time of the interval in ns. They are saved for each day beside the day's data
+# file, one compressed numpy file per level e.g. R_SQM_20260204.1s.npz and R_SQM_20260204.10m.npz. The levels
+# are a pyramid: each level is built from the level below it, and long time ranges are plotted from a coarse level
+AGGREGATE_FIELDS = [('time', '<i8'), ('count', '<u4'),
+                    ('lux_min', '<f4'), ('lux_mean', '<f4'), ('lux_max', '<f4'),
+                    ('visible_min', '<u2'), ('visible_max', '<u2'), ('visible_mean', '<f4'),
+                    ('ir_min', '<u2'), ('ir_max', '<u2'), ('ir_mean', '<f4')]
+AGGREGATE_DTYPE = np.dtype(AGGREGATE_FIELDS)
+AGGREGATE_COLUMNS = ['lux', 'visible', 'ir']
+
+# Levels of aggregates and their intervals in ns, from the finest
+LEVELS = {'1s': 1000000000, '10s': 10 * 1000000000, '1m': 60 * 1000000000, '10m': 600 * 1000000000}
+LEVEL_NAMES = {'1s': '1 second', '10s': '10 second', '1m': '1 minute', '10m': '10 minute'}
+AGGREGATE_EXTENSION = '.npz'
+
+
+# Name of a day's files without their extensions e.g. /data/R_SQM_20260204.csv.rcz -> /data/R_SQM_20260204
+def day_base_name(file_name):
+    directory, base_name = os.path.split(file_name)
+    return os.path.join(directory, base_name.split('.')[0])
+
+
+# File name of the aggregates at a level of a day file e.g. R_SQM_20260204.csv.rcz -> R_SQM_20260204.1m.npz
+def aggregate_file_name(file_name, level):
+    return day_base_name(file_name) + '.' + level + AGGREGATE_EXTENSION
+
+
+# Level of an aggregate file, or None for a data file
+def file_level(file_name):
+    if not file_name.endswith(AGGREGATE_EXTENSION):
+        return None
+    return os.path.basename(file_name).split('.')[1]
+
+
+# Whether the day of a file is over, so that its aggregates are complete. A file without a date isn't closed
+def day_closed(file_name):
+    match = re.search(r'(\d{8})\.', os.path.basename(file_name))
+    return bool(match) and match.group(1) < datetime.date.today().strftime('%Y%m%d')
+
+
+# Reduce the rows of each interval. The times must be in order. The minimums, maximums and sums of each column
+# are given for each row, with the number of readings the row holds
+def reduce_intervals(times, counts, minimums, maximums, sums, interval_ns):
+    if not len(times):
+        return np.zeros(0, dtype=AGGREGATE_DTYPE)
+    intervals = times // interval_ns
+    starts = np.flatnonzero(np.concatenate(([True], intervals[1:] != intervals[:-1])))
+    aggregates = np.zeros(len(starts), dtype=AGGREGATE_DTYPE)
+    aggregates['time'] = intervals[starts] * interval_ns
+    aggregates['count'] = np.add.reduceat(counts, starts)
+    for column in AGGREGATE_COLUMNS:
+        aggregates[column + '_min'] = np.minimum.reduceat(minimums[column], starts)
+        aggregates[column + '_max'] = np.maximum.reduceat(maximums[column], starts)
+        aggregates[column + '_mean'] = np.add.reduceat(sums[column], starts) / aggregates['count']
+    return aggregates
+
+
+# Aggregate loaded readings into intervals
+def aggregate(data, interval_ns):
+    if np.any(data['time'][1:] < data['time'][:-1]):
+        order = np.argsort(data['time'], kind='stable')
+        data = {key: values[order] for key, values in data.items()}
+    columns = {column: data[column] for column in AGGREGATE_COLUMNS}
+    sums = {column: data[column].astype(np.float64) for column in AGGREGATE_COLUMNS}
+    return reduce_intervals(data['time'], np.ones(len(data['time']), dtype=np.int64), columns, columns, sums, interval_ns)
+
+
+# Combine aggregates into longer intervals, or merge the aggregates of the same intervals e.g. from blocks of a file
+def combine(aggregates, interval_ns):
+    if np.any(aggregates['time'][1:] < aggregates['time'][:-1]):
+        aggregates = aggregates[np.argsort(aggregates['time'], kind='stable')]
+    counts = aggregates['count'].astype(np.int64)
+    minimums = {column: aggregates[column + '_min'] for column in AGGREGATE_COLUMNS}
+    maximums = {column: aggregates[column + '_max'] for column in AGGREGATE_COLUMNS}
+    sums = {column: aggregates[column + '_mean'] * counts for column in AGGREGATE_COLUMNS}
+    return reduce_intervals(aggregates['time'], counts, minimums, maximums, sums, interval_ns)
+
+
+# Aggregate a day file of any format at each level. The file is read a block at a time, and the blocks'
+# intervals are merged, so only the aggregates are held in memory. An aggregate file can be given instead,
+# for a day whose readings have been removed, to build the levels above it
+def aggregate_file(file_name):
+    finer = file_level(file_name)
+    if finer:
+        aggregates = {finer: read_aggregates(file_name)}
+    else:
+        finer = '1s'
+        blocks = [aggregate(data, LEVELS[finer]) for data, skipped in radiometer_loader.iterate_file(file_name)]
+        aggregates = {finer: combine(np.concatenate(blocks) if blocks else np.zeros(0, dtype=AGGREGATE_DTYPE), LEVELS[finer])}
+    for level, interval_ns in LEVELS.items():
+        if interval_ns > LEVELS[finer]:
+            aggregates[level] = combine(aggregates[finer], interval_ns)
+            finer = level
+    return aggregates
+
+
+# Save aggregates under a temporary name and rename them, so a power loss never leaves a partial file
+def save_aggregates(file_name, aggregates):
+    temp_file_name = file_name + '.tmp'
+    with open(temp_file_name, 'wb') as aggregate_file:
+        np.savez_compressed(aggregate_file, aggregates=aggregates)
+    os.replace(temp_file_name, file_name)
+
+
+def read_aggregates(file_name):
+    with np.load(file_name) as aggregate_file:
+        return aggregate_file['aggregates']
+
+
+# Aggregate a day file and save the aggregates beside it. Returns the file name of each level
+def build_aggregate_files(file_name):
+    file_names = {}
+    for level, aggregates in aggregate_file(file_name).items():
+        file_names[level] = aggregate_file_name(file_name, level)
+        if file_names[level] != file_name:
+            save_aggregates(file_names[level], aggregates)
+    return file_names
+
+
+# Aggregates of a day at a level, read from the saved file, or built from the day file. The levels built for a
+# day that is over are saved, if the data directory can be written, so they are only built once
+def day_aggregates(file_name, level):
+    file_name_at_level = aggregate_file_name(file_name, level)
+    if os.path.exists(file_name_at_level):
+        return read_aggregates(file_name_at_level)
+    levels = aggregate_file(file_name)
+    if day_closed(file_name):
+        try:
+            for built_level, aggregates in levels.items():
+                save_aggregates(aggregate_file_name(file_name, built_level), aggregates)
+        except OSError:
+            pass
+    return levels[level]
+
+
+# Find the days in a directory with data files or aggregates at a level, for a sensor name (or all sensors if
+# no name is given), optionally only for the days overlapping the start and end times. Returns a file of each day
+def find_days(directory, level, name=None, start=None, end=None):
+    pattern = r'(\d{8})\.' + re.escape(level + AGGREGATE_EXTENSION) + '$'
+    days = {day_base_name(file_name): file_name
+            for file_name in radiometer_loader.find_data_files(directory, name, start, end, pattern)}
+    days.update({day_base_name(file_name): file_name for file_name in radiometer_loader.find_data_files(directory, name, start, end)})
+    return [days[base_name] for base_name in sorted(days)]
+
+
+# Load the aggregates at a level of the days of the files, optionally only the intervals overlapping the start
+# and end times in ns
+def load_aggregates(file_names, level, start=None, end=None):
+    blocks = [day_aggregates(file_name, level) for file_name in file_names]
+    aggregates = np.concatenate(blocks) if blocks else np.zeros(0, dtype=AGGREGATE_DTYPE)
+    if start is not None:
+        aggregates = aggregates[aggregates['time'] + LEVELS[level] > start]
+    if end is not None:
+        aggregates = aggregates[aggregates['time'] <= end]
+    return aggregates
+
+
+# Times in ns of the first and last readings of a day between the start and end times, and the number of readings,
+# found without loading the readings. They come from the day's coarsest saved aggregates, which give the times to
+# their interval, from the times of a binary file, or from the index and line count of a csv file, which give the
+# times to the minute. The aggregates of gzipped and compressed files are built. None if there are no readings
+def day_extent(file_name, start=None, end=None):
+    level = file_level(file_name) or next((level for level in reversed(LEVELS) if os.path.exists(aggregate_file_name(file_name, level))), None)
+    if level or file_name.endswith(('.gz', radiometer_loader.COMPRESSED_EXTENSION)):
+        level = level or list(LEVELS)[-1]
+        aggregates = load_aggregates([file_name], level, start, end)
+        if not len(aggregates):
+            return None
+        first, last, count = aggregates['time'][0], aggregates['time'][-1] + LEVELS[level], aggregates['count'].sum()
+    elif radiometer_binary.is_binary_file(file_name):
+        times = radiometer_binary.read_binary(file_name)['time']
+        times = times[np.searchsorted(times, start, side='left') if start is not None else 0:
+                      np.searchsorted(times, end, side='right') if end is not None else len(times)]
+        if not len(times):
+            return None
+        first, last, count = times[0], times[-1], len(times)
+    else:
+        count, entries = radiometer_loader.count_lines(file_name, start, end, save=False)
+        if not count or not len(entries):
+            return None
+        first, last = entries['time'][0], entries['time'][-1] + radiometer_index.INDEX_INTERVAL_NS
+    first = max(int(first), start) if start is not None else int(first)
+    last = min(int(last), end) if end is not None else int(last)
+    return first, max(last, first), int(count)
+
+
+# Coarsest level with at least one interval for each of the pixels across a time span, or None if the
+# readings themselves are needed
+def choose_level(span_ns, pixels):
+    chosen = None
+    for level, interval_ns in LEVELS.items():
+        if interval_ns * pixels <= span_ns:
+            chosen = level
+    return chosen
+
+
+# Main program. Build the aggregates of day files
+if __name__ == "__main__":
+
+    # Construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser(description='Build the ' + ', '.join(LEVELS) + ' aggregates of radiometer day files')
+    ap.add_argument("file", type=str, nargs='+',
+                    help="Day files to aggregate. The aggregates are saved beside each file")
+
+    args = vars(ap.parse_args())
+
+    for file_name in args['file']:
+        for level, aggregate_name in build_aggregate_files(file_name).items():
+            print("Saved", len(read_aggregates(aggregate_name)), level, "aggregates of", file_name, "to", aggregate_name)
@@ -0,0 +1,165 @@
+import argparse
+import numpy as np
+
+import sensor_backend
+
+# The auto ranger steps down to a less sensitive setting when the counts predicted for the next reading are
+# above this fraction of the saturation counts, choosing a setting whose predicted counts are below the target fraction
+NEAR_SATURATION = 0.8
+TARGET = 0.5
+
+# The auto ranger steps up to a more sensitive setting when its counts would be below this fraction of
+# the saturation counts for this many consecutive readings. The gap between the fractions is the hysteresis
+SWITCH_UP = 0.25
+SWITCH_UP_READINGS = 10
+
+# Number of readings ahead that the rise in the count rate is extrapolated. The next reading is already integrating
+# when a reading is read, so a new setting can only take effect on the reading after it
+LOOKAHEAD_READINGS = 2
+
+# When the sensor has saturated, and the count rate is unknown, step down by at least this factor in sensitivity
+SATURATED_STEP = 20.0
+
+INTEGRATION_TIMES = [sensor_backend.INTEGRATIONTIME_100MS, sensor_backend.INTEGRATIONTIME_200MS, sensor_backend.INTEGRATIONTIME_300MS,
+                     sensor_backend.INTEGRATIONTIME_400MS, sensor_backend.INTEGRATIONTIME_500MS, sensor_backend.INTEGRATIONTIME_600MS]
+
+
+# Sensitivity of a gain and integration time setting, in counts per unit count rate
+def sensitivity(setting):
+    gain, integration_time = setting
+    return sensor_backend.GAIN_FACTORS[gain] * (100 * integration_time + 100)
+
+
+def max_counts(setting):
+    return sensor_backend.MAX_COUNT_100MS if setting[1] == sensor_backend.INTEGRATIONTIME_100MS else sensor_backend.MAX_COUNT
+
+
+# Predictive auto ranging over the sensor's gains and integration times. The settings are ordered by sensitivity.
+# After each reading, the count rate (counts / sensitivity) and its rise since the previous reading predict the
+# counts of the next readings, so the sensor is stepped down before it saturates, straight to the most sensitive
+# setting that has enough headroom. The sensor is only stepped back up when the counts have been low enough for a
+# while, so the setting doesn't oscillate. If the sensor saturates anyway, it steps down until it can read again.
+# The longest integration time is limited to keep the sampling rate e.g. 100ms for 10 readings per second
+class AutoRanger():
+
+    def __init__(self, gain=sensor_backend.GAIN_MAX, integration_time=sensor_backend.INTEGRATIONTIME_100MS,
+                 max_integration_time=sensor_backend.INTEGRATIONTIME_100MS):
+        self.ladder = sorted([(ladder_gain, ladder_time) for ladder_gain in sensor_backend.GAIN_FACTORS
+                              for ladder_time in INTEGRATION_TIMES if ladder_time <= max_integration_time], key=sensitivity)
+        self.gain = gain
+        self.integration_time = integration_time
+        self.prev_rate = None
+        self.low_readings = 0
+        self.switches = 0
+
+    def setting(self):
+        return (self.gain, self.integration_time)
+
+    # Check a reading's counts. Returns the new (gain, integration time) setting if the sensor should be changed
+    def update(self, vis_level, ir_level):
+        rate = max(vis_level, ir_level) / sensitivity(self.setting())
+        rise = max(rate - self.prev_rate, 0) if self.prev_rate is not None else 0
+        self.prev_rate = rate
+        predicted_rate = rate + LOOKAHEAD_READINGS * rise
+
+        # Step down before the sensor saturates
+        if predicted_rate * sensitivity(self.setting()) > NEAR_SATURATION * max_counts(self.setting()):
+            self.low_readings = 0
+            return self.change(self.best_setting(predicted_rate, TARGET))
+
+        # Step up once the counts would have been low enough at a more sensitive setting for long enough
+        best = self.best_setting(predicted_rate, SWITCH_UP)
+        if sensitivity(best) > sensitivity(self.setting()):
+            self.low_readings += 1
+            if self.low_readings >= SWITCH_UP_READINGS:
+                self.low_readings = 0
+                return self.change(best)
+        else:
+            self.low_readings = 0
+
+        return None
+
+    # The sensor has saturated. Returns a less sensitive setting, or None if the sensor is at its least sensitive setting
+    def saturated(self):
+        self.prev_rate = None
+        self.low_readings = 0
+        current = sensitivity(self.setting())
+        candidates = [setting for setting in self.ladder if sensitivity(setting) * SATURATED_STEP <= current]
+        return self.change(candidates[-1] if candidates else self.ladder[0])
+
+    # Most sensitive setting with the predicted counts below the fraction of its saturation counts
+    def best_setting(self, rate, fraction):
+        best = self.ladder[0]
+        for setting in self.ladder:
+            if rate * sensitivity(setting) < fraction * max_counts(setting):
+                best = setting
+        return best
+
+    def change(self, setting):
+        if setting == self.setting():
+            return None
+        self.gain, self.integration_time = setting
+        self.switches += 1
+        return setting
+
+    # Change the sensor's setting. The integration restarts when the ADC is enabled, so the next reading is at the new setting
+    def apply(self, sensor, setting):
+        sensor.adc_en_off()
+        sensor.gain, sensor.integration_time = setting
+        sensor.enable()
+        sensor.clear_interrupts()
+
+
+# Main program. Replay data files through a simulated sensor with the auto ranger, and measure the readings lost at each switch
+if __name__ == "__main__":
+
+    # Construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser(description='Replay data files through a simulated sensor with auto ranging and count the readings lost by each switch')
+    ap.add_argument("file", type=str, nargs='+',
+                    help="Data files to replay")
+    ap.add_argument("-t", "--max-atime", type=int, choices=[100, 200, 300, 400, 500, 600], default=100,
+                    help="Longest integration time in ms that the auto ranger can choose. Default is 100")
+    ap.add_argument("-v", "--verbose", action='store_true',
+                    help="Print each switch")
+
+    args = vars(ap.parse_args())
+
+    sensor = sensor_backend.SimulatedTSL2591(args['file'], speed=0)
+    auto_ranger = AutoRanger(max_integration_time=args['max_atime'] // 100 - 1)
+    auto_ranger.apply(sensor, auto_ranger.setting())
+
+    # Readings that saturated at the least sensitive setting are beyond the sensor's range, not lost by switching
+    readings = saturated_readings = out_of_range_readings = lost_readings = 0
+    previous_end = None
+    while True:
+        try:
+            sensor.wait_interrupt()
+        except sensor_backend.ReplayFinished:
+            break
+
+        # Readings missed since the previous reading, e.g. while the integration restarted
+        if previous_end is not None and sensor.reading_end - previous_end < sensor_backend.MAX_GAP_NS:
+            lost_readings += max(int(round((sensor.reading_end - previous_end) / sensor.period())) - 1, 0)
+        previous_end = sensor.reading_end
+
+        try:
+            lux, vis_level, ir_level, again, atime = sensor.get_light_levels()
+            readings += 1
+            setting = auto_ranger.update(vis_level, ir_level)
+        except RuntimeError:
+            if auto_ranger.setting() == auto_ranger.ladder[0]:
+                out_of_range_readings += 1
+            else:
+                saturated_readings += 1
+            setting = auto_ranger.saturated()
+
+        if setting:
+            if args['verbose']:
+                print(np.datetime64(sensor.reading_end, 'ns'), "gain", sensor_backend.GAIN_FACTORS[setting[0]],
+                      "atime", 100 * setting[1] + 100)
+            auto_ranger.apply(sensor, setting)
+
+    switches = max(auto_ranger.switches, 1)
+    print("Readings: {0}  switches: {1}  saturated readings: {2}  lost readings: {3}  out of range readings: {4}".format(
+        readings, auto_ranger.switches, saturated_readings, lost_readings, out_of_range_readings))
+    print("Per switch: saturated readings {0:.2f}  lost readings {1:.2f}".format(saturated_readings / switches, lost_readings / switches))
@@ -0,0 +1,289 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import runpy
+import sys
+import tempfile
+import time
+import numpy as np
+
+import data_logger
+import sensor_backend
+
+SCRIPTS = ["radiometer_tsl2591", "sqm_tsl2591", "sssm_tsl2591"]
+
+# Sensor methods timed as each stage of the acquisition loop. Other sensor calls are gain and time settings
+SENSOR_STAGES = {'wait_interrupt': 'wait', 'wait_interrupt_600': 'wait', 'get_light_levels': 'read'}
+
+# Intervals longer than this many sensor integration periods are counted as gaps
+GAP_PERIODS = 1.5
+
+# Readings either side of a gain or integration time switch in which gaps are counted as caused by the switch
+SWITCH_WINDOW = 3
+
+
+class BenchmarkFinished(BaseException):
+    pass
+
+
+# Wall and main thread CPU time spent in each stage of the acquisition loop
+class StageTimer():
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, stage, wall, cpu):
+        calls, total_wall, total_cpu = self.stages.get(stage, (0, 0.0, 0.0))
+        self.stages[stage] = (calls + 1, total_wall + wall, total_cpu + cpu)
+
+    def timed(self, stage, function, *args, **kwargs):
+        start_wall, start_cpu = time.perf_counter(), time.thread_time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.add(stage, time.perf_counter() - start_wall, time.thread_time() - start_cpu)
+
+
+# Proxy for the sensor which times each call, records the sensor time of each reading, and ends the
+# benchmark at the end of a replay or after the benchmark duration
+class TimedSensor():
+
+    def __init__(self, sensor, timer, duration):
+        object.__setattr__(self, 'sensor', sensor)
+        object.__setattr__(self, 'timer', timer)
+        object.__setattr__(self, 'end_time', time.monotonic() + duration if duration else None)
+        object.__setattr__(self, 'reading_time', None)
+        object.__setattr__(self, 'start', None)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.sensor, name)
+        if not callable(attribute):
+            return attribute
+
+        def timed_call(*args, **kwargs):
+            if name in ('wait_interrupt', 'wait_interrupt_600'):
+                # The loop is timed from the first wait, after the script's setup
+                if self.start is None:
+                    object.__setattr__(self, 'start', (time.perf_counter(), time.thread_time(), time.process_time()))
+                if self.end_time and time.monotonic() > self.end_time:
+                    raise BenchmarkFinished()
+            result = self.timer.timed(SENSOR_STAGES.get(name, 'settings'), attribute, *args, **kwargs)
+            if name in ('wait_interrupt', 'wait_interrupt_600'):
+                # The simulated sensor's time of the reading, or the real time
+                object.__setattr__(self, 'reading_time', getattr(self.sensor, 'reading_end', None) or time.time_ns())
+            return result
+        return timed_call
+
+    def __setattr__(self, name, value):
+        self.timer.timed('settings', setattr, self.sensor, name, value)
+
+
+# Run an acquisition script in this process with timing proxies around its sensor, data logger and fireball detector
+def run_script(script, script_args, simulate, speed, duration):
+    timer = StageTimer()
+    readings = []
+    proxies = {}
+
+    def finished():
+        raise BenchmarkFinished()
+
+    def open_sensor(*args, **kwargs):
+        kwargs['on_finished'] = finished
+        proxies['sensor'] = TimedSensor(original_open_sensor(*args, **kwargs), timer, duration)
+        return proxies['sensor']
+
+    class TimedDataLogger(data_logger.RadiometerDataLogger):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            proxies['logger'] = self
+
+        def log_data(self, obs_time, lux_value, vis_level, ir_level, again, atime):
+            readings.append((time.perf_counter(), proxies['sensor'].reading_time, again, atime))
+            timer.timed('log', super().log_data, obs_time, lux_value, vis_level, ir_level, again, atime)
+
+    original_open_sensor = sensor_backend.open_sensor
+    sensor_backend.open_sensor = open_sensor
+    data_logger.RadiometerDataLogger = TimedDataLogger
+
+    import fireball_detector
+
+    class TimedFireballDetector(fireball_detector.FireballDetector):
+        def __init__(self, *args, event_dir=None, **kwargs):
+            # Events are written to the benchmark's temporary data directory, not the real events directory
+            super().__init__(*args, event_dir=event_dir or data_logger.DATA_DIR + fireball_detector.EVENT_SUBDIR, **kwargs)
+
+        def update(self, *args):
+            return timer.timed('detect', super().update, *args)
+    fireball_detector.FireballDetector = TimedFireballDetector
+
+    import shared_readings
+
+    class ClosedSharedReadingsPublisher(shared_readings.SharedReadingsPublisher):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            proxies.setdefault('publishers', []).append(self)
+    shared_readings.SharedReadingsPublisher = ClosedSharedReadingsPublisher
+
+    sys.argv = [script + '.py'] + script_args
+    if simulate:
+        sys.argv += ['--simulate'] + simulate + ['--speed', str(speed)]
+
+    try:
+        runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), script + '.py'), run_name='__main__')
+    except BenchmarkFinished:
+        pass
+    start_wall, start_cpu, start_process_cpu = proxies['sensor'].start
+    elapsed = time.perf_counter() - start_wall
+    loop_cpu = time.thread_time() - start_cpu
+
+    # Include the time to write out the queued readings
+    if 'logger' in proxies:
+        proxies['logger'].close()
+    process_cpu = time.process_time() - start_process_cpu
+
+    # Remove the shared memory of the script's readings, as the script would on exit
+    for publisher in proxies.get('publishers', []):
+        publisher.close()
+    return timer, readings, elapsed, loop_cpu, process_cpu, proxies.get('logger')
+
+
+def percentiles(values):
+    if not len(values):
+        return {}
+    return {'p50': float(np.percentile(values, 50)), 'p99': float(np.percentile(values, 99)),
+            'max': float(np.max(values)), 'mean': float(np.mean(values))}
+
+
+def machine_model():
+    try:
+        with open('/proc/device-tree/model') as model_file:
+            return model_file.read().strip('\0\n')
+    except OSError:
+        return platform.machine()
+
+
+# Summarise the timing of the readings logged by the acquisition loop
+def summarise(timer, readings, elapsed, loop_cpu, process_cpu, logger, simulated):
+    wall_times = np.array([reading[0] for reading in readings])
+    sensor_times = np.array([reading[1] for reading in readings], dtype=np.int64)
+    gains = np.array([reading[2] for reading in readings])
+    periods = np.array([reading[3] for reading in readings]) * 1e6
+
+    wall_intervals = np.diff(wall_times) * 1000
+    sensor_intervals = np.diff(sensor_times)
+    if simulated:
+        # Ignore the gaps in the replayed data, which the simulated sensor skips
+        replayed = sensor_intervals < sensor_backend.MAX_GAP_NS
+        wall_intervals, sensor_intervals = wall_intervals[replayed], sensor_intervals[replayed]
+        gains, periods = np.concatenate((gains[:1], gains[1:][replayed])), np.concatenate((periods[:1], periods[1:][replayed]))
+    gaps = sensor_intervals > GAP_PERIODS * periods[1:]
+    switches = np.flatnonzero((gains[1:] != gains[:-1]) | (periods[1:] != periods[:-1]))
+    near_switch = np.zeros(len(sensor_intervals), dtype=bool)
+    for switch in switches:
+        near_switch[max(switch - SWITCH_WINDOW, 0):switch + SWITCH_WINDOW + 1] = True
+    lost_readings = np.maximum(np.round(sensor_intervals / periods[1:]) - 1, 0)
+
+    stages = {}
+    stage_cpu = 0.0
+    for stage, (calls, wall, cpu) in sorted(timer.stages.items()):
+        stages[stage] = {'calls': calls, 'wall_s': wall, 'cpu_s': cpu, 'cpu_us_per_call': 1e6 * cpu / calls}
+        stage_cpu += cpu
+    stages['loop_other'] = {'cpu_s': loop_cpu - stage_cpu}
+    stages['other_threads'] = {'cpu_s': process_cpu - loop_cpu}
+
+    return {
+        'readings': len(readings),
+        'elapsed_s': elapsed,
+        'rate_hz': len(readings) / elapsed if elapsed else 0.0,
+        'wall_interval_ms': percentiles(wall_intervals),
+        'sensor_interval_ms': percentiles(sensor_intervals / 1e6),
+        'gaps': int(np.count_nonzero(gaps)),
+        'gain_switches': len(switches),
+        'gaps_near_gain_switches': int(np.count_nonzero(gaps & near_switch)),
+        'lost_readings_near_gain_switches': int(lost_readings[near_switch].sum()),
+        'lost_readings_per_switch': float(lost_readings[near_switch].sum() / len(switches)) if len(switches) else 0.0,
+        'dropped_readings': logger.dropped_count if logger else 0,
+        'late_readings': logger.late_count if logger else 0,
+        'stages': stages,
+    }
+
+
+def print_results(results, previous=None):
+    print("Readings: {0}  elapsed: {1:.2f} s  rate: {2:.1f} Hz".format(results['readings'], results['elapsed_s'], results['rate_hz']))
+    for name in ['wall_interval_ms', 'sensor_interval_ms']:
+        values = results[name]
+        if values:
+            print("{0:20s} p50: {1:8.3f}  p99: {2:8.3f}  max: {3:8.3f}".format(name, values['p50'], values['p99'], values['max']))
+    print("Gaps: {0}  gain switches: {1}  gaps near gain switches: {2}  lost readings near gain switches: {3} ({4:.2f} per switch)".format(
+        results['gaps'], results['gain_switches'], results['gaps_near_gain_switches'], results['lost_readings_near_gain_switches'],
+        results.get('lost_readings_per_switch', 0.0)))
+    print("Dropped readings: {0}  late readings: {1}".format(results['dropped_readings'], results['late_readings']))
+    for stage, values in results['stages'].items():
+        line = "  {0:14s} cpu {1:8.3f} s".format(stage, values['cpu_s'])
+        if 'calls' in values:
+            line += "  {0:8d} calls  {1:8.1f} us/call".format(values['calls'], values['cpu_us_per_call'])
+        if previous and stage in previous['stages'] and 'cpu_us_per_call' in values and 'cpu_us_per_call' in previous['stages'][stage]:
+            line += "  (previous {0:8.1f} us/call)".format(previous['stages'][stage]['cpu_us_per_call'])
+        print(line)
+    if previous:
+        print("Previous rate: {0:.1f} Hz, wall interval p99: {1:.3f} ms".format(
+            previous['rate_hz'], previous['wall_interval_ms'].get('p99', np.nan)))
+
+
+# Main program
+if __name__ == "__main__":
+
+    # Construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser(description='Benchmark an acquisition loop against a simulated or real sensor',
+                                 epilog='Arguments after -- are passed to the acquisition script')
+    ap.add_argument("script", choices=SCRIPTS, nargs='?', default=SCRIPTS[0],
+                    help="Acquisition script to benchmark. Default is " + SCRIPTS[0])
+    ap.add_argument("--simulate", type=str, nargs='+', default=None,
+                    help="Replay these data files with a simulated sensor. Default is the real sensor")
+    ap.add_argument("--speed", type=float, default=0,
+                    help="Replay speed of the simulated sensor. Default is 0 - as fast as possible")
+    ap.add_argument("-d", "--duration", type=float, default=None,
+                    help="Stop the benchmark after this many seconds. Default is the end of the replay")
+    ap.add_argument("-o", "--output", type=str, default=None,
+                    help="Save the results to this JSON file")
+    ap.add_argument("-c", "--compare", type=str, default=None,
+                    help="Compare the results with a previously saved JSON file")
+
+    argv = sys.argv[1:]
+    script_args = []
+    if '--' in argv:
+        script_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = vars(ap.parse_args(argv))
+
+    if not args['simulate'] and not args['duration']:
+        ap.error("a --duration is needed when benchmarking the real sensor")
+
+    # Write the data and event files to a temporary directory, and don't start the REST servers
+    data_logger.DATA_DIR = tempfile.mkdtemp(prefix='radiometer_benchmark_') + '/'
+    import reading_history
+    reading_history.run_server = lambda *args, **kwargs: None
+
+    timer, readings, elapsed, loop_cpu, process_cpu, logger = run_script(
+        args['script'], script_args, args['simulate'], args['speed'], args['duration'])
+
+    results = summarise(timer, readings, elapsed, loop_cpu, process_cpu, logger, bool(args['simulate']))
+    results.update({'script': args['script'], 'script_args': script_args, 'simulated': bool(args['simulate']),
+                    'speed': args['speed'], 'machine': machine_model(), 'python': platform.python_version(),
+                    'date': datetime.datetime.now().isoformat(timespec='seconds')})
+
+    previous = None
+    if args['compare']:
+        with open(args['compare']) as previous_file:
+            previous = json.load(previous_file)
+    print_results(results, previous)
+
+    if args['output']:
+        with open(args['output'], 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+    # The acquisition scripts' threads don't exit
+    sys.stdout.flush()
+    os._exit(0)
@@ -0,0 +1,113 @@
+import argparse
+from collections import deque
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+import radiometer_loader
+import seeing
+
+
+# Run a function, returning its result, the elapsed time and the peak traced memory.
+# The memory is traced in a second run so that the tracing doesn't slow down the timed run
+def measure(function, *args):
+    start_time = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start_time
+    tracemalloc.start()
+    function(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def report(label, elapsed, peak, rows):
+    print('{0:<28s} {1:9.3f} s {2:9.1f} MB {3:10d} rows'.format(label, elapsed, peak / 1e6, rows))
+
+
+# The original loading path of the analysis tools
+def pandas_load(file_names):
+    dfs = [pd.read_csv(file_name, sep=' ', names=radiometer_loader.COLUMNS)
+           for file_name in file_names]
+    df = pd.concat(dfs, ignore_index=True)
+    df["Times"] = pd.to_datetime(df.Date + " " + df.Time, format="%Y/%m/%d %H:%M:%S.%f")
+    return df
+
+
+def benchmark_loader(file_names):
+    df_pandas, elapsed, peak = measure(pandas_load, file_names)
+    report("pd.read_csv + to_datetime", elapsed, peak, len(df_pandas))
+    df_loader, elapsed, peak = measure(radiometer_loader.load_data, file_names)
+    report("radiometer_loader", elapsed, peak, len(df_loader))
+
+    if len(df_pandas) == len(df_loader):
+        # pandas 3 parses the times to us rather than ns
+        print("Max timestamp difference (ns):",
+              np.max(np.abs(df_pandas.Times.values.astype('datetime64[ns]').astype(np.int64) -
+                            df_loader.Times.values.astype('datetime64[ns]').astype(np.int64)), initial=0))
+        print("Max lux difference:", np.max(np.abs(df_pandas.Lux.values - df_loader.Lux.values), initial=0))
+
+
+# The original seeing calculation of graph_radiometer_data
+def iterrows_seeing(df, min_lux):
+    rolling_deque = deque(maxlen=seeing.CHUNK_SIZE)
+    seeings = []
+    for index, row in df[df['Lux'] > min_lux].iterrows():
+        rolling_deque.append(row['Lux'])
+        if len(rolling_deque) == rolling_deque.maxlen:
+            rolling = np.array(rolling_deque)
+            average = np.average(rolling)
+            rms = np.sqrt(np.mean((rolling - average)**2))
+            seeings.append(seeing.SSSM_FACTOR * abs(rms / average))
+            rolling_deque.clear()
+    return np.array(seeings)
+
+
+def vectorized_seeing(df, min_lux):
+    lux = df.Lux.to_numpy()
+    return seeing.chunked_seeing(lux[lux > min_lux])[0]
+
+
+def incremental_seeing(df, min_lux):
+    calculator = seeing.SeeingCalculator()
+    seeings = [calculator.update(lux) for lux in df.Lux.to_numpy()[df.Lux.to_numpy() > min_lux].tolist()]
+    return np.array([value for value in seeings if value is not None])
+
+
+def benchmark_seeing(file_names, min_lux):
+    df = radiometer_loader.load_data(file_names)
+    seeings_iterrows, elapsed_iterrows, peak = measure(iterrows_seeing, df, min_lux)
+    report("iterrows + deque", elapsed_iterrows, peak, len(seeings_iterrows))
+    seeings_vectorized, elapsed, peak = measure(vectorized_seeing, df, min_lux)
+    report("seeing.chunked_seeing", elapsed, peak, len(seeings_vectorized))
+    print("Speedup:", np.around(elapsed_iterrows / elapsed, 1))
+    seeings_incremental, elapsed, peak = measure(incremental_seeing, df, min_lux)
+    report("seeing.SeeingCalculator", elapsed, peak, len(seeings_incremental))
+
+    if len(seeings_iterrows):
+        print("Max seeing difference (arcsec):",
+              np.nanmax(np.abs(seeings_iterrows - seeings_vectorized)), np.nanmax(np.abs(seeings_iterrows - seeings_incremental)))
+
+
+# Main program
+if __name__ == "__main__":
+
+    # Construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser(description='Benchmark the radiometer analysis tools')
+    ap.add_argument("benchmark", type=str, choices=["loader", "seeing"],
+                    help="Benchmark to run")
+    ap.add_argument("file", type=str, nargs='+',
+                    help="Data files to use for the benchmark")
+    ap.add_argument("--min-lux", type=float, default=seeing.SEEING_MIN_LUX,
+                    help="Minimum lux value for the seeing benchmark. Default is " + str(seeing.SEEING_MIN_LUX))
+
+    args = vars(ap.parse_args())
+
+    benchmark = args['benchmark']
+    file_names = args['file']
+
+    if benchmark == "loader":
+        benchmark_loader(file_names)
+    elif benchmark == "seeing":
+        benchmark_seeing(file_names, args['min_lux'])
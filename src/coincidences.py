@@ -0,0 +1,230 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import os
+import re
+import numpy as np
+import pandas as pd
+
+import event_catalog
+import radiometer_loader
+from radiometer_loader import parse_time
+
+# Coincidences are brightenings seen by several stations at the same time. Each station's events are the peaks
+# found in its readings, the events of a lightcurve batch table, or the events of an event catalog. The events of
+# all of the stations are merged in time order, and each group holds the events within the tolerance of its first
+# event, so a coincidence is a group with events from at least the minimum number of stations. The times of every
+# station must be in the same time zone
+TOLERANCE = 1.0
+MIN_STATIONS = 2
+COINCIDENCES_FILE = 'coincidences.csv'
+
+# A station argument may be named e.g. SQM_Hove=/data/hove/event_catalog.db
+STATION_PATTERN = re.compile(r'(\w+)=(.+)$')
+
+
+# Events of a station with no events
+def no_events():
+    return {'time': np.zeros(0, dtype=np.int64), 'peak_lux': np.zeros(0, dtype=np.float64)}
+
+
+# Name and source of a station argument. The name is None if the argument doesn't give one
+def parse_station(station_arg):
+    match = STATION_PATTERN.match(station_arg)
+    return (match.group(1), match.group(2)) if match else (None, station_arg)
+
+
+# Whether a file is a table of events e.g. the lightcurve_events.csv of a lightcurve batch, rather than readings
+def is_event_table(file_name):
+    if not file_name.endswith('.csv'):
+        return False
+    with open(file_name) as table_file:
+        columns = table_file.readline().strip().split(',')
+    return 'time' in columns and 'peak_lux' in columns
+
+
+# Events of each sensor in an event catalog, or of all of its sensors if the station is named
+def catalog_events(name, catalog_file, start=None, end=None):
+    connection = event_catalog.open_catalog(catalog_file)
+    try:
+        rows = [dict(zip(event_catalog.QUERY_COLUMNS, row)) for row in event_catalog.query_events(connection, start=start, end=end)]
+    finally:
+        connection.close()
+    sensors = np.array([row['sensor'] if name is None else name for row in rows], dtype=object)
+    times = np.array([row['time'] for row in rows], dtype=np.int64)
+    lux = np.array([row['peak_lux'] for row in rows], dtype=np.float64)
+    return {station: {'time': times[sensors == station], 'peak_lux': lux[sensors == station]} for station in set(sensors)}
+
+
+# Events of a lightcurve batch table
+def table_events(name, file_name, start=None, end=None):
+    table = pd.read_csv(file_name, usecols=['time', 'peak_lux'])
+    times = pd.to_datetime(table['time']).to_numpy().astype('datetime64[ns]').astype(np.int64)
+    events = radiometer_loader.select_time_range({'time': times, 'peak_lux': table['peak_lux'].to_numpy(dtype=np.float64)}, start, end)
+    return {name: events}
+
+
+# Events of the peaks in the lux readings of a data file, found as lightcurve finds them
+def file_events(name, file_name, prominence, start=None, end=None):
+    # lightcurve is only imported to find peaks in readings, as scipy and matplotlib are slow to import
+    import lightcurve
+    data, skipped = radiometer_loader.load_file(file_name, start, end)
+    if len(data['time']) == 0:
+        return {name: no_events()}
+    peaks = lightcurve.find_lux_peaks(data['lux'], prominence)
+    return {name: {'time': data['time'][peaks], 'peak_lux': data['lux'][peaks].astype(np.float64)}}
+
+
+# Tasks that load the events of a station argument, each a function and its arguments. The readings of a
+# station are loaded a file at a time, so the files of a station with many days are loaded in parallel too.
+# Unnamed stations are named after their event table, their directory of day files, the sensor of their data
+# files, or their catalog's sensors. The events of stations with the same name are combined
+def station_tasks(station_arg, prominence, start=None, end=None):
+    name, source = parse_station(station_arg)
+    if source.endswith('.db'):
+        if not os.path.exists(source):
+            raise FileNotFoundError("No event catalog " + source)
+        return [(catalog_events, (name, source, start, end))]
+    if os.path.isfile(source) and is_event_table(source):
+        return [(table_events, (name or os.path.splitext(os.path.basename(source))[0], source, start, end))]
+
+    import lightcurve
+    file_names = lightcurve.batch_files([source], None, start, end)
+    if os.path.isdir(source):
+        name = name or os.path.basename(os.path.normpath(source))
+    name = name or (event_catalog.sensor_name(file_names[0]) if file_names else "") or source
+    return [(file_events, (name, file_name, prominence, start, end)) for file_name in file_names]
+
+
+# Load the events of the stations on a pool of processes. Returns the events of each station in time order
+def load_stations(station_args, prominence, start=None, end=None, jobs=0):
+    tasks = [task for station_arg in station_args for task in station_tasks(station_arg, prominence, start, end)]
+    jobs = jobs or os.cpu_count()
+    print("Loading", len(station_args), "stations from", len(tasks), "files with", jobs, "processes")
+    blocks = {}
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(function, *arguments): arguments[1] for function, arguments in tasks}
+        for future in as_completed(futures):
+            try:
+                for station, events in future.result().items():
+                    blocks.setdefault(station, []).append(events)
+            except Exception as e:
+                print("Unable to load", futures[future], e)
+
+    stations = {}
+    for station, station_blocks in sorted(blocks.items()):
+        events = {key: np.concatenate([block[key] for block in station_blocks]) for key in ['time', 'peak_lux']}
+        order = np.argsort(events['time'], kind='stable')
+        stations[station] = {key: values[order] for key, values in events.items()}
+        print(station, "events:", len(order))
+    return stations
+
+
+# Groups of events in time order, each holding the events within the tolerance in ns of its first event. The events
+# are split into chains where they are more than the tolerance apart, and the few chains that last longer than the
+# tolerance are split again, each group starting at the first event past the tolerance of the group before, so a
+# chain of events each close to the next can't join events minutes apart. Returns the group of each event
+def group_events(times, tolerance):
+    breaks = np.concatenate(([True], np.diff(times) > tolerance))
+    starts = np.flatnonzero(breaks)
+    ends = np.append(starts[1:], len(times))
+    long_chains = times[ends - 1] - times[starts] > tolerance
+    for start, end in zip(starts[long_chains], ends[long_chains]):
+        anchor = start
+        while True:
+            anchor = start + np.searchsorted(times[start:end], times[anchor] + tolerance, side='right')
+            if anchor >= end:
+                break
+            breaks[anchor] = True
+    return np.cumsum(breaks) - 1
+
+
+# Find the coincidences between the events of the stations, each in time order. The stations' events are merged by
+# a stable sort, which merges the sorted runs of the stations in one pass, and the events are split into groups
+# within the tolerance in ns of their first event. The brightest event of each station in a group is its peak,
+# so each station has at most one peak in a coincidence.
+# Returns a table of the coincidences with the time of the first peak, the number of stations, the spread of the
+# peak times in seconds, and the peak time and peak lux of each station, which are empty for the stations that
+# missed it
+def find_coincidences(stations, tolerance, min_stations=MIN_STATIONS):
+    names = list(stations)
+    columns = ['time', 'stations', 'spread'] + [name + suffix for name in names for suffix in ['_time', '_peak_lux']]
+    times = np.concatenate([stations[name]['time'] for name in names] + [np.zeros(0, dtype=np.int64)])
+    if len(times) == 0:
+        return pd.DataFrame(columns=columns)
+    lux = np.concatenate([stations[name]['peak_lux'] for name in names])
+    station_ids = np.repeat(np.arange(len(names)), [len(stations[name]['time']) for name in names])
+
+    order = np.argsort(times, kind='stable')
+    times, lux, station_ids = times[order], lux[order], station_ids[order]
+    groups = group_events(times, tolerance)
+
+    # Most events are alone in their group, so the groups with fewer events than the minimum number of stations
+    # are dropped before the brightest event of each station in each group is found, in group order
+    candidates = np.flatnonzero(np.bincount(groups)[groups] >= min_stations)
+    if len(candidates) == 0:
+        return pd.DataFrame(columns=columns)
+    order = candidates[np.lexsort((-lux[candidates], station_ids[candidates], groups[candidates]))]
+    peaks = order[np.concatenate(([True], (groups[order][1:] != groups[order][:-1]) |
+                                          (station_ids[order][1:] != station_ids[order][:-1])))]
+    peaks = peaks[np.bincount(groups[peaks])[groups[peaks]] >= min_stations]
+    if len(peaks) == 0:
+        return pd.DataFrame(columns=columns)
+
+    coincidences, starts = np.unique(groups[peaks], return_index=True)
+    rows = np.searchsorted(coincidences, groups[peaks])
+    first = np.minimum.reduceat(times[peaks], starts)
+    table = {'time': first.astype('datetime64[ns]'), 'stations': np.diff(np.append(starts, len(peaks))),
+             'spread': (np.maximum.reduceat(times[peaks], starts) - first) / 1e9}
+    for station, name in enumerate(names):
+        at_station = station_ids[peaks] == station
+        peak_times = np.full(len(coincidences), np.datetime64('NaT'), dtype='datetime64[ns]')
+        peak_times[rows[at_station]] = times[peaks][at_station].astype('datetime64[ns]')
+        peak_lux = np.full(len(coincidences), np.nan)
+        peak_lux[rows[at_station]] = lux[peaks][at_station]
+        table[name + '_time'] = peak_times
+        table[name + '_peak_lux'] = peak_lux
+    return pd.DataFrame(table, columns=columns)
+
+
+# Main program
+if __name__ == "__main__":
+
+    # Construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser(description='Find the fireball candidates seen by several radiometer stations at the same time',
+                                 epilog='Example usage: python coincidences.py -p 0.02 Hove=/data/hove Lewes=/data/lewes/event_catalog.db')
+    ap.add_argument("station", type=str, nargs='+',
+                    help="Events of each station, optionally named e.g. Hove=<source>. The source is an event catalog (.db), "
+                         "a lightcurve batch table, or data files, quoted globs or a directory of day files to find peaks in. "
+                         "A catalog without a station name gives a station for each of its sensors")
+    ap.add_argument("-t", "--tolerance", type=float, default=TOLERANCE,
+                    help="Maximum time between the peaks of the stations in seconds. Default is " + str(TOLERANCE))
+    ap.add_argument("-m", "--min-stations", type=int, default=MIN_STATIONS,
+                    help="Minimum number of stations seeing a coincidence. Default is " + str(MIN_STATIONS))
+    ap.add_argument("-p", "--prominence", type=float, default=0.0,
+                    help="Peak detection prominence above background for data files. Default is auto, which finds the peaks that "
+                         "rise 10 times the noise of the readings around them above the background")
+    ap.add_argument("--start", type=str, default=None,
+                    help="Only use the events from this time onwards e.g. \"2023-01-31 00:01:15\"")
+    ap.add_argument("--end", type=str, default=None,
+                    help="Only use the events up to this time e.g. \"2023-01-31 00:01:45\"")
+    ap.add_argument("-j", "--jobs", type=int, default=0,
+                    help="Number of processes loading the stations. Default is the number of CPUs")
+    ap.add_argument("-o", "--output", type=str, default=COINCIDENCES_FILE,
+                    help="Table of the coincidences. Default is " + COINCIDENCES_FILE)
+
+    # The stations may follow the options
+    args = vars(ap.parse_intermixed_args())
+    start_time = parse_time(args['start']) if args['start'] else None
+    end_time = parse_time(args['end']) if args['end'] else None
+
+    stations = load_stations(args['station'], args['prominence'], start_time, end_time, args['jobs'])
+    coincidences = find_coincidences(stations, int(args['tolerance'] * 1e9), args['min_stations'])
+
+    for coincidence in coincidences.itertuples(index=False):
+        coincidence = dict(zip(coincidences.columns, coincidence))
+        print(coincidence['time'].strftime("%Y-%m-%d %H:%M:%S.%f")[:-3], coincidence['stations'], "stations, spread",
+              round(coincidence['spread'], 3), "s:",
+              ', '.join(name + ' ' + coincidence[name + '_time'].strftime("%H:%M:%S.%f")[:-3] + ' ' + '{:.6g}'.format(coincidence[name + '_peak_lux'])
+                        for name in stations if not pd.isna(coincidence[name + '_time'])))
+    coincidences.to_csv(args['output'], index=False)
+    print(len(coincidences), "coincidences written to", args['output'])
@@ -1,57 +1,13 @@
 import argparse
-import re
 import pandas as pd
 from matplotlib import pyplot as plt
 import numpy as np
 import scipy.stats
-import ephem
 import datetime
 
-TWILIGHT_HORIZON = '-9.0'     # Set degree below horizon for twilight (astronomical is -18 degrees)
+from twilight import TwilightTable
 
 
-class ConfigReader() :
-    def get_config(self, config_dir) :
-        with open(config_dir + '/.config') as fp:
-            for cnt, line in enumerate(fp):
-                line_words = (re.split("[: ]+", line))
-                if line_words[0] == 'stationID' : self.cameraname = line_words[1]
-                if line_words[0] == 'latitude'  : self.latitude = line_words[1]
-                if line_words[0] == 'longitude' : self.longitude = line_words[1]
-                if line_words[0] == 'elevation' : self.elevation = float(line_words[1])
-
-
-class DayNightChecker() :
-
-    def __init__(self, latitude, longitude, elevation) :
-        self.location = ephem.Observer()
-        self.location.lat, self.location.long = str(latitude), str(longitude)
-        self.location.elevation          = elevation
-        self.location.horizon            = TWILIGHT_HORIZON
-
-        self.sun = ephem.Sun()
-
-
-    def is_sun_down(self, time):
-
-        ephem_time = ephem.Date(time)
-
-        # Only recalculate rise and set if one of them has passed
-        try:
-            if (ephem_time < self.next_setting) and (ephem_time < self.next_rising) :
-                return (self.next_setting > self.next_rising)
-        except:
-            pass
-
-        # Calculate rise and set times
-        try:
-            self.next_setting = self.location.next_setting(self.sun, start=ephem_time)
-            self.next_rising  = self.location.next_rising(self.sun, start=ephem_time)
-            # print(ephem_time, self.next_setting, self.next_rising)
-            return self.next_setting > self.next_rising
-        except:
-            return False
-
 # Main program
 if __name__ == "__main__":
 
@@ -76,9 +32,7 @@ if __name__ == "__main__":
     camera_angle = args['angle']
     night = args['night']
 
-    config = ConfigReader()
-    config.get_config(config_dir)
-    night_checker = DayNightChecker(config.latitude, config.longitude, config.elevation)
+    twilight_table = TwilightTable.from_config(config_dir)
 
     print("Comparing", sqm_file, fs_file)
 
@@ -120,14 +74,8 @@ if __name__ == "__main__":
         res = df[df['times'] > start_date]
         df = res[res['times'] < end_date]
 
-    # Clip the data outside astronomical twilight (sun 18 degrees below horizon)
-    indexes = []
-    for index, row in df.iterrows():
-        if not night_checker.is_sun_down(row.times) :
-            # print("Dropping", index, row.times)
-            indexes.append(index)
-    
-    df.drop(index=indexes, inplace=True)
+    # Clip the data outside twilight (sun 9 degrees below horizon)
+    df = df[twilight_table.sun_down_mask(df.times)]
 
     print(df)
 
@@ -1,14 +1,141 @@
 import argparse
-import glob
-import os
-import pandas as pd
-from matplotlib import pyplot as plt
-from scipy.signal import find_peaks
 import numpy as np
 
+import radiometer_loader
+from radiometer_loader import parse_time
+
 # Rolling average step size
 STEP_SIZE = 100
 
+# Files of the rolling average lux, and of the SQM calculated from the visible sensor readings
+LUX_FILE = 'lux.csv'
+IR_FILE = 'sqm_with_ir.csv'
+
+# Luminous efficacy at 5800 K
+LUM_EFFICACY = 0.0079 # 1 lux in W/m^2
+
+# Re irradiance responsivity from TSL2591 datasheet, white light on "visible" sensor channel 0
+# The 100 scaling factor is to convert the RE_WHITE_CHANNEL0 from the datsheet units of counts/(μW/cm2) to counts/(W/m2)
+RE_WHITE_CHANNEL0 = 264.1 * 100
+TSL2591_LUX_DF = 408.0
+TSL2591_LUX_COEFC = 0.59
+
+# High gain factor 428x from https://github.com/adafruit/Adafruit_CircuitPython_TSL2591/blob/main/adafruit_tsl2591.py
+GAIN_HIGH = 428
+
+
+# SQM magnitudes of lux values. Zero or negative lux gives NaN, which isn't output
+def lux_to_sqm(lux):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.log10(lux / 108000) / -0.4
+
+
+# Read the lux readings of the files, and the lux calculated from the visible sensor readings, a block at a time.
+# The lux is read as float64, as pandas read it when the converter loaded the files with read_csv. Whole files are
+# read in blocks of a fixed size, and with start or end times only the readings of each file between them are read,
+# using the index, so only one block or one file's readings are held at a time
+def read_blocks(file_names, start=None, end=None):
+    for file_name in file_names:
+        if start is None and end is None:
+            blocks = radiometer_loader.iterate_file(file_name, np.float64)
+        else:
+            blocks = [radiometer_loader.load_file(file_name, start, end, np.float64)]
+        for data, skipped in blocks:
+            if skipped:
+                print("Skipped", skipped, "incomplete lines in", file_name)
+            cpl = (data['atime'].astype(float) * data['gain'].astype(float)) / TSL2591_LUX_DF
+            # lux2 = ((TSL2591_LUX_COEFC * visible)) / cpl
+            yield {'time': data['time'], 'lux': data['lux'], 'lux2': data['visible'] / cpl}
+
+
+# Rolling averages of readings over STEP_SIZE readings centred on every STEP_SIZE'th reading, the same as pandas'
+# rolling(STEP_SIZE, center=True).mean() taken every STEP_SIZE rows, apart from the rounding of the last digit or
+# two, as pandas keeps a running sum. The averages of every STEP_SIZE'th reading are over consecutive windows of
+# readings, so each window is averaged once it is complete, and the readings of an incomplete window are carried
+# over to the next block. The first and last readings without a complete window centred on them give no average,
+# as pandas gives NaN
+class RollingAverages():
+
+    def __init__(self, step_size=STEP_SIZE):
+        self.step_size = step_size
+        self.skip = (step_size - step_size // 2) % step_size
+        self.carried = None
+
+    # Averages of the windows completed by a block of readings, with the time of the reading each is centred on
+    def add(self, block):
+        skip = min(self.skip, len(block['time']))
+        self.skip -= skip
+        if self.carried is not None:
+            block = {key: np.concatenate((self.carried[key], values[skip:])) for key, values in block.items()}
+        else:
+            block = {key: values[skip:] for key, values in block.items()}
+
+        used = len(block['time']) // self.step_size * self.step_size
+        self.carried = {key: values[used:] for key, values in block.items()}
+        averages = {key: values[:used].reshape(-1, self.step_size).mean(axis=1) for key, values in block.items() if key != 'time'}
+        averages['time'] = block['time'][self.step_size // 2:used:self.step_size]
+        return averages
+
+
+# Rolling averages of the blocks of readings. Streams too short for the step size are averaged with a step of half
+# their length, so the first readings are held until there are enough for the step size
+def rolling_averages(blocks, step_size=STEP_SIZE):
+    held = []
+    averages = None
+    for block in blocks:
+        if averages is None:
+            held.append(block)
+            if sum(len(held_block['time']) for held_block in held) < 2 * step_size:
+                continue
+            averages = RollingAverages(step_size)
+            block = {key: np.concatenate([held_block[key] for held_block in held]) for key in block}
+        yield averages.add(block)
+
+    readings = sum(len(held_block['time']) for held_block in held)
+    if averages is None and readings >= 2:
+        yield RollingAverages(readings // 2).add({key: np.concatenate([held_block[key] for held_block in held]) for key in held[0]})
+
+
+# Date and time strings of times in ns e.g. 2023-01-31T00:01:15.250, written as 2023/01/31,00:01:15.250
+def format_times(times):
+    return np.datetime_as_string(times.astype('datetime64[ns]').astype('datetime64[ms]'), unit='ms').tolist()
+
+
+# Append rows of the times and values to a csv file, with the header before the first rows. The values are
+# written as pandas writes them, so the files are the same as those of the dataframes the converter used to save
+def write_rows(output_file, time_strings, column, values):
+    if output_file.tell() == 0:
+        output_file.write('Date,Time,' + column + '\n')
+    output_file.writelines(time[:10].replace('-', '/') + ',' + time[11:] + ',' + repr(value) + '\n'
+                           for time, value in zip(time_strings, values.tolist()))
+    return len(values)
+
+
+# Convert the readings of the files to the rolling average lux, the SQM, and the SQM of the visible sensor readings,
+# in one pass over the files. If a twilight table is given only the readings taken when the sun is down are output.
+# Returns the number of rows written to each file
+def convert(file_names, output_file_name, lux_file_name=LUX_FILE, ir_file_name=IR_FILE, start=None, end=None,
+            twilight_table=None):
+    rows = {output_file_name: 0, lux_file_name: 0, ir_file_name: 0}
+    if twilight_table is not None:
+        # The twilight table is in UTC, and the readings are logged in the local time of the computer
+        from twilight import local_to_utc
+    with open(lux_file_name, 'w') as lux_file, open(output_file_name, 'w') as output_file, open(ir_file_name, 'w') as ir_file:
+        for averages in rolling_averages(read_blocks(file_names, start, end)):
+            times = averages['time']
+            night = twilight_table.sun_down_mask(local_to_utc(times)) if twilight_table is not None else np.ones(len(times), dtype=bool)
+
+            sqm = lux_to_sqm(averages['lux'])
+            selected = night & ~np.isnan(averages['lux']) & ~np.isnan(sqm)
+            time_strings = format_times(times[selected])
+            rows[lux_file_name] += write_rows(lux_file, time_strings, 'Rolling', averages['lux'][selected])
+            rows[output_file_name] += write_rows(output_file, time_strings, 'SQM', sqm[selected])
+
+            sqm = lux_to_sqm(averages['lux2'])
+            selected = night & ~np.isnan(averages['lux2']) & ~np.isnan(sqm)
+            rows[ir_file_name] += write_rows(ir_file, format_times(times[selected]), 'SQM', sqm[selected])
+    return rows
+
 
 # Main program
 if __name__ == "__main__":
@@ -18,77 +145,32 @@ if __name__ == "__main__":
     ap.add_argument("file", type=str, nargs='*',
                     help="File or directory to analyse.")
     ap.add_argument("-o", "--outfile", type=str, help="Output file name", default="sqm.csv")
+    ap.add_argument("--lux-file", type=str, default=LUX_FILE,
+                    help="Output file name of the rolling average lux. Default is " + LUX_FILE)
+    ap.add_argument("--ir-file", type=str, default=IR_FILE,
+                    help="Output file name of the SQM calculated from the visible sensor readings. Default is " + IR_FILE)
+    ap.add_argument("-c", "--config_dir", type=str, default=None,
+                    help="RMS config directory. If given, only the readings taken when the sun is below the twilight horizon at the RMS site are output")
+    ap.add_argument("--start", type=str, default=None,
+                    help="Only use the data from this time onwards e.g. \"2023-01-31 00:01:15\"")
+    ap.add_argument("--end", type=str, default=None,
+                    help="Only use the data up to this time e.g. \"2023-01-31 00:01:45\"")
 
     args = vars(ap.parse_args())
 
     file_names = args['file']
-    output_file_name = args['outfile']
+    config_dir = args['config_dir']
+    start_time = parse_time(args['start']) if args['start'] else None
+    end_time = parse_time(args['end']) if args['end'] else None
 
     print("Converting", file_names)
 
-    # Collect the data into a pandas dataframe
-    columns = ["Date", "Time", "Lux", "Visible", "IR", "Gain", "IntTime"]
-    dfs = [pd.read_csv(file_name, sep=' ', names=columns)
-           for file_name in file_names]
-    df = pd.concat(dfs, ignore_index=True)
-
-    # Check that the file length is long enough for the rolling average step size
-    if STEP_SIZE > int(len(df["Lux"]) / 2) :
-        STEP_SIZE = int(len(df["Lux"]) / 2)
-
-    # Format the times into datetime values
-    # times = pd.to_datetime(df.Date + " " + df.Time,
-    #                        format="%Y/%m/%d %H:%M:%S.%f")
-
-    df["Rolling"] = df.Lux.rolling(STEP_SIZE, center=True).mean()
-    df = df.iloc[::STEP_SIZE, :]
-    df["SQM"] = np.log10(df["Rolling"]/108000)/-0.4
-    df = df.dropna(how='any')
-    print(df)
-
-    df[['Date', 'Time', "Rolling"]].to_csv('lux.csv', index=False)
-    df[['Date', 'Time', "SQM"]].to_csv(output_file_name, index=False)
-
-
-    # Try using visible+IR sensor values
-    # Luminous efficacy at 5800 K
-    LUM_EFFICACY = 0.0079 # 1 lux in W/m^2
-
-    # Re irradiance responsivity from TSL2591 datasheet, white light on "visible" sensor channel 0
-    # The 100 scaling factor is to convert the RE_WHITE_CHANNEL0 from the datsheet units of counts/(μW/cm2) to counts/(W/m2)
-    RE_WHITE_CHANNEL0 = 264.1 * 100
-    TSL2591_LUX_DF = 408.0
-    TSL2591_LUX_COEFC = 0.59
-
-    # High gain factor 428x from https://github.com/adafruit/Adafruit_CircuitPython_TSL2591/blob/main/adafruit_tsl2591.py
-    GAIN_HIGH = 428
-
-    dfs = [pd.read_csv(file_name, sep=' ', names=columns)
-           for file_name in file_names]
-    df = pd.concat(dfs, ignore_index=True)
-
-    cpl = (df.IntTime * df.Gain) / TSL2591_LUX_DF
-
-    # df["lux2"] = ((TSL2591_LUX_COEFC * df.Visible)) / cpl
-    df["lux2"] = df.Visible / cpl
-
-    """
-    gain_scaling = np.array(df["Gain"].values, dtype=float)/GAIN_HIGH
-
-    # Get watts/m2 from visible data
-    visible_data = np.array(df["Visible"].values, dtype=float)
-    watts_per_square_meter = visible_data/(RE_WHITE_CHANNEL0*gain_scaling)
-
-    # Compute the lux from visible data
-    df["lux_data_with_ir"] = watts_per_square_meter/LUM_EFFICACY
-    """
-
-    # df["Rolling"] = df.lux_data_with_ir.rolling(STEP_SIZE, center=True).mean()
-    df["Rolling"] = df.lux2.rolling(STEP_SIZE, center=True).mean()
-    df = df.iloc[::STEP_SIZE, :]
-    df["SQM"] = np.log10(df["Rolling"]/108000)/-0.4
-    df = df.dropna(how='any')
-    print(df)
-
-    df[['Date', 'Time', "SQM"]].to_csv('sqm_with_ir.csv', index=False)
+    # Get the night time intervals for the RMS site
+    twilight_table = None
+    if config_dir is not None:
+        from twilight import TwilightTable
+        twilight_table = TwilightTable.from_config(config_dir)
 
+    rows = convert(file_names, args['outfile'], args['lux_file'], args['ir_file'], start_time, end_time, twilight_table)
+    for file_name, count in rows.items():
+        print("Wrote", count, "rows to", file_name)
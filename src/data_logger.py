@@ -0,0 +1,196 @@
+from collections import deque
+import datetime
+import os
+import syslog
+import threading
+import time
+
+import radiometer_binary
+import radiometer_index
+from storage_manager import StorageManager
+
+DATA_DIR = os.path.expanduser('~/radiometer_data/')
+
+# Writer thread settings
+QUEUE_SIZE = 6000       # Readings held while the disk is stalled, 10 minutes at 10 Hz
+BATCH_SIZE = 1000       # Maximum readings formatted for each write
+WRITE_INTERVAL = 1.0    # Seconds between writes
+FLUSH_INTERVAL = 10.0   # Seconds between flushes to disk
+LATE_SECONDS = 5.0      # Readings written more than this after their time stamp are counted as late
+
+
+# Class for logging detections to radiometer data file
+class RadiometerDataLogger():
+
+    def __init__(self, name="", keep_days=0, binary=False, queue_size=QUEUE_SIZE, compress=False, keep_1s_months=0,
+                 quota_mb=0, verbose=False):
+        self.device_name = name
+        self.name = name
+        if name:
+            self.name = "_" + name + "_"
+        self.binary = binary
+        self.verbose = verbose
+        self.extension = radiometer_binary.BINARY_EXTENSION if binary else ".csv"
+
+        # Make the data logging directory
+        os.makedirs(DATA_DIR, exist_ok=True)
+
+        # Set the filename and open it for appending
+        self.open_day_file(datetime.datetime.now())
+        if verbose:
+            print("Writing data to file:", DATA_DIR + self.filename)
+
+        # Archive each day file once it is closed, building its aggregates for plotting and keeping them after
+        # its readings are removed
+        self.storage_manager = StorageManager(DATA_DIR, name, keep_days, keep_1s_months, quota_mb, compress,
+                                              DATA_DIR + self.filename, verbose)
+
+        # Readings are queued by the acquisition loop and written by a single writer thread
+        self.queue = deque()
+        self.queue_size = queue_size
+        self.dropped_count = 0
+        self.late_count = 0
+        self.written_count = 0
+        self.reported_counts = (0, 0)
+        self.stop_event = threading.Event()
+        self.writer_thread = threading.Thread(target=self.write_queue)
+        self.writer_thread.start()
+
+    # Open the data file for the day of the given time. The day boundaries are kept so that
+    # the date change check for each reading is a simple comparison
+    def open_day_file(self, obs_time):
+        self.day_start = datetime.datetime.combine(obs_time.date(), datetime.time())
+        self.next_day_start = self.day_start + datetime.timedelta(days=1)
+        self.filename = "R" + self.name + obs_time.strftime("%Y%m%d") + self.extension
+        if self.binary:
+            self.rmfile = radiometer_binary.open_binary_file(DATA_DIR + self.filename, self.device_name)
+        else:
+            self.rmfile = open(DATA_DIR + self.filename, "a")
+            # Binary files are fixed width so they can be searched without an index
+            self.index_writer = radiometer_index.IndexWriter(DATA_DIR + self.filename)
+
+    # Queue the date/time and lux reading to be written by the writer thread. The acquisition loop never
+    # waits on the disk: deque appends are atomic, and if the queue is full the reading is dropped and counted
+    def log_data(self, obs_time, lux_value, vis_level, ir_level, again, atime):
+        if len(self.queue) >= self.queue_size:
+            self.dropped_count += 1
+            return
+        self.queue.append((obs_time, lux_value, vis_level, ir_level, again, atime))
+
+    # Write out the queued readings in batches, and flush the data log file to disk every 10s
+    def write_queue(self):
+        last_flush = time.monotonic()
+        while True:
+            stopping = self.stop_event.wait(WRITE_INTERVAL)
+            self.write_batch()
+
+            if stopping or time.monotonic() - last_flush >= FLUSH_INTERVAL:
+                try:
+                    self.rmfile.flush()
+                except Exception as e:
+                    syslog.syslog(syslog.LOG_WARNING, "Data logger " + self.filename + " unable to flush: " + str(e))
+                last_flush = time.monotonic()
+                self.report_counts()
+
+            if stopping and not self.queue:
+                self.rmfile.close()
+                return
+
+    # Format and write the readings that are in the queue, in one write per day file. A reading that can't be
+    # formatted is dropped on its own, and counted with the dropped readings
+    def write_batch(self):
+        batch = []
+        while self.queue and len(batch) < BATCH_SIZE:
+            batch.append(self.queue.popleft())
+        if not batch:
+            return
+
+        late_time = datetime.datetime.now() - datetime.timedelta(seconds=LATE_SECONDS)
+        out_strings = []
+        lines = []
+        for reading in batch:
+            obs_time = reading[0]
+            try:
+                if obs_time < late_time:
+                    self.late_count += 1
+
+                # Check for date change
+                if obs_time >= self.next_day_start or obs_time < self.day_start:
+                    self.write_out(out_strings, lines)
+                    out_strings = []
+                    lines = []
+                    self.rmfile.close()
+                    self.storage_manager.day_closed(DATA_DIR + self.filename)
+                    self.open_day_file(obs_time)
+
+                out_string = self.format_reading(*reading)
+            except Exception as e:
+                self.dropped_count += 1
+                syslog.syslog(syslog.LOG_WARNING, "Data logger " + self.filename + " unable to log reading: " + str(reading) + " " + str(e))
+                continue
+
+            out_strings.append(out_string)
+            if not self.binary:
+                lines.append((obs_time, len(out_string)))
+            if self.verbose and self.binary:
+                print(*reading)
+            elif self.verbose:
+                print(out_string, end='')
+
+        self.write_out(out_strings, lines)
+
+    # Format a reading as a binary record or a csv line
+    def format_reading(self, obs_time, lux_value, vis_level, ir_level, again, atime):
+        if self.binary:
+            return radiometer_binary.pack_record(obs_time, lux_value, vis_level, ir_level, again, atime)
+        return radiometer_binary.CSV_FORMAT.format(obs_time.strftime(
+            "%Y/%m/%d %H:%M:%S.%f")[:-3], lux_value, vis_level, ir_level, again, atime)
+
+    # Write formatted readings to the day file. The times and lengths of the csv lines are only added to the
+    # index once the lines are written, so the index always matches the file. Readings that can't be written
+    # are counted as dropped
+    def write_out(self, out_strings, lines):
+        if not out_strings:
+            return
+        position = None
+        try:
+            position = self.rmfile.tell()
+            self.rmfile.write((b'' if self.binary else '').join(out_strings))
+        except Exception as e:
+            self.dropped_count += len(out_strings)
+            syslog.syslog(syslog.LOG_WARNING, "Data logger " + self.filename + " unable to write " + str(len(out_strings)) +
+                          " readings: " + str(e))
+            if position is not None:
+                self.remove_partial_write(position)
+            return
+
+        self.written_count += len(out_strings)
+        for obs_time, length in lines:
+            self.index_writer.add(obs_time, length)
+
+    # After a failed write, part of the readings may have reached the file, so the file is cut back to its size
+    # before the write. The next readings then start on a line or record of their own, and the file only holds
+    # the readings counted as written
+    def remove_partial_write(self, position):
+        try:
+            self.rmfile.flush()
+        except Exception as e:
+            syslog.syslog(syslog.LOG_WARNING, "Data logger " + self.filename + " unable to flush: " + str(e))
+        try:
+            if os.path.getsize(DATA_DIR + self.filename) > position:
+                os.truncate(DATA_DIR + self.filename, position)
+        except Exception as e:
+            syslog.syslog(syslog.LOG_WARNING, "Data logger " + self.filename + " unable to remove a partial write: " + str(e))
+
+    # Log the dropped and late reading counts if they have changed
+    def report_counts(self):
+        counts = (self.dropped_count, self.late_count)
+        if counts != self.reported_counts and (self.dropped_count or self.late_count):
+            syslog.syslog(syslog.LOG_WARNING, "Data logger " + self.filename + " dropped readings: " + str(self.dropped_count) +
+                          " late readings: " + str(self.late_count) + " written readings: " + str(self.written_count))
+        self.reported_counts = counts
+
+    # Write out the queued readings and close the data file
+    def close(self):
+        self.stop_event.set()
+        self.writer_thread.join()
@@ -0,0 +1,83 @@
+import numpy as np
+from matplotlib import dates as mdates
+from matplotlib import pyplot as plt
+
+# Lines of many readings are drawn from the first, minimum, maximum and last reading of each run of readings that
+# fall in the same pixel column, rather than from every reading. The line drawn is the same as the full line at
+# the screen resolution, so a spike of a single reading is always visible, where plotting every nth reading would
+# miss it. The readings are decimated again for the visible time range whenever the plot is zoomed, panned or resized
+
+# Lines with no more than this many readings per pixel column are drawn in full
+READINGS_PER_PIXEL = 4
+
+
+# Indices of the first reading in each run that matches the run's extreme value
+def run_extreme_indices(values, run_ids, run_lengths, extremes):
+    matches = np.flatnonzero(values == np.repeat(extremes, run_lengths))
+    first = np.concatenate(([True], run_ids[matches][1:] != run_ids[matches][:-1]))
+    return matches[first]
+
+
+# Indices of the readings to draw for the visible range from x_min to x_max, with the given number of pixel
+# columns. The times are date numbers, and needn't be in order. Readings just outside the range are kept so the
+# line runs to the edges of the plot
+def decimate(times, values, x_min, x_max, pixels):
+    visible = (times >= x_min) & (times <= x_max)
+    visible[:-1] |= visible[1:]
+    visible[1:] |= visible[:-1]
+    indices = np.flatnonzero(visible)
+    if len(indices) <= READINGS_PER_PIXEL * pixels or x_max <= x_min:
+        return indices
+
+    # Runs of consecutive readings in the same pixel column
+    columns = np.clip(np.floor((times[indices] - x_min) * (pixels / (x_max - x_min))), -1, pixels).astype(np.int64)
+    starts = np.flatnonzero(np.concatenate(([True], (columns[1:] != columns[:-1]) | (np.diff(indices) != 1))))
+    run_lengths = np.diff(np.append(starts, len(indices)))
+    run_ids = np.repeat(np.arange(len(starts)), run_lengths)
+
+    # fmin and fmax skip NaN values, e.g. the sky brightness of a zero lux reading, unless the whole run is NaN
+    run_values = values[indices]
+    with np.errstate(invalid='ignore'):
+        minimums = run_extreme_indices(run_values, run_ids, run_lengths, np.fmin.reduceat(run_values, starts))
+        maximums = run_extreme_indices(run_values, run_ids, run_lengths, np.fmax.reduceat(run_values, starts))
+    return indices[np.unique(np.concatenate((starts, starts + run_lengths - 1, minimums, maximums)))]
+
+
+# A line of readings against time that is decimated to the pixel columns of its axes
+class DecimatedLine():
+
+    def __init__(self, ax, times, values, **kwargs):
+        self.ax = ax
+        self.times = np.asarray(times)
+        self.date_numbers = mdates.date2num(self.times)
+        self.values = np.asarray(values, dtype=np.float64)
+        self.view = None
+        indices = decimate(self.date_numbers, self.values, np.nanmin(self.date_numbers, initial=np.inf),
+                           np.nanmax(self.date_numbers, initial=-np.inf), self.pixels())
+        self.line = ax.plot(self.times[indices], self.values[indices], **kwargs)[0]
+        ax.callbacks.connect('xlim_changed', self.update)
+        ax.figure.canvas.mpl_connect('resize_event', self.update)
+
+    def pixels(self):
+        return max(int(self.ax.bbox.width), 1)
+
+    # Decimate the readings again for the visible range and width of the axes
+    def update(self, event=None):
+        x_min, x_max = self.ax.get_xlim()
+        view = (x_min, x_max, self.pixels())
+        if view == self.view:
+            return
+        self.view = view
+        indices = decimate(self.date_numbers, self.values, *view)
+        self.line.set_data(self.times[indices], self.values[indices])
+
+
+# Plot readings against time on the current axes, or the axes given, decimated unless raw is set.
+# Returns the line, as plt.plot does
+def plot(times, values, ax=None, raw=False, **kwargs):
+    ax = ax or plt.gca()
+    if raw:
+        return ax.plot(times, values, **kwargs)[0]
+    decimated = DecimatedLine(ax, times, values, **kwargs)
+    decimated.line.decimated = decimated
+    return decimated.line
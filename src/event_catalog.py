@@ -0,0 +1,266 @@
+import argparse
+import os
+import re
+import sqlite3
+import numpy as np
+
+import radiometer_binary
+import radiometer_loader
+
+CAPTURE_DIR = os.path.expanduser('~/radiometer_data/')
+CATALOG_FILE = CAPTURE_DIR + 'event_catalog.db'
+
+# Seconds to wait for another process writing to the catalog, e.g. the batch workers of the analysis tools
+CATALOG_TIMEOUT = 60
+
+# The catalog holds one row for each fireball candidate of each sensor, keyed by the sensor name and the time of
+# the peak reading in ns since 1970-01-01 local time. The file holding the readings and the byte offset to read
+# them from are kept with each event: the first line of the minute of the peak in a csv file, the peak's record in
+# a binary file, or the header of the chunk holding the peak in a compressed file. Gzipped files have no offset.
+# The analysis tools fill in the columns they calculate, so an event found by the graph tool keeps the magnitudes
+# later calculated for it by lightcurve, and the source of each event is the tool that first found it. The primary
+# key also indexes the events by sensor name. The background column records what lightcurve measured the event
+# from: the readings around its peak, or for events analysed by older versions, the median of the whole file
+EVENT_COLUMNS = ['sensor', 'time', 'peak_lux', 'magnitude', 'raw_magnitude', 'energy', 'mass', 'integrated_lux',
+                 'median_lux', 'background', 'file', 'offset', 'source']
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    sensor TEXT NOT NULL,
+    time INTEGER NOT NULL,
+    peak_lux REAL,
+    magnitude REAL,
+    raw_magnitude REAL,
+    energy REAL,
+    mass REAL,
+    integrated_lux REAL,
+    median_lux REAL,
+    background TEXT,
+    file TEXT,
+    offset INTEGER,
+    source TEXT,
+    PRIMARY KEY (sensor, time)
+);
+CREATE INDEX IF NOT EXISTS events_time ON events (time);
+CREATE INDEX IF NOT EXISTS events_peak_lux ON events (peak_lux);
+CREATE INDEX IF NOT EXISTS events_magnitude ON events (magnitude);
+"""
+UPSERT = "INSERT INTO events (" + ', '.join(EVENT_COLUMNS) + ") VALUES (" + ', '.join('?' * len(EVENT_COLUMNS)) + \
+         ") ON CONFLICT (sensor, time) DO UPDATE SET " + \
+         ', '.join(column + ' = COALESCE(excluded.' + column + ', ' + column + ')' for column in EVENT_COLUMNS[2:-1])
+
+# Catalog columns of the results of lightcurve's analysis
+LIGHTCURVE_COLUMNS = {'peak_lux': 'peak_lux', 'magnitude': 'peak_magnitude', 'raw_magnitude': 'raw_peak_magnitude',
+                      'energy': 'energy', 'mass': 'mass', 'integrated_lux': 'integrated_lux', 'median_lux': 'median_lux'}
+
+# Backgrounds of the events analysed by lightcurve
+LOCAL_BACKGROUND = 'local'
+FILE_MEDIAN_BACKGROUND = 'file median'
+
+# Columns printed by the query command, and the orders the events can be listed in
+QUERY_COLUMNS = ['time', 'sensor', 'peak_lux', 'magnitude', 'energy', 'mass', 'background', 'file', 'offset']
+ORDERS = {'time': 'time', 'lux': 'peak_lux DESC', 'magnitude': 'magnitude'}
+
+
+# Open the catalog, creating its table and indexes if they don't exist. A catalog made before the background column
+# was added has it added, and its events analysed by lightcurve are marked as measured from the file median
+def open_catalog(catalog_file=CATALOG_FILE):
+    connection = sqlite3.connect(catalog_file, timeout=CATALOG_TIMEOUT)
+    connection.executescript(SCHEMA)
+    if 'background' not in [row[1] for row in connection.execute("PRAGMA table_info(events)")]:
+        with connection:
+            connection.execute("ALTER TABLE events ADD COLUMN background TEXT")
+            connection.execute("UPDATE events SET background = ? WHERE magnitude IS NOT NULL", (FILE_MEDIAN_BACKGROUND,))
+    return connection
+
+
+# Sensor name of a day or event file e.g. R_SQM_20260204.csv -> SQM, E_SQM_20260204_021400.csv -> SQM.
+# Files without a sensor name have the name ""
+def sensor_name(file_name):
+    match = re.match(r'[RE]_(.+?)_\d{8}', os.path.basename(file_name))
+    return match.group(1) if match else ""
+
+
+# The file of a list of files that holds the reading at a time in ns: the file named with the day of the time,
+# or the only file. None if the file isn't known
+def event_file(file_names, time_ns):
+    day = str(np.datetime64(int(time_ns), 'ns').astype('datetime64[D]')).replace('-', '')
+    for file_name in file_names:
+        if re.search(r'(?<!\d)' + day + r'(?!\d)', os.path.basename(file_name)):
+            return file_name
+    return file_names[0] if len(file_names) == 1 else None
+
+
+# Byte offsets in a data file from which the readings at the times in ns can be read. None where there is no offset
+def event_offsets(file_name, times):
+    offsets = [None] * len(times)
+    if file_name is None or file_name.endswith('.gz') or not os.path.exists(file_name):
+        return offsets
+
+    if file_name.endswith(radiometer_loader.COMPRESSED_EXTENSION):
+        import radiometer_compress
+        chunk_offsets, first_times, last_times = radiometer_compress.chunk_offsets(file_name)
+        for event, time_ns in enumerate(times):
+            chunks = np.flatnonzero((first_times <= time_ns) & (last_times >= time_ns))
+            offsets[event] = int(chunk_offsets[chunks[0]]) if len(chunks) else None
+    elif radiometer_binary.is_binary_file(file_name):
+        records = radiometer_binary.read_binary(file_name)
+        records = np.searchsorted(records['time'], times)
+        offsets = [radiometer_binary.HEADER_SIZE + int(record) * radiometer_binary.RECORD_DTYPE.itemsize for record in records]
+    else:
+        # The minutes are scanned without saving an index, so analysing files outside the data directory doesn't
+        # leave index files beside them
+        entries = radiometer_loader.file_index(file_name, save=False)
+        if len(entries):
+            offsets = [int(entries['offset'][entry]) if entry >= 0 else 0
+                       for entry in np.searchsorted(entries['time'], times, side='right') - 1]
+    return offsets
+
+
+# Add events to the catalog, or update the events already in it. Each event is a dict of its columns. Columns
+# without values keep the values already in the catalog
+def upsert_events(connection, events):
+    rows = [tuple(event.get(column) for column in EVENT_COLUMNS) for event in events]
+    with connection:
+        connection.executemany(UPSERT, rows)
+
+
+# Record the events found by an analysis tool in the files it analysed. The times are in ns, and the columns are
+# arrays of the other calculated values of each event, measured from the background given. The file and byte
+# offset of each event are found for it
+def record_events(file_names, times, source, columns=None, catalog_file=CATALOG_FILE, background=None):
+    # Events aren't recorded on a computer without the data directory, unless another catalog file is given
+    if not os.path.isdir(os.path.dirname(os.path.abspath(catalog_file))):
+        return 0
+
+    times = [int(time_ns) for time_ns in times]
+    files = [event_file(file_names, time_ns) for time_ns in times]
+    offsets = [None] * len(times)
+    for file_name in set(files):
+        events = [event for event in range(len(times)) if files[event] == file_name]
+        for event, offset in zip(events, event_offsets(file_name, [times[event] for event in events])):
+            offsets[event] = offset
+
+    events = []
+    for event, time_ns in enumerate(times):
+        values = {column: float(column_values[event]) if np.isfinite(column_values[event]) else None
+                  for column, column_values in (columns or {}).items()}
+        values.update({'sensor': sensor_name(files[event] or ""), 'time': time_ns, 'background': background,
+                       'file': os.path.abspath(files[event]) if files[event] else None, 'offset': offsets[event], 'source': source})
+        events.append(values)
+
+    connection = open_catalog(catalog_file)
+    try:
+        upsert_events(connection, events)
+    finally:
+        connection.close()
+    return len(events)
+
+
+# Record the table of events of lightcurve's batch analysis, one file at a time
+def record_lightcurve_table(events, source, catalog_file=CATALOG_FILE):
+    recorded = 0
+    for file_name in events['file'].unique():
+        in_file = (events['file'] == file_name).to_numpy()
+        recorded += record_events([file_name], events['time'].to_numpy()[in_file].astype(np.int64), source,
+                                  {column: events[key].to_numpy()[in_file] for column, key in LIGHTCURVE_COLUMNS.items()}, catalog_file,
+                                  LOCAL_BACKGROUND)
+    return recorded
+
+
+# Remove the events that an earlier backfill of the files measured from the file median, between the start and end
+# times in ns. The peaks found from the local background replace them, so peaks that are no longer found don't stay
+def remove_file_median_events(file_names, start=None, end=None, catalog_file=CATALOG_FILE):
+    connection = open_catalog(catalog_file)
+    try:
+        with connection:
+            return sum(connection.execute("DELETE FROM events WHERE file = ? AND source = 'backfill' AND background = ? AND time >= ? AND time <= ?",
+                                          (os.path.abspath(file_name), FILE_MEDIAN_BACKGROUND,
+                                           start if start is not None else np.iinfo(np.int64).min,
+                                           end if end is not None else np.iinfo(np.int64).max)).rowcount
+                       for file_name in file_names)
+    finally:
+        connection.close()
+
+
+# Find the events in the catalog. The magnitude limit selects the events brighter than it
+def query_events(connection, sensor=None, start=None, end=None, min_lux=None, max_magnitude=None, order='time', limit=None):
+    conditions = []
+    parameters = []
+    for condition, value in [('sensor = ?', sensor), ('time >= ?', start), ('time <= ?', end),
+                             ('peak_lux >= ?', min_lux), ('magnitude <= ?', max_magnitude)]:
+        if value is not None:
+            conditions.append(condition)
+            parameters.append(value)
+    query = "SELECT " + ', '.join(QUERY_COLUMNS) + " FROM events" + \
+            (" WHERE " + ' AND '.join(conditions) if conditions else "") + " ORDER BY " + ORDERS[order]
+    if limit:
+        query += " LIMIT ?"
+        parameters.append(limit)
+    return connection.execute(query, parameters).fetchall()
+
+
+# Analyse every peak of the files, globs or directories with lightcurve and record the events in the catalog,
+# replacing the events of the files that an earlier backfill measured from the file median. The light curves are
+# analysed with lightcurve's default meteor distance, angle, extinction and velocity. The analysis tools are only
+# imported for a backfill, as scipy and matplotlib are slow to import for a query
+def backfill(file_args, args, start_time, end_time):
+    import lightcurve
+    file_names = lightcurve.batch_files(file_args, args['name'], start_time, end_time)
+    events = lightcurve.analyse_files(file_names, dict(lightcurve.LIGHTCURVE_DEFAULTS, **args), start_time, end_time)
+    removed = remove_file_median_events(events.attrs['analysed_files'], start_time, end_time, args['catalog'])
+    if removed:
+        print("Removed", removed, "events measured from the file median")
+    return record_lightcurve_table(events, 'backfill', args['catalog'])
+
+
+# Main program
+if __name__ == "__main__":
+
+    # Construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser(description='Query the catalog of fireball candidates, or backfill it from data files',
+                                 epilog='Example usage: python event_catalog.py query --max-magnitude -10 --start 2025-01-01')
+    ap.add_argument("command", type=str, choices=["query", "backfill"],
+                    help="Query the catalog, or analyse every peak of the data files and record them in the catalog")
+    ap.add_argument("file", type=str, nargs='*',
+                    help="Files, globs or directories to backfill. Default is the day files in " + CAPTURE_DIR +
+                         " covering the start and end times")
+    ap.add_argument("-c", "--catalog", type=str, default=CATALOG_FILE,
+                    help="Catalog file. Default is " + CATALOG_FILE)
+    ap.add_argument("--name", type=str, default=None,
+                    help="Name of the sensor. Default is all sensors")
+    ap.add_argument("--start", type=str, default=None,
+                    help="Only use the events from this time onwards e.g. \"2023-01-31 00:01:15\"")
+    ap.add_argument("--end", type=str, default=None,
+                    help="Only use the events up to this time e.g. \"2023-01-31 00:01:45\"")
+    ap.add_argument("--min-lux", type=float, default=None,
+                    help="Only list the events with at least this peak lux")
+    ap.add_argument("--max-magnitude", type=float, default=None,
+                    help="Only list the events brighter than this magnitude e.g. -10")
+    ap.add_argument("--order", type=str, choices=list(ORDERS), default='time',
+                    help="Order of the events listed, by time, brightest peak lux or brightest magnitude. Default is time")
+    ap.add_argument("--limit", type=int, default=None,
+                    help="Maximum number of events to list")
+    ap.add_argument("-p", "--prominence", type=float, default=0.0,
+                    help="Peak detection prominence above background for the backfill. Default is auto, which finds the peaks that rise "
+                         "10 times the noise of the readings around them above the background")
+    ap.add_argument("-j", "--jobs", type=int, default=0,
+                    help="Number of processes for the backfill. Default is the number of CPUs")
+
+    # The files to backfill may follow the options
+    args = vars(ap.parse_intermixed_args())
+    start_time = radiometer_loader.parse_time(args['start']) if args['start'] else None
+    end_time = radiometer_loader.parse_time(args['end']) if args['end'] else None
+
+    if args['command'] == 'backfill':
+        print("Recorded", backfill(args['file'], args, start_time, end_time), "events in", args['catalog'])
+        exit(0)
+
+    connection = open_catalog(args['catalog'])
+    events = query_events(connection, args['name'], start_time, end_time, args['min_lux'], args['max_magnitude'],
+                          args['order'], args['limit'])
+    print(' '.join(QUERY_COLUMNS))
+    for event in events:
+        event = dict(zip(QUERY_COLUMNS, event))
+        event['time'] = np.datetime64(event['time'], 'ns').astype('datetime64[ms]')
+        print(' '.join(str(event[column]) for column in QUERY_COLUMNS))
+    print(len(events), "events")
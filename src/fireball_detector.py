@@ -0,0 +1,174 @@
+import argparse
+import datetime
+import os
+import syslog
+import threading
+import numpy as np
+
+import data_logger
+import radiometer_binary
+
+# Directory of the event files in the data directory
+EVENT_SUBDIR = 'events/'
+
+# Detection defaults for 10 Hz readings
+PRE_TRIGGER_SAMPLES = 50        # 5s of readings before the trigger
+POST_TRIGGER_SAMPLES = 50       # 5s of readings after the light level has returned to the baseline
+MAX_EVENT_SAMPLES = 1200        # End an event after 120s even if the light level hasn't returned to the baseline
+BASELINE_ALPHA = 0.005          # Weight of each reading in the running baseline (~20s time constant)
+TRIGGER_SIGMA = 6.0             # Trigger when the lux is this many standard deviations above the baseline
+MIN_TRIGGER_LUX = 0.003         # and at least this many lux above the baseline
+TRIGGER_SAMPLES = 2             # for this many consecutive readings
+WARMUP_SAMPLES = 100            # Readings used to settle the baseline before triggering
+
+
+# Class to detect fireballs in the stream of readings as they are acquired. A running (exponentially weighted)
+# baseline and variance are kept, so each reading costs a fixed number of float operations. The readings of
+# each event, including a pre-trigger ring buffer, are written to their own small file in a background thread
+class FireballDetector():
+
+    def __init__(self, name="", event_dir=None, pre_samples=PRE_TRIGGER_SAMPLES, post_samples=POST_TRIGGER_SAMPLES,
+                 trigger_sigma=TRIGGER_SIGMA, min_trigger_lux=MIN_TRIGGER_LUX, alpha=BASELINE_ALPHA, write_files=True, verbose=False):
+        self.name = "_" + name + "_" if name else ""
+        # The data directory is looked up when the detector is made, so a data directory set after import is used
+        self.event_dir = event_dir if event_dir is not None else data_logger.DATA_DIR + EVENT_SUBDIR
+        self.pre_samples = pre_samples
+        self.post_samples = post_samples
+        self.trigger_sigma = trigger_sigma
+        self.min_trigger_lux = min_trigger_lux
+        self.alpha = alpha
+        self.write_files = write_files
+        self.verbose = verbose
+
+        # Pre-trigger ring buffer
+        self.ring = [None] * pre_samples
+        self.ring_index = 0
+
+        self.baseline = None
+        self.variance = 0.0
+        self.warmup = WARMUP_SAMPLES
+        self.rising_count = 0
+        self.event = None
+
+    # Add a reading. Returns the completed event when an event ends, otherwise None. Events aren't kept by the
+    # detector, so the caller records or drops them
+    def update(self, obs_time, lux_value, vis_level, ir_level, again, atime):
+        reading = (obs_time, lux_value, vis_level, ir_level, again, atime)
+
+        if self.baseline is None:
+            self.baseline = lux_value
+
+        excess = lux_value - self.baseline
+        threshold = max(self.trigger_sigma * self.variance ** 0.5, self.min_trigger_lux)
+
+        if self.event is not None:
+            return self.update_event(reading, excess, threshold)
+
+        if excess > threshold and self.warmup <= 0:
+            self.rising_count += 1
+            if self.rising_count >= TRIGGER_SAMPLES:
+                self.start_event(reading, threshold)
+                return None
+        else:
+            self.rising_count = 0
+            # Only update the baseline outside events and rising edges
+            self.baseline += self.alpha * excess
+            self.variance += self.alpha * (excess * excess - self.variance)
+            self.warmup -= 1
+
+        self.ring[self.ring_index] = reading
+        self.ring_index = (self.ring_index + 1) % self.pre_samples
+        return None
+
+    def start_event(self, reading, threshold):
+        # Unwrap the ring buffer into the start of the event's readings
+        pre_trigger = [r for r in self.ring[self.ring_index:] + self.ring[:self.ring_index] if r is not None]
+        self.event = {'readings': pre_trigger + [reading], 'trigger_time': reading[0], 'baseline': self.baseline,
+                      'threshold': threshold, 'peak_time': reading[0], 'peak_lux': reading[1], 'quiet_count': 0}
+        self.ring = [None] * self.pre_samples
+        self.ring_index = 0
+        self.rising_count = 0
+
+    def update_event(self, reading, excess, threshold):
+        event = self.event
+        event['readings'].append(reading)
+        if reading[1] > event['peak_lux']:
+            event['peak_time'], event['peak_lux'] = reading[0], reading[1]
+
+        # The event ends when the light level has been back near the baseline for the post-trigger readings
+        if excess < event['threshold'] / 2:
+            event['quiet_count'] += 1
+        else:
+            event['quiet_count'] = 0
+        if event['quiet_count'] < self.post_samples and len(event['readings']) < MAX_EVENT_SAMPLES:
+            return None
+
+        self.event = None
+        event['peak_excess_lux'] = event['peak_lux'] - event['baseline']
+        del event['quiet_count']
+
+        # An event that hasn't returned to the baseline is a lasting change in the light level, e.g. dawn, car lights
+        # or cloud glow, so it is marked as truncated and the baseline restarts from the current level
+        event['truncated'] = excess >= event['threshold'] / 2
+        if event['truncated']:
+            self.baseline = reading[1]
+            self.warmup = WARMUP_SAMPLES
+
+        message = "Fireball candidate {0} peak {1:.6f} lux, {2:.6f} lux above baseline{3}".format(
+            event['peak_time'], event['peak_lux'], event['peak_excess_lux'],
+            ", truncated after {0:d} readings".format(len(event['readings'])) if event['truncated'] else "")
+        syslog.syslog(syslog.LOG_INFO, message)
+        if self.verbose:
+            print(message)
+
+        if self.write_files:
+            event['file_name'] = os.path.join(self.event_dir, "E" + self.name + event['trigger_time'].strftime("%Y%m%d_%H%M%S") + ".csv")
+            threading.Thread(target=self.write_event_file, args=(event['file_name'], event['readings'])).start()
+        return event
+
+    # Write the readings of an event in the same format as the data files
+    def write_event_file(self, file_name, readings):
+        try:
+            os.makedirs(os.path.dirname(file_name), exist_ok=True)
+            with open(file_name, 'w') as event_file:
+                for obs_time, lux_value, vis_level, ir_level, again, atime in readings:
+                    event_file.write(radiometer_binary.CSV_FORMAT.format(obs_time.strftime(
+                        "%Y/%m/%d %H:%M:%S.%f")[:-3], lux_value, vis_level, ir_level, again, atime))
+        except OSError as e:
+            print(e)
+
+
+# Main program. Replay recorded data files through the detector
+if __name__ == "__main__":
+    from radiometer_loader import load_file
+
+    # Construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser(description='Replay radiometer data files through the streaming fireball detector')
+    ap.add_argument("file", type=str, nargs='+',
+                    help="Data files to replay")
+    ap.add_argument("-o", "--outdir", type=str, default=None,
+                    help="Directory to write the event files to. Default is no event files")
+    ap.add_argument("-s", "--sigma", type=float, default=TRIGGER_SIGMA,
+                    help="Trigger level in standard deviations above the baseline. Default is " + str(TRIGGER_SIGMA))
+    ap.add_argument("-l", "--lux", type=float, default=MIN_TRIGGER_LUX,
+                    help="Minimum trigger level in lux above the baseline. Default is " + str(MIN_TRIGGER_LUX))
+
+    args = vars(ap.parse_args())
+
+    for file_name in args['file']:
+        detector = FireballDetector(event_dir=args['outdir'], trigger_sigma=args['sigma'], min_trigger_lux=args['lux'],
+                                    write_files=args['outdir'] is not None)
+        data, skipped = load_file(file_name)
+        obs_times = data['time'].view('datetime64[ns]').astype('datetime64[us]').astype(datetime.datetime)
+        events = []
+        for reading in zip(obs_times, data['lux'].tolist(), data['visible'].tolist(), data['ir'].tolist(),
+                           data['gain'].tolist(), data['atime'].tolist()):
+            event = detector.update(*reading)
+            if event:
+                events.append(event)
+
+        print(file_name, "readings:", len(obs_times), "events:", len(events))
+        for event in events:
+            print("  trigger", event['trigger_time'], "peak", event['peak_time'], np.around(event['peak_lux'], 6), "lux",
+                  "baseline", np.around(event['baseline'], 6), "readings", len(event['readings']),
+                  "truncated" if event['truncated'] else "", event.get('file_name', ''))
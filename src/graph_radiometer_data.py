@@ -1,22 +1,304 @@
 import argparse
-from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import glob
 import os
-import pandas as pd
+import re
 from matplotlib import pyplot as plt
-from scipy.signal import find_peaks
 import numpy as np
 
+import decimate
+import event_catalog
+from aggregates import LEVELS, LEVEL_NAMES, choose_level, day_base_name, day_extent, file_level, find_days, load_aggregates
+from radiometer_loader import DATA_FILE_PATTERN, find_data_files, load_data, parse_time
+from seeing import SEEING_MIN_LUX, chunked_seeing
+
 
 CAPTURE_DIR = os.path.expanduser('~/radiometer_data/')
 
 PEAK_DETECTION_LUX_LIMIT = 2.0
-SSSM_FACTOR = 1900   # Solar diameter is ~1900 arcsec 
 
 
 # Taken from https://github.com/adafruit/Adafruit_CircuitPython_TSL2591/blob/main/adafruit_tsl2591.py for cpl calculation
 ADAFRUIT_TSL2591_LUX_DF = 408.0
 
+# Width of the plots in inches
+FIGURE_WIDTH = 10
+
+# Figures of a day, and the suffixes of their saved files
+FIGURES = {'illuminance': '', 'sky_brightness': '_sky_brightness', 'seeing': '_seeing', 'raw': '_raw'}
+
+# Most readings that are plotted themselves, decimated to the pixel columns, rather than from their aggregates.
+# Two days of 10 Hz readings
+MAX_PLOT_READINGS = 2 * 864000
+
+# Coarsest aggregates that are kept indefinitely, used to find the days whose readings have been removed
+KEPT_LEVEL = '1m'
+
+
+# Show the current figure, or save it to its file and close it. The figure is saved directly, as plt.savefig draws
+# it again after saving it
+def finish_figure(save_files, figure):
+    if save_files is None:
+        plt.show()
+    else:
+        plt.gcf().savefig(save_files[figure])
+        plt.close()
+
+
+# Whether to draw a figure. When figures are saved, only the figures with file names are drawn
+def draw_figure(save_files, figure):
+    return save_files is None or figure in save_files
+
+
+# File name of a saved figure of a day e.g. R_SQM_20260204.csv.rcz -> R_SQM_20260204_sky_brightness.png
+def figure_file_name(file_name, figure):
+    return day_base_name(file_name) + FIGURES[figure] + '.png'
+
+
+# Level of the aggregates to plot the readings of the files between the start and end times from, or None to plot
+# the readings themselves. The readings are plotted, decimated to the pixel columns, unless there are more than
+# MAX_PLOT_READINGS of them, so a day is plotted from its readings. More readings are plotted from the aggregates
+# at the coarsest level that still has an interval for each pixel across the time from the first to the last
+# reading. Days whose readings have been removed are plotted from their aggregates, at their level or above. The
+# readings are needed for peak and seeing analysis
+def plot_level(file_names, start_time, end_time, readings_needed):
+    if readings_needed:
+        return None
+    extents = [extent for extent in (day_extent(file_name, start_time, end_time) for file_name in file_names) if extent]
+    file_levels = [file_level(file_name) for file_name in file_names if file_level(file_name)]
+    if not extents or (sum(extent[2] for extent in extents) <= MAX_PLOT_READINGS and not file_levels):
+        return None
+    span = max(extent[1] for extent in extents) - min(extent[0] for extent in extents)
+    level = choose_level(span, FIGURE_WIDTH * plt.rcParams['figure.dpi']) or '1s'
+    return max([level] + file_levels, key=LEVELS.get)
+
+
+# Find peaks in the lux readings that may match the light curve of a fireball
+def find_fireball_peaks(lux, prominence):
+    # scipy is slow to import, so it is only imported for peak detection
+    from scipy.signal import find_peaks
+    peaks, properties = find_peaks(lux.clip(upper=PEAK_DETECTION_LUX_LIMIT), prominence=prominence, width=(1, 60))
+    return peaks
+
+
+# Record the peaks found in the readings of the files in the event catalog
+def record_peaks(file_names, df, peaks, args):
+    if len(peaks) == 0 or args['no_catalog']:
+        return 0
+    return event_catalog.record_events(file_names, df.Times.to_numpy()[peaks].astype(np.int64), 'graph',
+                                       {'peak_lux': df.Lux.to_numpy()[peaks]}, args['catalog'])
+
+
+# Rolling average of the lux readings over 64 readings (~6 seconds)
+def rolling_average(lux):
+    return lux.rolling(64, center=True).sum()/64
+
+
+# Plot the minimum to maximum range and the mean of a column of the aggregates
+def plot_range(times, aggregates, column, label=None, values=None):
+    values = values or (lambda x: x)
+    line = plt.plot(times, values(aggregates[column + '_mean']), label=label)[0]
+    plt.fill_between(times, values(aggregates[column + '_min']), values(aggregates[column + '_max']),
+                     color=line.get_color(), alpha=0.3, linewidth=0)
+
+
+# Print the darkest mean sky brightness of the aggregates
+def print_darkest_aggregate(aggregates, level):
+    mean_lux = aggregates['lux_mean'].astype(np.float64)
+    if np.any(mean_lux > 0):
+        darkest = np.argmin(np.where(mean_lux > 0, mean_lux, np.inf))
+        print("Min", LEVEL_NAMES[level], "mean sky brightness:", (aggregates['time'][darkest] + LEVELS[level] // 2).astype('datetime64[ns]'),
+              np.log10(mean_lux[darkest]/108000)/-0.4, "mag/arcsec^2")
+
+
+# Plot the illuminance, sky brightness and raw sensor values from the aggregates of the readings. The figures are
+# shown, or saved to the files given for each figure
+def plot_aggregates(aggregates, level, night_range, linear_scale, save_files=None):
+    times = (aggregates['time'] + LEVELS[level] // 2).astype('datetime64[ns]')
+    title = ' (' + LEVEL_NAMES[level] + ' minimum, mean and maximum)'
+
+    if draw_figure(save_files, 'illuminance'):
+        plt.figure(figsize=(FIGURE_WIDTH, 6))
+        plot_range(times, aggregates, 'lux')
+        plt.xlabel('Time')
+        plt.ylabel('Lux')
+        if night_range:
+            plt.ylim(-0.1, 0.5)
+        elif not linear_scale:
+            plt.yscale("log")
+        plt.title('Illuminance' + title)
+        plt.grid()
+        finish_figure(save_files, 'illuminance')
+
+    # The brightest lux is the faintest sky brightness, so the range is the same band the other way up
+    if draw_figure(save_files, 'sky_brightness'):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            plot_range(times, aggregates, 'lux', "Sky Brightness", lambda lux: np.log10(lux.astype(np.float64)/108000)/-0.4)
+        plt.xlabel('Time')
+        plt.ylabel(r'Mag/$arcsec^2$ (mpsas)')
+        plt.title('Sky Brightness' + title)
+        plt.legend(loc='lower left')
+        finish_figure(save_files, 'sky_brightness')
+
+    if draw_figure(save_files, 'raw'):
+        plt.xlabel('Time')
+        plt.ylabel('Count')
+        if not linear_scale:
+            plt.yscale("log")
+        plot_range(times, aggregates, 'visible', "Visible and IR")
+        plot_range(times, aggregates, 'ir', "IR")
+        plt.title('Raw sensor values' + title)
+        plt.legend(loc='upper left')
+        finish_figure(save_files, 'raw')
+
+
+# Plot the illuminance, sky brightness, seeing and raw sensor values of the readings. The figures are shown, or
+# saved to the files given for each figure
+def plot_readings(df, peaks, night_range, linear_scale, display_seeing, raw, save_files=None):
+    times = df.Times
+
+    # Plot the lux data vs time
+    if draw_figure(save_files, 'illuminance'):
+        plt.figure(figsize=(FIGURE_WIDTH, 6))
+        decimate.plot(times, df.Lux, raw=raw)
+        plt.xlabel('Time')
+        plt.ylabel('Lux')
+        if night_range:
+            plt.ylim(-0.1, 0.5)
+        elif not linear_scale:
+            plt.yscale("log")
+
+        # Plot the detected peaks
+        if len(peaks) > 0:
+            plt.plot(times[peaks],
+                     df.Lux[peaks], marker="o", ls="", ms=3)
+
+        plt.title('Illuminance')
+        plt.grid()
+        finish_figure(save_files, 'illuminance')
+
+    # Display sky brightness and rolling average
+    if draw_figure(save_files, 'sky_brightness'):
+        sky_brightness = np.log10(df.Lux/108000)/-0.4
+        decimate.plot(times, sky_brightness, raw=raw, label="Sky Brightness")
+        decimate.plot(times, np.log10(rolling_average(df.Lux)/108000)/-0.4, raw=raw, label="Rolling average")
+        plt.xlabel('Time')
+        plt.ylabel(r'Mag/$arcsec^2$ (mpsas)')
+
+        plt.title('Sky Brightness')
+        plt.legend(loc='lower left')
+        finish_figure(save_files, 'sky_brightness')
+
+    # Plot the seeing
+    if display_seeing != 0 and draw_figure(save_files, 'seeing'):
+        # Split the data into chunks so we sample the RMS and the average over a period of 1 second
+        # Limit valid seeing readings to a lux value > 2000
+        valid_lux = np.flatnonzero(df.Lux.to_numpy() > SEEING_MIN_LUX)
+        seeings, chunk_ends = chunked_seeing(df.Lux.to_numpy()[valid_lux])
+        seeing_times = times.to_numpy()[valid_lux[chunk_ends]]
+
+        # Calcluate a rolling average over the required number of seconds
+        if len(seeings) < 10:
+            print("Not enough data to plot seeing graph")
+
+        try:
+            rolling_seeings = np.convolve(seeings, np.ones(display_seeing), 'same') / display_seeing
+
+            fig, ax1 = plt.subplots(figsize=(12,7))
+
+            # Plot the illuminance
+            color = 'tab:green'
+            decimate.plot(times, df.Lux, ax1, raw, color=color)
+            ax1.set_ylabel('Illuminance (lux)', color=color)
+            ax2 = ax1.twinx()
+
+            # Plot the seeing
+            color = 'lightblue'
+            decimate.plot(seeing_times, seeings, ax2, raw, color=color)
+
+            color = 'tab:red'
+            decimate.plot(seeing_times, rolling_seeings, ax2, raw, color=color)
+            ax2.set(xlabel='Time')
+            ax2.set_ylabel('Seeing (arcsec)', color=color)
+
+            plt.grid()
+            finish_figure(save_files, 'seeing')
+ 
+        except Exception as e:
+            print(e)
+  
+
+    # Plot the visible and IR data vs time
+    if draw_figure(save_files, 'raw'):
+        plt.xlabel('Time')
+        plt.ylabel('Count')
+        if not linear_scale:
+            plt.yscale("log")
+        decimate.plot(times, df.Visible, raw=raw, label="Visible and IR")
+        decimate.plot(times, df.IR, raw=raw, label="IR")
+        plt.title('Raw sensor values')
+        plt.legend(loc='upper left')
+        finish_figure(save_files, 'raw')
+
+
+# Files of the days to render in batch mode. File arguments may be data files, globs of data files or directories.
+# The days in the capture directory are used if no files are given. Days whose readings have been removed are
+# included from their aggregates, if the days are plotted from their aggregates
+def batch_files(file_args, sensor_name, start_time, end_time, level):
+    file_names = []
+    for file_arg in file_args or [CAPTURE_DIR]:
+        if os.path.isdir(file_arg):
+            if level is not None:
+                file_names += find_days(file_arg, level, sensor_name, start_time, end_time)
+            else:
+                file_names += find_data_files(file_arg, sensor_name, start_time, end_time)
+        else:
+            file_names += [file_name for file_name in sorted(glob.glob(file_arg))
+                           if re.search(DATA_FILE_PATTERN, os.path.basename(file_name))]
+    return file_names
+
+
+# Whether the saved graph of a day is newer than the day's data
+def graph_up_to_date(file_name):
+    graph_file_name = figure_file_name(file_name, 'illuminance')
+    return os.path.exists(graph_file_name) and os.path.getmtime(graph_file_name) >= os.path.getmtime(file_name)
+
+
+# Render and save the figures of a day file, in a batch worker process. Returns the files saved
+def render_day(file_name, args):
+    plt.switch_backend('Agg')
+    readings_needed = args['raw'] or args['prominence'] != 0 or args['seeing'] != 0
+    level = plot_level([file_name], None, None, readings_needed)
+    figures = ['illuminance', 'sky_brightness', 'raw'] + (['seeing'] if args['seeing'] != 0 else [])
+    save_files = {figure: figure_file_name(file_name, figure) for figure in figures}
+
+    if level is not None:
+        plot_aggregates(load_aggregates([file_name], level), level, args['night'], args['linear'], save_files)
+    else:
+        df = load_data([file_name], verbose=False)
+        peaks = find_fireball_peaks(df.Lux, args['prominence']) if args['prominence'] != 0 else []
+        record_peaks([file_name], df, peaks, args)
+        plot_readings(df, peaks, args['night'], args['linear'], args['seeing'], args['raw'], save_files)
+    return [save_file for save_file in save_files.values() if os.path.exists(save_file)]
+
+
+# Render the figures of the days on a pool of processes, skipping the days whose graphs are up to date
+def render_days(file_names, args):
+    if not args['force']:
+        file_names = [file_name for file_name in file_names if not graph_up_to_date(file_name)]
+    jobs = args['jobs'] or os.cpu_count()
+    print("Rendering", len(file_names), "days with", jobs, "processes")
+
+    plt.switch_backend('Agg')
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(render_day, file_name, args): file_name for file_name in file_names}
+        for future in as_completed(futures):
+            try:
+                print("Saved", ' '.join(future.result()))
+            except Exception as e:
+                print("Unable to render", futures[future], e)
+
+
 # Main program
 if __name__ == "__main__":
 
@@ -26,6 +308,12 @@ if __name__ == "__main__":
                     help="File or directory to analyse. Default is last 2 files in the directory " + CAPTURE_DIR)
     ap.add_argument("-n", "--night", action='store_true',
                     help="Display with night readings range")
+    ap.add_argument("--name", type=str, default=None,
+                    help="Name of the sensor to use when selecting files from the directory " + CAPTURE_DIR + ". Default is all sensors")
+    ap.add_argument("--start", type=str, default=None,
+                    help="Only use the data from this time onwards e.g. \"2023-01-31 00:01:15\"")
+    ap.add_argument("--end", type=str, default=None,
+                    help="Only use the data up to this time e.g. \"2023-01-31 00:01:45\"")
     ap.add_argument("-l", "--linear", action='store_true',
                     help="Display with linear scale")
     ap.add_argument("-s", "--save", action='store_true',
@@ -36,6 +324,20 @@ if __name__ == "__main__":
     #                 help="Display sky brightness")
     ap.add_argument("-p", "--prominence", type=float, default=0,
                     help="Peak detection prominence above background. Usually 0.005 lux. Default is no peak detection")
+    ap.add_argument("--raw", action='store_true',
+                    help="Plot every reading. Default is to plot the minimum and maximum readings of each pixel column, "
+                         "or the aggregates of the readings for more than two days of readings")
+    ap.add_argument("-b", "--batch", action='store_true',
+                    help="Save the graphs of every day of the files, globs or directories given, or of the days between the start "
+                         "and end times in " + CAPTURE_DIR + ", using a pool of processes. Days with up to date graphs are skipped")
+    ap.add_argument("-j", "--jobs", type=int, default=0,
+                    help="Number of processes for batch mode. Default is the number of CPUs")
+    ap.add_argument("-f", "--force", action='store_true',
+                    help="Render the graphs of every day in batch mode, even if they are up to date")
+    ap.add_argument("-c", "--catalog", type=str, default=event_catalog.CATALOG_FILE,
+                    help="Event catalog to record the detected peaks in. Default is " + event_catalog.CATALOG_FILE)
+    ap.add_argument("--no-catalog", action='store_true',
+                    help="Don't record the detected peaks in the event catalog")
 
     args = vars(ap.parse_args())
 
@@ -45,32 +347,57 @@ if __name__ == "__main__":
     linear_scale = args['linear']
     save_figure = args['save']
     display_seeing = args['seeing']
+    sensor_name = args['name']
+    raw = args['raw']
+    start_time = parse_time(args['start']) if args['start'] else None
+    end_time = parse_time(args['end']) if args['end'] else None
+    readings_needed = raw or prominence != 0 or display_seeing != 0
+
+    # Render whole days in batch
+    if args['batch']:
+        day_level = None if readings_needed else KEPT_LEVEL
+        render_days(batch_files(file_names, sensor_name, start_time, end_time, day_level), args)
+        exit(0)
 
-    # If no filenames were given, use the 2 newest files
+    # If no filenames were given, use the 2 newest files, or the days covering the start and end times, including
+    # the days whose readings have been removed but whose aggregates are kept
     if len(file_names) == 0:
-        file_names = sorted(glob.glob(CAPTURE_DIR + "R*.csv*"))[-2:]
+        if start_time is None and end_time is None:
+            file_names = find_data_files(CAPTURE_DIR, sensor_name)[-2:]
+        elif readings_needed:
+            file_names = find_data_files(CAPTURE_DIR, sensor_name, start_time, end_time)
+        else:
+            file_names = find_days(CAPTURE_DIR, KEPT_LEVEL, sensor_name, start_time, end_time)
+        if len(file_names) == 0:
+            print("No data files found in", CAPTURE_DIR)
+            exit(1)
+
+    # Only the illuminance graph is saved
+    save_files = {'illuminance': figure_file_name(file_names[-1], 'illuminance')} if save_figure else None
+
+    level = plot_level(file_names, start_time, end_time, readings_needed)
+    if level is not None:
+        print("Graphing the", LEVEL_NAMES[level], "aggregates of", file_names)
+        aggregates = load_aggregates(file_names, level, start_time, end_time)
+        print_darkest_aggregate(aggregates, level)
+        plot_aggregates(aggregates, level, night_range, linear_scale, save_files)
+        exit(0)
 
     print("Graphing", file_names)
 
     # Collect the data into a pandas dataframe
-    columns = ["Date", "Time", "Lux", "Visible", "IR", "Gain", "IntTime"]
-    dfs = [pd.read_csv(file_name, sep=' ', names=columns)
-           for file_name in file_names]
-    df = pd.concat(dfs, ignore_index=True)
+    df = load_data(file_names, start_time, end_time)
+    times = df.Times
 
     # Find peaks in the data that may match the light curve of a fireball
     peaks = []
     if prominence != 0:
-        peaks, properties = find_peaks(
-            df.Lux.clip(upper=PEAK_DETECTION_LUX_LIMIT), prominence=prominence, width=(1, 60))
+        peaks = find_fireball_peaks(df.Lux, prominence)
         print("Peaks found:", len(peaks))
         if (len(peaks) < 50):
             for peak in peaks:
-                print(df.Time[peak], df.Lux[peak])
-
-    # Format the times into datetime values
-    times = pd.to_datetime(df.Date + " " + df.Time,
-                           format="%Y/%m/%d %H:%M:%S.%f")
+                print(times[peak], df.Lux[peak])
+        record_peaks(file_names, df, peaks, args)
 
     print("Contents in csv file:")
     print(df)
@@ -81,10 +408,10 @@ if __name__ == "__main__":
     sky_brightness_measurements_sorted = sky_brightness_measurements.sort_values(
         by=['Lux'], ascending=False)
     for row in sky_brightness_measurements_sorted.itertuples():
-        print(row.Date, row.Time, "SQM:", np.log10((row.Lux)/108000)/-0.4)
+        print(row.Times, "SQM:", np.log10((row.Lux)/108000)/-0.4)
 
     # Calculate sky brightness and minimum rolling average over 64 readings (~6 seconds)
-    rolling = df.Lux.rolling(64, center=True).sum()/64
+    rolling = rolling_average(df.Lux)
     min_lux_index = np.argmin(df.Lux)
     min_rolling_index = np.argmin(rolling)
     print("Min sky brightness:", times[min_lux_index], np.log10(
@@ -92,111 +419,9 @@ if __name__ == "__main__":
     print("Min rolling average sky brightness:", times[min_rolling_index], np.log10(
         rolling[min_rolling_index]/108000)/-0.4, "mag/arcsec^2")
 
-    # Plot the lux data vs time
-    plt.figure(figsize=(10, 6))
-    plt.plot(times, df.Lux)
-    plt.xlabel('Time')
-    plt.ylabel('Lux')
-    if night_range:
-        plt.ylim(-0.1, 0.5)
-    elif not linear_scale:
-        plt.yscale("log")
-
-    # Plot the detected peaks
-    if len(peaks) > 0:
-        plt.plot(times[peaks],
-                 df.Lux[peaks], marker="o", ls="", ms=3)
-
-    plt.title('Illuminance')
-    plt.grid()
+    plot_readings(df, peaks, night_range, linear_scale, display_seeing, raw, save_files)
     if save_figure:
-        plt.savefig(os.path.splitext(file_names[-1])[0] + '.png')
         exit(0)
-    plt.show()
-
-    # Display sky brightness and rolling average
-    sky_brightness = np.log10(df.Lux/108000)/-0.4
-    plt.plot(times, sky_brightness, label="Sky Brightness")
-    plt.plot(times, np.log10(rolling/108000)/-0.4, label="Rolling average")
-    plt.xlabel('Time')
-    plt.ylabel(r'Mag/$arcsec^2$ (mpsas)')
-
-    plt.title('Sky Brightness')
-    plt.legend(loc='lower left')
-    plt.show()
-
-    # Plot the seeing
-    if display_seeing != 0 :
-        # Split the data into chunks so we sample the RMS and the average over a period of 1 second
-        chunk_size = 10
-        rolling_deque = deque(maxlen=chunk_size)
-        seeings = []
-        seeing_times = []
-
-        # Limit valid seeing readings to a lux value > 2000
-        rslt_df = df[df['Lux'] > 2000] 
-
-        for index, row in rslt_df.iterrows():
-            lux = row['Lux']
-            rolling_deque.append(lux)
-
-            # If the deque is full
-            if len(rolling_deque) == rolling_deque.maxlen:
-                rolling = np.array(rolling_deque)
-                average = np.average(rolling)
-                rms = np.sqrt(np.mean((rolling - average)**2))
-                average1 = np.average(rolling[0:4])
-                average2 = np.average(rolling[5:9])
-                seeing = SSSM_FACTOR * abs(rms / average)
-
-                seeings.append(seeing)
-                seeing_times.append(times[index])
-                # print(average1, average2, rms, seeing)
-                
-                # Clear the deque for the next set of readings
-                rolling_deque.clear()
-
-        # Calcluate a rolling average over the required number of seconds
-        if len(seeings) < 10:
-            print("Not enough data to plot seeing graph")
-
-        try:
-            rolling_seeings = np.convolve(seeings, np.ones(display_seeing), 'same') / display_seeing
-
-            fig, ax1 = plt.subplots(figsize=(12,7))
-
-            # Plot the illuminance
-            color = 'tab:green'
-            ax1.plot(times, df.Lux, color=color)
-            ax1.set_ylabel('Illuminance (lux)', color=color)
-            ax2 = ax1.twinx()
-
-            # Plot the seeing
-            color = 'lightblue'
-            ax2.plot(seeing_times, seeings, color=color)
-
-            color = 'tab:red'
-            ax2.plot(seeing_times, rolling_seeings, color=color)
-            ax2.set(xlabel='Time')
-            ax2.set_ylabel('Seeing (arcsec)', color=color)
-
-            plt.grid()
-            plt.show()
- 
-        except Exception as e:
-            print(e)
-  
-
-    # Plot the visible and IR data vs time
-    plt.xlabel('Time')
-    plt.ylabel('Count')
-    if not linear_scale:
-        plt.yscale("log")
-    plt.plot(times, df.Visible, label="Visible and IR")
-    plt.plot(times, df.IR, label="IR")
-    plt.title('Raw sensor values')
-    plt.legend(loc='upper left')
-    plt.show()
 
     # Calculate average measured integration times
     res = np.diff(times)[::2].astype(np.int32)
@@ -0,0 +1,100 @@
+import argparse
+import datetime
+import threading
+import numpy as np
+
+import radiometer_binary
+import sensor_backend
+
+HDR_NAME = "HDR"
+
+# A sensor's reading is used while its counts are below this fraction of the saturation counts.
+# A higher gain sensor is only switched back to once its counts are below the lower fraction
+NEAR_SATURATION = 0.8
+SWITCH_BACK = 0.5
+
+# Readings older than this many integration periods are out of date, e.g. the sensor is saturated or changing gain
+FRESH_PERIODS = 1.5
+
+
+# Class to fuse the readings of sensors at different gains into one high dynamic range stream of readings.
+# Each fused reading is the latest reading of the highest gain sensor that isn't close to saturation, so the
+# stream switches to a lower gain sensor before the higher gain sensor saturates, without a gap in the readings.
+# Readings can be added by the acquisition threads of each sensor
+class HdrFusion():
+
+    def __init__(self, output):
+        self.output = output
+        self.latest = {}
+        self.source = None
+        self.last_time = None
+        self.lock = threading.Lock()
+
+    # Add a sensor's reading. Outputs a fused reading if the sensor is the best source of the latest readings.
+    # The output is called while holding the lock, so the fused readings are written by one thread at a time and in order
+    def update(self, device_name, time_stamp, lux, vis_level, ir_level, again, atime):
+        with self.lock:
+            self.latest[device_name] = (time_stamp, lux, vis_level, ir_level, again, atime)
+            if self.select_source(time_stamp) != device_name:
+                return
+            if self.last_time is not None and time_stamp <= self.last_time:
+                return
+            self.last_time = time_stamp
+            self.output(time_stamp, lux, vis_level, ir_level, again, atime)
+
+    # Select the highest gain sensor with an up to date reading that isn't close to saturation.
+    # If all of the sensors are close to saturation, select the lowest gain sensor
+    def select_source(self, time_stamp):
+        candidates = []
+        for device_name, (reading_time, lux, vis_level, ir_level, again, atime) in self.latest.items():
+            if (time_stamp - reading_time).total_seconds() * 1000 > FRESH_PERIODS * atime:
+                continue
+            max_counts = sensor_backend.MAX_COUNT_100MS if atime <= 100 else sensor_backend.MAX_COUNT
+            limit = NEAR_SATURATION if device_name == self.source else SWITCH_BACK
+            candidates.append((max(vis_level, ir_level) < limit * max_counts, again * atime, device_name))
+
+        if candidates:
+            unsaturated = [candidate for candidate in candidates if candidate[0]]
+            self.source = max(unsaturated)[2] if unsaturated else min(candidates)[2]
+        return self.source
+
+
+# Main program. Fuse the data files of sensors at different gains
+if __name__ == "__main__":
+    from radiometer_loader import load_file
+
+    # Construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser(description='Fuse the readings of sensors at different gains into one high dynamic range data file')
+    ap.add_argument("file", type=str, nargs='+',
+                    help="Data files of each sensor for the same period e.g. R_GAIN_MAX_20260204.csv R_GAIN_MED_20260204.csv")
+    ap.add_argument("-o", "--output", type=str, required=True,
+                    help="Output csv data file")
+
+    args = vars(ap.parse_args())
+
+    # Merge the readings of all of the sensors in time order
+    readings = []
+    for sensor_index, file_name in enumerate(args['file']):
+        data, skipped = load_file(file_name)
+        readings.append((data['time'], np.full(len(data['time']), sensor_index), data))
+    times = np.concatenate([reading[0] for reading in readings])
+    sensors = np.concatenate([reading[1] for reading in readings])
+    rows = np.concatenate([np.arange(len(reading[0])) for reading in readings])
+    order = np.argsort(times, kind='stable')
+
+    with open(args['output'], 'w') as output_file:
+        def write_reading(time_stamp, lux, vis_level, ir_level, again, atime):
+            counts[fusion.source] += 1
+            output_file.write(radiometer_binary.CSV_FORMAT.format(time_stamp.strftime(
+                "%Y/%m/%d %H:%M:%S.%f")[:-3], lux, vis_level, ir_level, again, atime))
+
+        counts = [0] * len(args['file'])
+        fusion = HdrFusion(write_reading)
+        for sensor_index, row in zip(sensors[order].tolist(), rows[order].tolist()):
+            data = readings[sensor_index][2]
+            time_stamp = radiometer_binary.EPOCH + datetime.timedelta(microseconds=int(data['time'][row]) // 1000)
+            fusion.update(sensor_index, time_stamp, float(data['lux'][row]), int(data['visible'][row]), int(data['ir'][row]),
+                          float(data['gain'][row]), float(data['atime'][row]))
+
+    for file_name, count in zip(args['file'], counts):
+        print(file_name, "readings used:", count)
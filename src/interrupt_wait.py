@@ -0,0 +1,134 @@
+import argparse
+import random
+import threading
+import time
+
+# TSL2591 status register and its ALS interrupt (AINT) bit
+STATUS_REGISTER = 0x13
+STATUS_AINT = 0x10
+
+# Time to wait for an interrupt edge before falling back to polling the status register
+EDGE_TIMEOUT = 1.0
+
+
+# Wait strategy that polls the sensor's status register over i2c until the AINT bit is set
+class PollingWait():
+
+    def __init__(self):
+        self.status_reads = 0
+
+    def wait(self, sensor, initial_sleep, poll_interval):
+        time.sleep(initial_sleep)
+        # Get the status to check for the AINT interrupt being asserted
+        self.status_reads += 1
+        while sensor._read_u8(STATUS_REGISTER) & STATUS_AINT == 0:
+            time.sleep(poll_interval)
+            self.status_reads += 1
+
+        sensor.clear_interrupts()
+
+
+# Wait strategy that blocks until the edge source signals that the sensor's INT pin has been asserted.
+# There is no i2c traffic while waiting, and the wait ends as soon as the reading completes.
+# If no edge arrives, e.g. the INT pin isn't connected, the status register is polled instead
+class EdgeWait():
+
+    def __init__(self, edge_source, timeout=EDGE_TIMEOUT):
+        self.edge_source = edge_source
+        self.timeout = timeout
+        self.polling_wait = PollingWait()
+        self.timeouts = 0
+
+    def wait(self, sensor, initial_sleep, poll_interval):
+        if self.edge_source.wait_edge(self.timeout):
+            sensor.clear_interrupts()
+            return
+
+        self.timeouts += 1
+        self.polling_wait.wait(sensor, 0, poll_interval)
+
+
+# Edge source for the sensor's INT pin connected to a Raspberry Pi GPIO pin (BCM numbering).
+# The INT pin is active low and open drain, so the GPIO's pull up is enabled.
+# The INT pin stays low until the interrupt is cleared, so an edge that arrived before the wait isn't missed
+class GpioEdgeSource():
+
+    def __init__(self, pin):
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+        self.pin = pin
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+
+    def wait_edge(self, timeout):
+        if self.GPIO.input(self.pin) == self.GPIO.LOW:
+            return True
+        return self.GPIO.wait_for_edge(self.pin, self.GPIO.FALLING, timeout=int(timeout * 1000)) is not None
+
+
+# Edge source that asserts an interrupt at the end of each simulated reading, for testing without the hardware
+class SimulatedEdgeSource():
+
+    def __init__(self, sensor):
+        self.sensor = sensor
+
+    def wait_edge(self, timeout):
+        return self.sensor.interrupt_event.wait(timeout)
+
+
+# Simulated sensor with a status register and interrupt flag, for testing the wait strategies without the hardware.
+# A reading completes every period, with some jitter
+class SimulatedInterruptSensor():
+
+    def __init__(self, period=0.1, jitter=0.002):
+        self.period = period
+        self.jitter = jitter
+        self.status_reads = 0
+        self.clears = 0
+        self.reading_end_time = None
+        self.interrupt_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        next_time = time.monotonic() + self.period
+        while True:
+            time.sleep(max(next_time + random.uniform(0, self.jitter) - time.monotonic(), 0))
+            self.reading_end_time = time.monotonic()
+            self.interrupt_event.set()
+            next_time += self.period
+
+    def _read_u8(self, register):
+        self.status_reads += 1
+        return STATUS_AINT if self.interrupt_event.is_set() else 0
+
+    def clear_interrupts(self):
+        self.clears += 1
+        self.interrupt_event.clear()
+
+
+# Main program. Compare the wait strategies using the simulated sensor
+if __name__ == "__main__":
+
+    # Construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser(description='Compare the polling and interrupt edge wait strategies with a simulated sensor')
+    ap.add_argument("-r", "--readings", type=int, default=100,
+                    help="Number of readings to wait for with each strategy. Default is 100")
+
+    args = vars(ap.parse_args())
+    readings = args['readings']
+
+    for name in ["polling", "edge"]:
+        sensor = SimulatedInterruptSensor()
+        wait_strategy = PollingWait() if name == "polling" else EdgeWait(SimulatedEdgeSource(sensor))
+        sensor.interrupt_event.wait()
+        sensor.clear_interrupts()
+        delays = []
+        for i in range(readings):
+            wait_strategy.wait(sensor, 0.05, 0.005)
+            delays.append(time.monotonic() - sensor.reading_end_time)
+
+        delays.sort()
+        print("{0:8s} status reads per reading: {1:5.2f}  timestamp delay ms median: {2:6.2f}  max: {3:6.2f}".format(
+            name, sensor.status_reads / readings, 1000 * delays[len(delays) // 2], 1000 * delays[-1]))
+
@@ -1,12 +1,17 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import glob
 import os
+import warnings
 import pandas as pd
 from matplotlib import pyplot as plt
 from scipy.signal import find_peaks
 # from scipy.integrate import simpson
 import numpy as np
 
+import event_catalog
+from radiometer_loader import find_data_files, load_data, load_file, parse_time
+
 
 CAPTURE_DIR = os.path.expanduser('~/radiometer_data/')
 
@@ -32,6 +37,177 @@ GAIN_HIGH = 428
 # Minimum magnitude detectable with the sensor
 MIN_MAGNITUDE = -6.0
 
+# Default number of readings analysed around each peak, and the default meteor distance, incident angle,
+# extinction and velocity
+LIGHTCURVE_DEFAULTS = {'width': 40, 'distance': 50000, 'angle': 45, 'extinction': 0.0, 'velocity': 15000}
+
+# Length of the window of readings around a peak that is searched for its prominence, a minute either side at
+# 10 Hz. Without a window, the prominence of every local maximum in a day of noisy readings is searched for across
+# the whole day, which takes minutes
+PROMINENCE_WINDOW = 1201
+
+# Without a prominence, peaks are found that rise this many times the noise of the readings around them above the
+# background, and at least the minimum prominence in lux. The noise is found from the median absolute deviation,
+# scaled to a standard deviation
+AUTO_PROMINENCE_SIGMA = 10.0
+MIN_AUTO_PROMINENCE = 0.003
+MAD_TO_SIGMA = 1.4826
+
+# Number of readings around each peak whose median is the background the peak is measured from, 200s at 10 Hz
+BACKGROUND_WINDOW = 2000
+
+# Results of each event in the batch table
+EVENT_COLUMNS = ['time', 'peak_lux', 'median_lux', 'integrated_lux', 'energy', 'mass', 'peak_magnitude',
+                 'raw_energy', 'raw_mass', 'raw_peak_magnitude']
+EVENTS_FILE = 'lightcurve_events.csv'
+
+# Files that can be analysed in batch mode, so a glob of a data directory skips the index, aggregate and graph files
+DATA_FILE_EXTENSIONS = ('.csv', '.csv.gz', '.bin', '.rcz')
+
+
+# Area under each row of values against the times in seconds, by the trapezoidal rule
+def integrate(values, seconds):
+    return np.sum((values[:, 1:] + values[:, :-1]) * np.diff(seconds, axis=1), axis=1) / 2
+
+
+# Magnitudes of powers in Watts. No power is the minimum magnitude detectable with the sensor
+def power_magnitudes(powers):
+    magnitudes = -2.5*np.log10(powers/POWER_OF_MAG_ZERO_FIREBALL)
+    magnitudes[magnitudes == np.inf] = MIN_MAGNITUDE
+    return magnitudes
+
+
+# Noise of each reading. The noise of each block of PROMINENCE_WINDOW readings is the median absolute deviation of
+# the differences between its readings, so a change in the light level doesn't add to it, and the noise of a
+# reading is the largest of its block and the blocks either side, which cover the readings its prominence is
+# measured against
+def local_noise(lux):
+    differences = np.full(-(-len(lux) // PROMINENCE_WINDOW) * PROMINENCE_WINDOW, np.nan)
+    differences[1:len(lux)] = np.diff(lux)
+    differences = differences.reshape(-1, PROMINENCE_WINDOW)
+    with warnings.catch_warnings():
+        # A block of a single reading has no differences
+        warnings.simplefilter('ignore', RuntimeWarning)
+        deviations = np.abs(differences - np.nanmedian(differences, axis=1)[:, None])
+        noise = np.nan_to_num(np.nanmedian(deviations, axis=1)) * MAD_TO_SIGMA / np.sqrt(2)
+    noise = np.maximum(noise, np.maximum(np.concatenate(([0], noise[:-1])), np.concatenate((noise[1:], [0]))))
+    return np.repeat(noise, PROMINENCE_WINDOW)[:len(lux)]
+
+
+# Find the peaks in the lux readings. If no prominence is given, the peaks that stand out from the noise of the
+# readings around them are found, so a bright day doesn't hide the peaks of the night
+def find_lux_peaks(lux, prominence):
+    lux = np.asarray(lux, dtype=np.float64)
+    if prominence != 0.0:
+        peaks, properties = find_peaks(lux, prominence=prominence, wlen=PROMINENCE_WINDOW)  # , width=3)
+        return peaks
+    if len(lux) == 0:
+        return np.zeros(0, dtype=np.int64)
+    thresholds = np.maximum(AUTO_PROMINENCE_SIGMA * local_noise(lux), MIN_AUTO_PROMINENCE)
+    peaks, properties = find_peaks(lux, prominence=np.min(thresholds), wlen=PROMINENCE_WINDOW)
+    return peaks[properties['prominences'] >= thresholds[peaks]]
+
+
+# Background of each peak, the median of the BACKGROUND_WINDOW values around it
+def local_medians(values, peaks):
+    half = BACKGROUND_WINDOW // 2
+    return np.array([np.median(values[max(peak - half, 0):peak + half + 1]) for peak in peaks], dtype=np.float64)
+
+
+# Analyse the light curve of the readings around each peak. The data is the time in ns, lux, visible and gain
+# columns of the readings. The windows of readings around the peaks are the rows of an index array into the
+# columns, so every peak is analysed at once. A window that runs past the ends of the readings repeats the end
+# reading, which adds nothing to the integrals. Returns the results of each peak, and the light curve of each
+# peak as a row of each of the curve arrays
+def analyse_peaks(data, peaks, width, distance, angle, extinction, velocity):
+    peaks = np.asarray(peaks, dtype=np.int64)
+    windows = np.clip(peaks[:, None] + np.arange(-int(width/2), int(width/2)), 0, len(data['time']) - 1)
+    seconds = (data['time'][windows] - data['time'][windows[:, :1]]) / 1e9
+
+    # Calculate the area of the sphere at that distance
+    area = 4 * np.pi * np.square(distance)
+
+    # Adjust for the incident angle with the sensor and for atmospheric extinction
+    adjustment = np.power(2.5, extinction) / np.cos(np.deg2rad(angle))
+
+    # Calculate the power and magnitude over the light curve from the lux values above the median of the readings
+    # around the peak
+    lux = data['lux'].astype(np.float64)
+    median_lux = local_medians(lux, peaks)
+    median_adjusted_lux = np.maximum(lux[windows] - median_lux[:, None], 0)
+    powers = median_adjusted_lux * adjustment * area * LUMINOUS_EFFICACY
+    magnitudes = power_magnitudes(powers)
+    energies = integrate(powers, seconds)
+
+    # Calculate the power and magnitude using the raw channel 0 data which includes visble and IR.
+    # The RE_WHITE_CHANNEL0 measured in the datasheet is measured at high gain, so divide by the GAIN_HIGH factor
+    # Note: datasheet says the gain scaling for max gain is 9200/400
+    visible = data['visible'].astype(np.float64)
+    gain_scaling = data['gain'][windows].astype(np.float64)/GAIN_HIGH
+    watts_per_square_meter = (visible[windows] - local_medians(visible, peaks)[:, None]) / (RE_WHITE_CHANNEL0 * gain_scaling)
+    raw_powers = np.maximum(watts_per_square_meter * area, 0)
+    adjusted_raw_powers = raw_powers * adjustment
+    raw_magnitudes = power_magnitudes(adjusted_raw_powers)
+    raw_energies = integrate(adjusted_raw_powers, seconds)
+
+    events = {'time': data['time'][peaks], 'peak_lux': lux[peaks], 'median_lux': median_lux,
+              'integrated_lux': integrate(median_adjusted_lux, seconds),
+              'energy': energies, 'mass': 2 * energies / (TAU * np.square(velocity)), 'peak_magnitude': np.min(magnitudes, axis=1),
+              'raw_energy': raw_energies, 'raw_mass': 2 * raw_energies / (TAU * np.square(velocity)),
+              'raw_peak_magnitude': np.min(raw_magnitudes, axis=1)}
+    curves = {'seconds': seconds, 'magnitudes': magnitudes, 'raw_powers': raw_powers, 'raw_magnitudes': raw_magnitudes}
+    return events, curves
+
+
+# Analyse every peak in a file, in a batch worker process. Returns a table of the events
+def analyse_file(file_name, args, start_time, end_time):
+    np.seterr(divide='ignore')
+    data, skipped = load_file(file_name, start_time, end_time)
+    if len(data['time']) == 0:
+        return pd.DataFrame(columns=['file'] + EVENT_COLUMNS)
+    peaks = find_lux_peaks(data['lux'], args['prominence'])
+    events, curves = analyse_peaks(data, peaks, args['width'], args['distance'], args['angle'], args['extinction'], args['velocity'])
+    table = pd.DataFrame({column: events[column] for column in EVENT_COLUMNS})
+    table.insert(0, 'file', file_name)
+    return table
+
+
+# Files to analyse in batch mode. File arguments may be files, globs or directories of day files. The day files
+# in the capture directory covering the start and end times are used if no files are given
+def batch_files(file_args, sensor_name, start_time, end_time):
+    file_names = []
+    for file_arg in file_args or [CAPTURE_DIR]:
+        if os.path.isdir(file_arg):
+            file_names += find_data_files(file_arg, sensor_name, start_time, end_time)
+        else:
+            file_names += [file_name for file_name in sorted(glob.glob(file_arg)) if file_name.endswith(DATA_FILE_EXTENSIONS)]
+    return file_names
+
+
+# Analyse the files on a pool of processes. Returns a table of the events of all of the files, with the files
+# that were analysed in its attrs
+def analyse_files(file_names, args, start_time, end_time):
+    jobs = args['jobs'] or os.cpu_count()
+    print("Analysing", len(file_names), "files with", jobs, "processes")
+    tables = []
+    analysed = []
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(analyse_file, file_name, args, start_time, end_time): file_name for file_name in file_names}
+        for future in as_completed(futures):
+            try:
+                tables.append(future.result())
+                analysed.append(futures[future])
+                print(futures[future], "peaks:", len(tables[-1]))
+            except Exception as e:
+                print("Unable to analyse", futures[future], e)
+
+    events = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=['file'] + EVENT_COLUMNS)
+    events['time'] = events['time'].astype(np.int64).astype('datetime64[ns]')
+    events = events.sort_values(by=['time'], kind='stable')
+    events.attrs['analysed_files'] = analysed
+    return events
+
+
 # Main program
 if __name__ == "__main__":
 
@@ -39,20 +215,38 @@ if __name__ == "__main__":
     ap = argparse.ArgumentParser(
         description='Analyse a light curve from the radiometer data',
         epilog='Example usage: python lightcurve.py -p 0.01 -w 40 -d 120000 -a 50 -v 12000 20230131_0001.csv')
-    ap.add_argument("file", type=str, nargs='+',
-                    help="File to analyse")
+    ap.add_argument("file", type=str, nargs='*',
+                    help="File to analyse. If no file is given, the files in " + CAPTURE_DIR + " covering the start and end times are used")
     ap.add_argument("-p", "--prominence", type=float, default=0.0,
-                    help="Peak detection prominence above background. Default is auto")
-    ap.add_argument("-w", "--width", type=int, default=40,
+                    help="Peak detection prominence above background. Default is auto, which finds the peaks that rise 10 times the "
+                         "noise of the readings around them above the background")
+    ap.add_argument("-w", "--width", type=int, default=LIGHTCURVE_DEFAULTS['width'],
                     help="Number of points to analyse around the peak. Default is 40")
-    ap.add_argument("-d", "--distance", type=float, default=50000,
+    ap.add_argument("-d", "--distance", type=float, default=LIGHTCURVE_DEFAULTS['distance'],
                     help="Straight line distance to meteor in meters. Default is 50000 m")
-    ap.add_argument("-a", "--angle", type=float, default=45,
+    ap.add_argument("-a", "--angle", type=float, default=LIGHTCURVE_DEFAULTS['angle'],
                     help="Incident angle of meteor with sensor in degrees. Default is 45 degrees")
-    ap.add_argument("-e", "--extinction", type=float, default=0.0,
+    ap.add_argument("-e", "--extinction", type=float, default=LIGHTCURVE_DEFAULTS['extinction'],
                     help="Atmospheric extinction in magnitudes. Default is 0 magnitudes extinctions")
-    ap.add_argument("-v", "--velocity", type=float, default=15000,
+    ap.add_argument("-v", "--velocity", type=float, default=LIGHTCURVE_DEFAULTS['velocity'],
                     help="Velocity in m/s. Default is 15000 m/s")
+    ap.add_argument("--name", type=str, default=None,
+                    help="Name of the sensor to use when selecting files from the directory " + CAPTURE_DIR + ". Default is all sensors")
+    ap.add_argument("--start", type=str, default=None,
+                    help="Only use the data from this time onwards e.g. \"2023-01-31 00:01:15\"")
+    ap.add_argument("--end", type=str, default=None,
+                    help="Only use the data up to this time e.g. \"2023-01-31 00:01:45\"")
+    ap.add_argument("-b", "--batch", action='store_true',
+                    help="Analyse every peak of each of the files, globs or directories given, or of the day files in " + CAPTURE_DIR +
+                         " covering the start and end times, on a pool of processes, and write the results of each event to a table")
+    ap.add_argument("-j", "--jobs", type=int, default=0,
+                    help="Number of processes for batch mode. Default is the number of CPUs")
+    ap.add_argument("-o", "--output", type=str, default=EVENTS_FILE,
+                    help="Csv file of the batch mode results. Default is " + EVENTS_FILE)
+    ap.add_argument("-c", "--catalog", type=str, default=event_catalog.CATALOG_FILE,
+                    help="Event catalog to record the results of each peak in. Default is " + event_catalog.CATALOG_FILE)
+    ap.add_argument("--no-catalog", action='store_true',
+                    help="Don't record the results in the event catalog")
 
     args = vars(ap.parse_args())
 
@@ -63,8 +257,15 @@ if __name__ == "__main__":
     angle = args['angle']
     extinction = args['extinction']
     velocity = args['velocity']
+    sensor_name = args['name']
+    start_time = parse_time(args['start']) if args['start'] else None
+    end_time = parse_time(args['end']) if args['end'] else None
+
+    if len(file_names) == 0 and not args['batch']:
+        if start_time is None or end_time is None:
+            ap.error("Either a file or the start and end times are required")
+        file_names = find_data_files(CAPTURE_DIR, sensor_name, start_time, end_time)
 
-    print("Graphing", file_names)
     print("Initial parameters.\nDistance (m):", distance,
           "\nAngle (degrees):", angle, "\nAtmospheric Extinction", extinction, "\nVelocity (m/s):", velocity)
     print()
@@ -72,67 +273,50 @@ if __name__ == "__main__":
     # Ignore div by zero warnings
     np.seterr(divide='ignore')
 
-    # Collect the data into a pandas dataframe
-    columns = ["Date", "Time", "Lux", "Visible", "IR", "Gain", "IntTime"]
-    dfs = [pd.read_csv(file_name, sep=' ', names=columns)
-           for file_name in file_names]
-    df = pd.concat(dfs, ignore_index=True)
+    if args['batch']:
+        events = analyse_files(batch_files(file_names, sensor_name, start_time, end_time), args, start_time, end_time)
+        events.to_csv(args['output'], index=False)
+        print("Wrote", len(events), "events to", args['output'])
+        if not args['no_catalog']:
+            print("Recorded", event_catalog.record_lightcurve_table(events, 'lightcurve', args['catalog']), "events in", args['catalog'])
+        exit(0)
 
-    # Format the times into datetime values
-    times = pd.to_datetime(df.Date + " " + df.Time,
-                           format="%Y/%m/%d %H:%M:%S.%f")
+    print("Graphing", file_names)
+
+    # Collect the data into a pandas dataframe
+    df = load_data(file_names, start_time, end_time)
+    times = df.Times
 
     # Find peaks in the data. If no prominence is given, calculate one
-    if prominence == 0.0:
-        prominence = np.max(df.Lux) - np.median(df.Lux) - np.std(df.Lux)
-    peaks = []
-    peaks, properties = find_peaks(
-        df.Lux, prominence=prominence)  # , width=3)
+    peaks = find_lux_peaks(df.Lux, prominence)
     print("Peaks found:", len(peaks))
 
     if len(peaks) == 0:
         exit(-1)
 
-    for peak in peaks:
-        print(df.Time[peak], df.Lux[peak])
-
-    # Calculate area under the peak
-    # print(peaks, properties)
-    median_adjusted_lux = df.Lux[peak -
-                                 (int(width/2)):peak+(int(width/2))]-np.median(df.Lux)
-    median_adjusted_lux[median_adjusted_lux < 0] = 0
-    times_over_peaks = times[peak - (int(width/2)):peak+(int(width/2))]
-    times_over_peaks = times_over_peaks - times[peak - (int(width/2))]
-    np_times_over_peaks = times_over_peaks.to_numpy(dtype=float)/1e9
+    # Analyse the light curve of every peak
+    data = {'time': times.to_numpy().astype(np.int64), 'lux': df.Lux.to_numpy(), 'visible': df.Visible.to_numpy(),
+            'gain': df.Gain.astype(float).to_numpy()}
+    events, curves = analyse_peaks(data, peaks, width, distance, angle, extinction, velocity)
+    if not args['no_catalog']:
+        event_catalog.record_events(file_names, events['time'], 'lightcurve',
+                                    {column: events[key] for column, key in event_catalog.LIGHTCURVE_COLUMNS.items()}, args['catalog'],
+                                    event_catalog.LOCAL_BACKGROUND)
 
-    print("Median", np.median(df.Lux), "Peak",
-          df.Lux[peak], "STD", np.std(df.Lux))
-    integrated_lux = np.trapz(median_adjusted_lux, x=np_times_over_peaks)
-    # , simpson(adjusted_peaks))
-    print("Area under peak:", integrated_lux, "Lux.s\n")
-
-    # Calculate the area of the sphere at that distance
-    area = 4 * np.pi * np.square(distance)
-
-    # Adjust the lux values for incident angle with the sensor
-    angle_adjusted_lux = median_adjusted_lux / np.cos(np.deg2rad(angle))
-
-    # Adjust the lux values for atmospheric extinction
-    extinction_adjusted_lux = angle_adjusted_lux * np.power(2.5, extinction)
-
-    # Calculate the power and magnitude over the light curve
-    powers = extinction_adjusted_lux * area * LUMINOUS_EFFICACY
-    powers[powers < 0] = 0
-    magnitudes = -2.5*np.log10(powers/POWER_OF_MAG_ZERO_FIREBALL)
-    magnitudes[magnitudes == np.inf] = MIN_MAGNITUDE
-
-    integrated_power = np.trapz(powers, x=np_times_over_peaks)
-    mass = 2 * integrated_power / (TAU * np.square(velocity))
-
-    print("Estimated energy:", np.around(integrated_power, 2), "J")
-    print("Estimated mass:", np.around(mass, 2), "kg")
-    print("Peak magnitude", np.around(np.min(magnitudes), 2))
+    print("Median", np.median(df.Lux), "STD", np.std(df.Lux))
     print()
+    for event in range(len(peaks)):
+        print(times[peaks[event]], "Peak", events['peak_lux'][event])
+        print("Background (median of the readings around the peak):", events['median_lux'][event], "Lux")
+        print("Area under peak:", events['integrated_lux'][event], "Lux.s")
+        print("Estimated energy:", np.around(events['energy'][event], 2), "J")
+        print("Estimated mass:", np.around(events['mass'][event], 2), "kg")
+        print("Peak magnitude", np.around(events['peak_magnitude'][event], 2))
+        print("Estimated energy from raw sensor data",
+              '{:.2E}'.format(events['raw_energy'][event]), "J")
+        print("Estimated mass from raw sensor data", np.around(events['raw_mass'][event], 2), "kg")
+        print("Peak magnitude from raw sensor data", np.around(events['raw_peak_magnitude'][event], 2))
+        print()
 
     # Plot the lux data vs time
     plt.plot(times, df.Lux)
@@ -148,11 +332,13 @@ if __name__ == "__main__":
     plt.title('Illuminance')
     plt.show()
 
-    # Plot the magnitudes
-    plt.plot(times_over_peaks, magnitudes)
-    plt.xlabel('Time')
+    # Plot the magnitudes of each peak
+    for event in range(len(peaks)):
+        plt.plot(curves['seconds'][event], curves['magnitudes'][event], label=str(times[peaks[event]]))
+    plt.xlabel('Time from start of light curve (s)')
     plt.ylabel('Abs Magnitude')
     plt.gca().invert_yaxis()
+    plt.legend(loc='upper left')
     plt.show()
 
     # Plot the visible and IR data vs time
@@ -164,60 +350,22 @@ if __name__ == "__main__":
     plt.legend(loc='upper left')
     plt.show()
 
-    # Calculate energy and mass using the raw channel 0 data which includes visble and IR
-    visible_data = df.Visible
-    visible_data = visible_data - np.median(visible_data)
-
-    # Restrict the data to values either side of the peak
-    visible_data = visible_data[peak - (int(width/2)):peak+(int(width/2))]
-    times_of_visible_data = times[peak - (int(width/2)):peak+(int(width/2))]
-    gains_of_visible_data = df.Gain[peak - (int(width/2)):peak+(int(width/2))]
-
-    # Calculate the gain scaling
-    # The RE_WHITE_CHANNEL0 measured in the datasheet is measured at high gain, so divide by the GAIN_HIGH factor
-    # Note: datasheet says the gain scaling for max gain is 9200/400
-    gain_scaling = gains_of_visible_data/GAIN_HIGH
-
-    # Get watts/m2.
-    watts_per_square_meter = visible_data / (RE_WHITE_CHANNEL0 * gain_scaling)
-    powers = watts_per_square_meter * area
-
-    # Remove any powers that may be negative
-    powers[powers < 0] = 0
-
-    # Adjust the powers for the incident angle of the light with the sensor
-    angle_adjusted_powers = powers / np.cos(np.deg2rad(angle))
-
-    # Adjust the powers for atmospheric extinction
-    extinction_adjusted_powers = angle_adjusted_powers * np.power(2.5, extinction)
-
-    # Integrate the power over time to get the energy under the light curve
-    integrated_power = np.trapz(extinction_adjusted_powers, x=np_times_over_peaks)
-
-    mass = 2 * integrated_power / (TAU * np.square(velocity))
-    print("Estimated energy from raw sensor data",
-          '{:.2E}'.format(integrated_power), "J")
-    print("Estimated mass from raw sensor data", np.around(mass, 2), "kg")
-
-    magnitudes_raw = -2.5*np.log10(extinction_adjusted_powers /
-                               POWER_OF_MAG_ZERO_FIREBALL)
-
-    magnitudes_raw[magnitudes_raw == np.inf] = MIN_MAGNITUDE
-
-    print("Peak magnitude", np.around(np.min(magnitudes_raw), 2))
-
     # Plot power graph
-    plt.plot(times_of_visible_data, powers, marker='.')
+    for event in range(len(peaks)):
+        plt.plot(curves['seconds'][event], curves['raw_powers'][event], marker='.', label=str(times[peaks[event]]))
     plt.title("Power from Raw Visible Sensor Data")
-    plt.xlabel('Time')
+    plt.xlabel('Time from start of light curve (s)')
     plt.ylabel('Power (Watts)')
+    plt.legend(loc='upper left')
     plt.show()
 
     # Plot graph of magnitudes
-    plt.plot(times_of_visible_data, magnitudes, label="Lux Data", marker='.')
-    plt.plot(times_of_visible_data, magnitudes_raw, label="Raw Visible Sensor Data", marker='.')
+    for event in range(len(peaks)):
+        line = plt.plot(curves['seconds'][event], curves['magnitudes'][event], label="Lux Data " + str(times[peaks[event]]), marker='.')[0]
+        plt.plot(curves['seconds'][event], curves['raw_magnitudes'][event], label="Raw Visible Sensor Data " + str(times[peaks[event]]),
+                 marker='.', ls='--', color=line.get_color())
     plt.title("Magnitudes")
-    plt.xlabel('Time')
+    plt.xlabel('Time from start of light curve (s)')
     plt.ylabel('Abs Magnitude')
     plt.gca().invert_yaxis()
     plt.legend(loc='upper left')
@@ -0,0 +1,157 @@
+import argparse
+import datetime
+import json
+import os
+import struct
+import numpy as np
+
+# Binary radiometer data files hold a fixed size text header followed by fixed width records
+# which can be loaded directly with numpy.fromfile or numpy.memmap, e.g.
+#   records = np.memmap(file_name, dtype=RECORD_DTYPE, mode='r', offset=HEADER_SIZE)
+BINARY_MAGIC = b'RADBIN01'
+HEADER_SIZE = 512
+BINARY_EXTENSION = '.bin'
+
+# Record layout. Timestamps are nanoseconds since 1970-01-01 00:00:00 using the same local wall clock
+# time as the csv files, so that csv and binary files convert to each other without any time zone shifts
+RECORD_FIELDS = [('time', '<i8'), ('lux', '<f4'), ('visible', '<u2'), ('ir', '<u2'), ('gain', 'u1'), ('atime', 'u1')]
+RECORD_DTYPE = np.dtype(RECORD_FIELDS)
+RECORD_STRUCT = struct.Struct('<qfHHBB')
+
+# Gain and integration time codes follow the TSL2591 register settings
+GAIN_TABLE = [1.0, 25.0, 428.0, 9876.0]
+ATIME_TABLE = [100.0, 200.0, 300.0, 400.0, 500.0, 600.0]
+GAIN_CODES = {gain: code for code, gain in enumerate(GAIN_TABLE)}
+ATIME_CODES = {atime: code for code, atime in enumerate(ATIME_TABLE)}
+UNKNOWN_CODE = 255
+
+EPOCH = datetime.datetime(1970, 1, 1)
+CSV_FORMAT = '{0:s} {1:.9f} {2:d} {3:d} {4:.1f} {5:.1f}\n'
+
+
+# Build the self describing header for a binary data file
+def make_header(name=""):
+    description = {'format': 'radiometer', 'version': 1, 'name': name[:64],
+                   'header_size': HEADER_SIZE, 'record_size': RECORD_DTYPE.itemsize,
+                   'fields': RECORD_FIELDS, 'time': 'ns since 1970-01-01 local time',
+                   'gain_table': GAIN_TABLE, 'atime_table': ATIME_TABLE}
+    header = BINARY_MAGIC + json.dumps(description).encode()
+    if len(header) >= HEADER_SIZE:
+        raise ValueError("Binary header too long")
+    return header.ljust(HEADER_SIZE - 1, b' ') + b'\n'
+
+
+# Read and check the header of a binary data file
+def read_header(binary_file):
+    header = binary_file.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE or not header.startswith(BINARY_MAGIC):
+        raise ValueError("Not a radiometer binary data file")
+    description = json.loads(header[len(BINARY_MAGIC):].decode())
+    description['dtype'] = np.dtype([tuple(field) for field in description['fields']])
+    return description
+
+
+def is_binary_file(file_name):
+    with open(file_name, 'rb') as binary_file:
+        return binary_file.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+# Open a binary data file for appending records, writing the header if the file is new
+def open_binary_file(file_name, name=""):
+    binary_file = open(file_name, 'ab')
+    size = binary_file.tell()
+    if size < HEADER_SIZE:
+        binary_file.truncate(0)
+        binary_file.write(make_header(name))
+    else:
+        # Drop any partial record left at the end of the file by a power loss
+        partial = (size - HEADER_SIZE) % RECORD_DTYPE.itemsize
+        if partial:
+            binary_file.truncate(size - partial)
+    return binary_file
+
+
+def datetime_to_ns(obs_time):
+    return (obs_time - EPOCH) // datetime.timedelta(microseconds=1) * 1000
+
+
+# Pack a single reading into a binary record
+def pack_record(obs_time, lux_value, vis_level, ir_level, again, atime):
+    return RECORD_STRUCT.pack(datetime_to_ns(obs_time), lux_value, vis_level, ir_level,
+                              GAIN_CODES.get(again, UNKNOWN_CODE), ATIME_CODES.get(atime, UNKNOWN_CODE))
+
+
+# Return the records in a binary data file as a read only memory mapped numpy array
+def read_binary(file_name):
+    with open(file_name, 'rb') as binary_file:
+        description = read_header(binary_file)
+    dtype = description['dtype']
+    count = (os.path.getsize(file_name) - description['header_size']) // dtype.itemsize
+    if count <= 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(file_name, dtype=dtype, mode='r', offset=description['header_size'], shape=(count,))
+
+
+# Decode the gain and integration time codes of binary records into the csv values
+def decode_gain(codes):
+    return np.append(GAIN_TABLE, np.nan)[np.minimum(codes, len(GAIN_TABLE))]
+
+
+def decode_atime(codes):
+    return np.append(ATIME_TABLE, np.nan)[np.minimum(codes, len(ATIME_TABLE))]
+
+
+# Convert a space separated csv data file to a binary data file
+def csv_to_binary(csv_file_name, binary_file_name, name=""):
+    count = 0
+    with open(csv_file_name) as csv_file, open(binary_file_name, 'wb') as binary_file:
+        binary_file.write(make_header(name))
+        for line in csv_file:
+            fields = line.split()
+            if len(fields) != 7:
+                continue
+            try:
+                obs_time = datetime.datetime.strptime(fields[0] + " " + fields[1], "%Y/%m/%d %H:%M:%S.%f")
+                binary_file.write(pack_record(obs_time, float(fields[2]), int(fields[3]), int(fields[4]),
+                                              float(fields[5]), float(fields[6])))
+                count += 1
+            except (ValueError, struct.error):
+                continue
+    return count
+
+
+# Convert a binary data file to a space separated csv data file
+def binary_to_csv(binary_file_name, csv_file_name):
+    records = read_binary(binary_file_name)
+    time_strings = np.datetime_as_string(records['time'].astype('datetime64[ns]'), unit='ms')
+    gains = decode_gain(records['gain'])
+    atimes = decode_atime(records['atime'])
+    with open(csv_file_name, 'w') as csv_file:
+        for time_string, lux, vis, ir, gain, atime in zip(time_strings, records['lux'].tolist(), records['visible'].tolist(),
+                                                          records['ir'].tolist(), gains.tolist(), atimes.tolist()):
+            csv_file.write(CSV_FORMAT.format(time_string.replace('-', '/').replace('T', ' '), lux, vis, ir, gain, atime))
+    return len(records)
+
+
+# Main program
+if __name__ == "__main__":
+
+    # Construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser(description='Convert radiometer data files between the csv and binary formats')
+    ap.add_argument("file", type=str, nargs='+',
+                    help="Files to convert. Binary files are converted to csv, csv files are converted to binary")
+    ap.add_argument("-o", "--outdir", type=str, default=None,
+                    help="Output directory. Default is the directory of each input file")
+
+    args = vars(ap.parse_args())
+
+    for file_name in args['file']:
+        out_dir = args['outdir'] if args['outdir'] else os.path.dirname(file_name)
+        base_name = os.path.splitext(os.path.basename(file_name))[0]
+        if is_binary_file(file_name):
+            out_file_name = os.path.join(out_dir, base_name + '.csv')
+            count = binary_to_csv(file_name, out_file_name)
+        else:
+            out_file_name = os.path.join(out_dir, base_name + BINARY_EXTENSION)
+            count = csv_to_binary(file_name, out_file_name)
+        print("Converted", file_name, "to", out_file_name, count, "records")
@@ -0,0 +1,245 @@
+import argparse
+import json
+import os
+import struct
+import time
+import zlib
+import numpy as np
+
+import radiometer_binary
+import radiometer_index
+import radiometer_loader
+
+# Compressed radiometer data files hold the columns of a day file in independently compressed chunks, so a file
+# can be read a chunk at a time and the chunks outside a time range are skipped without decompressing them.
+# The file is the magic, a length prefixed JSON description, then the chunks. Each chunk has a header of the
+# row count, the payload length and the first and last times, and a zlib payload of the encoded columns:
+#   time      int64 ns, delta from the previous row
+#   lux       float64, as parsed from the csv text so that the csv lines can be recreated exactly
+#   visible   int32, delta from the previous row
+#   ir        int32, delta from the previous row
+#   gain      float32
+#   atime     float32
+# The bytes of each column are shuffled (all of the first bytes, then all of the second bytes...) before
+# compression. The deltas of 10 Hz readings are mostly the same few small numbers, so the shuffled high bytes are
+# long runs of zeros or 0xff that zlib compresses to almost nothing
+COMPRESSED_MAGIC = b'RADCMP01'
+COMPRESSED_EXTENSION = radiometer_loader.COMPRESSED_EXTENSION
+DESCRIPTION_LENGTH = struct.Struct('<I')
+CHUNK_HEADER = struct.Struct('<IIqq')
+CHUNK_COLUMNS = [('time', np.int64, True), ('lux', np.float64, False), ('visible', np.int32, True),
+                 ('ir', np.int32, True), ('gain', np.float32, False), ('atime', np.float32, False)]
+
+# Rows per chunk, about 27 minutes of 10 Hz readings
+CHUNK_ROWS = 16384
+COMPRESSION_LEVEL = 9
+
+# Bytes of csv text parsed at a time while compressing, so a day file is never held in memory
+READ_BYTES = 1 << 20
+
+
+def compressed_file_name(file_name):
+    return file_name + COMPRESSED_EXTENSION
+
+
+def shuffle(values):
+    return np.ascontiguousarray(values.view(np.uint8).reshape(len(values), values.itemsize).T).tobytes()
+
+
+def unshuffle(payload, offset, rows, dtype):
+    size = rows * np.dtype(dtype).itemsize
+    planes = np.frombuffer(payload, dtype=np.uint8, count=size, offset=offset).reshape(np.dtype(dtype).itemsize, rows)
+    return np.ascontiguousarray(planes.T).view(dtype).ravel(), offset + size
+
+
+# Encode and compress a chunk of columns
+def encode_chunk(data):
+    encoded = []
+    for column, dtype, delta in CHUNK_COLUMNS:
+        values = data[column].astype(dtype)
+        if delta:
+            values = np.diff(values, prepend=dtype(0))
+        encoded.append(shuffle(values))
+    payload = zlib.compress(b''.join(encoded), COMPRESSION_LEVEL)
+    return CHUNK_HEADER.pack(len(data['time']), len(payload), int(data['time'].min()), int(data['time'].max())) + payload
+
+
+# Decompress and decode the payload of a chunk. The columns have the same types as a loaded csv file, apart from
+# the lux values which are float64 unless a lux type is given
+def decode_chunk(payload, rows, lux_dtype=np.float64):
+    payload = zlib.decompress(payload)
+    data = {}
+    offset = 0
+    for column, dtype, delta in CHUNK_COLUMNS:
+        values, offset = unshuffle(payload, offset, rows, dtype)
+        data[column] = np.cumsum(values, dtype=dtype) if delta else values
+    data['lux'] = data['lux'].astype(lux_dtype)
+    data['visible'] = data['visible'].astype(np.uint16)
+    data['ir'] = data['ir'].astype(np.uint16)
+    return data
+
+
+# Build the JSON description at the start of a compressed file
+def make_description(name=""):
+    description = {'format': 'radiometer compressed', 'version': 1, 'name': name[:64], 'codec': 'zlib',
+                   'chunk_header': CHUNK_HEADER.format, 'time': 'ns since 1970-01-01 local time',
+                   'columns': [(column, np.dtype(dtype).str, 'delta' if delta else 'value')
+                               for column, dtype, delta in CHUNK_COLUMNS]}
+    description = json.dumps(description).encode()
+    return COMPRESSED_MAGIC + DESCRIPTION_LENGTH.pack(len(description)) + description
+
+
+def is_compressed_file(file_name):
+    with open(file_name, 'rb') as compressed_file:
+        return compressed_file.read(len(COMPRESSED_MAGIC)) == COMPRESSED_MAGIC
+
+
+# Read the chunks of a compressed file one at a time, skipping the chunks outside the start and end times in ns
+def iterate_chunks(file_name, start=None, end=None, lux_dtype=np.float64):
+    with open(file_name, 'rb') as compressed_file:
+        if compressed_file.read(len(COMPRESSED_MAGIC)) != COMPRESSED_MAGIC:
+            raise ValueError("Not a radiometer compressed data file")
+        description_length = DESCRIPTION_LENGTH.unpack(compressed_file.read(DESCRIPTION_LENGTH.size))[0]
+        compressed_file.seek(description_length, os.SEEK_CUR)
+        while True:
+            header = compressed_file.read(CHUNK_HEADER.size)
+            if len(header) < CHUNK_HEADER.size:
+                return
+            rows, payload_length, first_time, last_time = CHUNK_HEADER.unpack(header)
+            if (start is not None and last_time < start) or (end is not None and first_time > end):
+                compressed_file.seek(payload_length, os.SEEK_CUR)
+                continue
+            payload = compressed_file.read(payload_length)
+            if len(payload) < payload_length:
+                raise ValueError("Truncated chunk in " + file_name)
+            yield radiometer_loader.select_time_range(decode_chunk(payload, rows, lux_dtype), start, end)
+
+
+# Read the chunk headers of a compressed file. Returns the byte offset of each chunk's header and the chunk's
+# first and last times in ns
+def chunk_offsets(file_name):
+    offsets, first_times, last_times = [], [], []
+    with open(file_name, 'rb') as compressed_file:
+        if compressed_file.read(len(COMPRESSED_MAGIC)) != COMPRESSED_MAGIC:
+            raise ValueError("Not a radiometer compressed data file")
+        description_length = DESCRIPTION_LENGTH.unpack(compressed_file.read(DESCRIPTION_LENGTH.size))[0]
+        offset = compressed_file.seek(description_length, os.SEEK_CUR)
+        while True:
+            header = compressed_file.read(CHUNK_HEADER.size)
+            if len(header) < CHUNK_HEADER.size:
+                break
+            rows, payload_length, first_time, last_time = CHUNK_HEADER.unpack(header)
+            offsets.append(offset)
+            first_times.append(first_time)
+            last_times.append(last_time)
+            offset = compressed_file.seek(payload_length, os.SEEK_CUR)
+    return np.array(offsets, dtype=np.int64), np.array(first_times, dtype=np.int64), np.array(last_times, dtype=np.int64)
+
+
+# Load a compressed data file into the same columns as a csv file
+def load_compressed_file(file_name, start=None, end=None, lux_dtype=np.float32):
+    return radiometer_loader.concatenate(list(iterate_chunks(file_name, start, end, lux_dtype))), 0
+
+
+# Regroup the blocks read from a data file into chunks of CHUNK_ROWS rows. Yields the chunks and the lines skipped
+def iterate_row_chunks(file_name):
+    pending = []
+    pending_rows = 0
+    for data, skipped in radiometer_loader.iterate_file(file_name, np.float64, READ_BYTES):
+        pending.append(data)
+        pending_rows += len(data['time'])
+        if pending_rows >= CHUNK_ROWS:
+            data = radiometer_loader.concatenate(pending)
+            full_rows = pending_rows - pending_rows % CHUNK_ROWS
+            for first in range(0, full_rows, CHUNK_ROWS):
+                yield {key: values[first:first + CHUNK_ROWS] for key, values in data.items()}, skipped
+                skipped = 0
+            pending = [{key: values[full_rows:] for key, values in data.items()}]
+            pending_rows -= full_rows
+        elif skipped:
+            yield None, skipped
+    if pending_rows:
+        yield radiometer_loader.concatenate(pending), 0
+
+
+# Compress a csv or binary data file. The compressed file is written beside it under a temporary name, checked,
+# and then renamed, so a power loss never leaves a partial compressed file. The data file and its index are
+# only removed once the compressed file is complete. Returns the compressed file name, the rows written and
+# the incomplete or corrupt lines skipped
+def compress_file(file_name, name="", pause=0.0, remove=True):
+    out_file_name = compressed_file_name(file_name)
+    temp_file_name = out_file_name + '.tmp'
+    rows = skipped = 0
+    with open(temp_file_name, 'wb') as out_file:
+        out_file.write(make_description(name))
+        for chunk, chunk_skipped in iterate_row_chunks(file_name):
+            skipped += chunk_skipped
+            if chunk is None:
+                continue
+            out_file.write(encode_chunk(chunk))
+            rows += len(chunk['time'])
+            if pause:
+                time.sleep(pause)
+        out_file.flush()
+        os.fsync(out_file.fileno())
+
+    # Check the compressed file before replacing the data file with it
+    if sum(len(data['time']) for data in iterate_chunks(temp_file_name)) != rows:
+        os.remove(temp_file_name)
+        raise ValueError("Compressed file check failed for " + file_name)
+
+    # Keep the time of the data file, so that old files are still removed after the number of days to keep
+    mtime = os.path.getmtime(file_name)
+    os.replace(temp_file_name, out_file_name)
+    os.utime(out_file_name, (mtime, mtime))
+    if remove:
+        os.remove(file_name)
+        try:
+            os.remove(radiometer_index.index_file_name(file_name))
+        except FileNotFoundError:
+            pass
+    return out_file_name, rows, skipped
+
+
+# Recreate the csv text of a compressed file
+def decompress_to_csv(file_name, csv_file_name):
+    rows = 0
+    with open(csv_file_name, 'w') as csv_file:
+        for data in iterate_chunks(file_name):
+            time_strings = np.datetime_as_string(data['time'].astype('datetime64[ns]'), unit='ms')
+            for time_string, lux, vis, ir, gain, atime in zip(time_strings, data['lux'].tolist(), data['visible'].tolist(),
+                                                              data['ir'].tolist(), data['gain'].tolist(), data['atime'].tolist()):
+                csv_file.write(radiometer_binary.CSV_FORMAT.format(time_string.replace('-', '/').replace('T', ' '),
+                                                                   lux, vis, ir, gain, atime))
+            rows += len(data['time'])
+    return rows
+
+
+# Main program
+if __name__ == "__main__":
+
+    # Construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser(description='Compress radiometer data files, or decompress them to csv')
+    ap.add_argument("file", type=str, nargs='+',
+                    help="Files to compress, or compressed files to decompress")
+    ap.add_argument("-d", "--decompress", action='store_true',
+                    help="Decompress " + COMPRESSED_EXTENSION + " files to csv files")
+    ap.add_argument("-k", "--keep", action='store_true',
+                    help="Keep the data files after compressing them")
+
+    args = vars(ap.parse_args())
+
+    for file_name in args['file']:
+        if args['decompress']:
+            base_name = file_name[:-len(COMPRESSED_EXTENSION)] if file_name.endswith(COMPRESSED_EXTENSION) else file_name
+            csv_file_name = os.path.splitext(base_name)[0] + '.csv'
+            if os.path.exists(csv_file_name):
+                print("Not decompressing", file_name, "as", csv_file_name, "already exists")
+                continue
+            rows = decompress_to_csv(file_name, csv_file_name)
+            print("Decompressed", file_name, "to", csv_file_name, rows, "rows")
+        else:
+            out_file_name, rows, skipped = compress_file(file_name, remove=not args['keep'])
+            print("Compressed", file_name, "to", out_file_name, rows, "rows", os.path.getsize(out_file_name), "bytes")
+            if skipped:
+                print("Skipped", skipped, "incomplete lines in", file_name)
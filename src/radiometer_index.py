@@ -0,0 +1,91 @@
+import os
+import numpy as np
+
+import radiometer_binary
+
+# A sidecar index file beside each csv data file maps the start of each minute to the byte offset of the first line
+# logged in that minute, so that a time window can be read from a day file with one seek.
+# The index file is a sequence of little endian int64 (time in ns, byte offset) pairs.
+# Every line before an entry's offset is earlier than the entry's time, so a sparse index is still correct.
+INDEX_EXTENSION = '.idx'
+INDEX_DTYPE = np.dtype([('time', '<i8'), ('offset', '<i8')])
+INDEX_INTERVAL_NS = 60 * 1000000000
+
+
+def index_file_name(data_file_name):
+    return data_file_name + INDEX_EXTENSION
+
+
+# Read the index entries for a data file. Returns an empty array if there is no index
+def read_index(data_file_name):
+    try:
+        entries = np.fromfile(index_file_name(data_file_name), dtype=INDEX_DTYPE)
+    except (FileNotFoundError, ValueError):
+        return np.zeros(0, dtype=INDEX_DTYPE)
+    return entries
+
+
+def make_entries(times, offsets):
+    entries = np.zeros(len(times), dtype=INDEX_DTYPE)
+    entries['time'] = times
+    entries['offset'] = offsets
+    return entries
+
+
+# Append entries to the index of a data file
+def append_index(data_file_name, times, offsets):
+    entries = make_entries(times, offsets)
+    with open(index_file_name(data_file_name), 'ab') as index_file:
+        index_file.write(entries.tobytes())
+
+
+# Replace the index of a data file
+def write_index(data_file_name, times, offsets):
+    temp_file_name = index_file_name(data_file_name) + '.tmp'
+    entries = make_entries(times, offsets)
+    entries.tofile(temp_file_name)
+    os.replace(temp_file_name, index_file_name(data_file_name))
+
+
+# Get the byte range of a data file that holds all of the lines between the start and end times
+def byte_range(entries, start=None, end=None):
+    start_offset = 0
+    end_offset = None
+    if start is not None and len(entries):
+        entry = np.searchsorted(entries['time'], start, side='right') - 1
+        if entry >= 0:
+            start_offset = int(entries['offset'][entry])
+    if end is not None and len(entries):
+        entry = np.searchsorted(entries['time'], end, side='right')
+        if entry < len(entries):
+            end_offset = int(entries['offset'][entry])
+    return start_offset, end_offset
+
+
+# Class to build the index of a csv data file as the data is logged
+class IndexWriter():
+
+    def __init__(self, data_file_name):
+        self.data_file_name = data_file_name
+        self.offset = os.path.getsize(data_file_name) if os.path.exists(data_file_name) else 0
+        self.minute = None
+
+        # Carry on from the last entry when appending to an existing file
+        entries = read_index(data_file_name)
+        self.last_indexed = int(entries['time'][-1]) if len(entries) else None
+
+    # Record a line of the given length logged at the given time. Each day file only holds one day's
+    # readings, so the minute of the day identifies the index entry
+    def add(self, obs_time, length):
+        minute = obs_time.hour * 60 + obs_time.minute
+        if minute != self.minute:
+            self.minute = minute
+            minute_ns = radiometer_binary.datetime_to_ns(obs_time.replace(second=0, microsecond=0))
+            if self.last_indexed is None or minute_ns > self.last_indexed:
+                # The index file is reopened for each entry as the analysis tools may rebuild it
+                try:
+                    append_index(self.data_file_name, [minute_ns], [self.offset])
+                    self.last_indexed = minute_ns
+                except OSError:
+                    pass
+        self.offset += length
@@ -0,0 +1,391 @@
+import glob
+import gzip
+import mmap
+import os
+import re
+import numpy as np
+
+import radiometer_binary
+import radiometer_index
+
+# Columns of the space separated radiometer data files
+COLUMNS = ["Date", "Time", "Lux", "Visible", "IR", "Gain", "IntTime"]
+
+# Number of lines parsed together. Limits the size of the temporary arrays
+BLOCK_LINES = 65536
+
+# Bytes of text decompressed and parsed at a time from a gzipped csv file
+STREAM_BYTES = 8 << 20
+
+# Each line is "YYYY/MM/DD HH:MM:SS.fff lux visible ir gain inttime" with the date and time at fixed positions
+TIMESTAMP_LENGTH = 23
+SPACES_PER_LINE = 6
+MAX_FIELD_DIGITS = 18
+DIGIT_OFFSETS = np.array([0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18, 20, 21, 22])
+SEPARATOR_OFFSETS = np.array([4, 7, 10, 13, 16, 19])
+SEPARATORS = np.array([ord(c) for c in '// ::.'], dtype=np.uint8)
+
+NS_PER_DAY = 86400 * 1000000000
+
+# Data files are named R<_name_>YYYYMMDD with a csv, gzipped csv or binary extension, and compressed
+# day files have the .rcz extension added (see radiometer_compress)
+DATA_FILE_PATTERN = r'(\d{8})\.(csv|csv\.gz|bin|csv\.rcz|bin\.rcz)$'
+COMPRESSED_EXTENSION = '.rcz'
+
+POWERS_OF_10 = 10 ** np.arange(MAX_FIELD_DIGITS + 1, dtype=np.int64)
+
+NEWLINE = ord('\n')
+SPACE = ord(' ')
+DOT = ord('.')
+MINUS = ord('-')
+ZERO = ord('0')
+
+
+# Parse the fixed position date and time of each line into int64 nanoseconds
+def parse_timestamps(buf, starts):
+    digits = buf[starts[:, None] + DIGIT_OFFSETS].astype(np.int32) - ZERO
+    valid = np.all((digits >= 0) & (digits <= 9), axis=1) & \
+        np.all(buf[starts[:, None] + SEPARATOR_OFFSETS] == SEPARATORS, axis=1)
+    digits[~valid] = 0
+
+    year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    month = digits[:, 4] * 10 + digits[:, 5]
+    day = digits[:, 6] * 10 + digits[:, 7]
+    valid &= (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31)
+    month = np.clip(month, 1, 12)
+    day = np.clip(day, 1, 31)
+
+    days = ((year - 1970).astype('datetime64[Y]').astype('datetime64[M]') + (month - 1)).astype('datetime64[D]') + (day - 1)
+    ms = ((digits[:, 8] * 10 + digits[:, 9]) * 3600 + (digits[:, 10] * 10 + digits[:, 11]) * 60 +
+          digits[:, 12] * 10 + digits[:, 13]) * 1000 + digits[:, 14] * 100 + digits[:, 15] * 10 + digits[:, 16]
+
+    return days.astype(np.int64) * 86400000000000 + ms.astype(np.int64) * 1000000, valid
+
+
+# Parse decimal number fields given by their start and end offsets in the buffer. The digits are accumulated
+# column by column into an integer before a single division so that the values match float()
+def parse_numbers(buf, starts, ends):
+    negative = buf[starts] == MINUS
+    starts = starts + negative
+    lengths = ends - starts
+    width = int(lengths.max()) if len(lengths) else 0
+
+    mantissa = np.zeros(len(starts), dtype=np.int64)
+    digit_count = np.zeros(len(starts), dtype=np.int64)
+    fraction_digits = np.zeros(len(starts), dtype=np.int64)
+    seen_dot = np.zeros(len(starts), dtype=bool)
+    valid = (lengths > 0) & (lengths <= MAX_FIELD_DIGITS + 1)
+
+    for column in range(min(width, MAX_FIELD_DIGITS + 1)):
+        in_field = column < lengths
+        chars = buf[np.minimum(starts + column, len(buf) - 1)]
+        is_dot = in_field & (chars == DOT)
+        is_digit = in_field & (chars >= ZERO) & (chars <= ZERO + 9)
+        valid &= ~in_field | is_digit | (is_dot & ~seen_dot)
+        seen_dot |= is_dot
+        np.multiply(mantissa, 10, out=mantissa, where=is_digit)
+        np.add(mantissa, chars - ZERO, out=mantissa, where=is_digit, casting='unsafe')
+        digit_count += is_digit
+        fraction_digits += is_digit & seen_dot
+
+    valid &= (digit_count > 0) & (digit_count <= MAX_FIELD_DIGITS)
+    values = mantissa / POWERS_OF_10[np.minimum(fraction_digits, MAX_FIELD_DIGITS)].astype(np.float64)
+    values[negative] = -values[negative]
+    return values, valid
+
+
+# Parse a block of complete lines given by their start and end (newline) offsets
+def parse_lines(buf, starts, ends, lux_dtype=np.float32):
+    # Each valid line has exactly 6 spaces, the first two at fixed positions
+    spaces = np.flatnonzero(buf[starts[0]:ends[-1]] == SPACE) + starts[0]
+    first_space = np.searchsorted(spaces, starts)
+    valid = ((np.searchsorted(spaces, ends) - first_space) == SPACES_PER_LINE) & \
+        (ends - starts > TIMESTAMP_LENGTH + 2 * (SPACES_PER_LINE - 1))
+    starts, ends, first_space = starts[valid], ends[valid], first_space[valid]
+
+    line_spaces = spaces[first_space[:, None] + np.arange(SPACES_PER_LINE)]
+    fixed = (line_spaces[:, 0] == starts + 10) & (line_spaces[:, 1] == starts + TIMESTAMP_LENGTH)
+
+    times, times_valid = parse_timestamps(buf, starts)
+
+    # Parse the 5 number fields separately so that each is only as wide as its longest value
+    field_ends = np.column_stack((line_spaces[:, 2:], ends))
+    values = []
+    ok = fixed & times_valid
+    for field in range(5):
+        field_values, field_valid = parse_numbers(buf, line_spaces[:, field + 1] + 1, field_ends[:, field])
+        values.append(field_values)
+        ok &= field_valid
+    ok &= (values[1] >= 0) & (values[1] <= 65535) & (values[2] >= 0) & (values[2] <= 65535)
+
+    data = {'time': times[ok], 'lux': values[0][ok].astype(lux_dtype),
+            'visible': values[1][ok].astype(np.uint16), 'ir': values[2][ok].astype(np.uint16),
+            'gain': values[3][ok].astype(np.float32), 'atime': values[4][ok].astype(np.float32)}
+    return data, len(valid) - np.count_nonzero(ok)
+
+
+# Parse a buffer of csv text, returning the columns and the number of incomplete or corrupt lines skipped.
+# The lux values can be kept as float64 to keep all of the digits of the csv text
+def parse_buffer(buf, lux_dtype=np.float32):
+    newlines = np.flatnonzero(buf == NEWLINE)
+    starts = np.concatenate(([0], newlines[:-1] + 1)) if len(newlines) else np.zeros(0, dtype=np.int64)
+
+    # A truncated last line without a newline is left by a power loss or a file still being written
+    skipped = 1 if len(buf) and (not len(newlines) or newlines[-1] < len(buf) - 1) else 0
+
+    blocks = []
+    for block in range(0, len(newlines), BLOCK_LINES):
+        data, bad = parse_lines(buf, starts[block:block + BLOCK_LINES], newlines[block:block + BLOCK_LINES], lux_dtype)
+        blocks.append(data)
+        skipped += bad
+
+    # Blank lines are not counted as skipped
+    skipped -= np.count_nonzero(newlines - starts == 0)
+    return concatenate(blocks) if blocks else empty_data(lux_dtype), skipped
+
+
+def empty_data(lux_dtype=np.float32):
+    return {'time': np.zeros(0, dtype=np.int64), 'lux': np.zeros(0, dtype=lux_dtype),
+            'visible': np.zeros(0, dtype=np.uint16), 'ir': np.zeros(0, dtype=np.uint16),
+            'gain': np.zeros(0, dtype=np.float32), 'atime': np.zeros(0, dtype=np.float32)}
+
+
+def concatenate(blocks):
+    if not blocks:
+        return empty_data()
+    return {key: np.concatenate([block[key] for block in blocks]) for key in blocks[0]}
+
+
+# Select the rows of the loaded columns between the start and end times
+def select_time_range(data, start=None, end=None):
+    if start is None and end is None:
+        return data
+    mask = np.ones(len(data['time']), dtype=bool)
+    if start is not None:
+        mask &= data['time'] >= start
+    if end is not None:
+        mask &= data['time'] <= end
+    return {key: values[mask] for key, values in data.items()}
+
+
+# Find the index entries for the csv lines in a buffer from the given offset. An entry is made for the first line
+# of each minute that is later than all of the lines before it
+def index_entries(buf, offset=0, after=None):
+    newlines = np.flatnonzero(buf[offset:] == NEWLINE) + offset
+    starts = np.concatenate(([offset], newlines[:-1] + 1)) if len(newlines) else np.zeros(0, dtype=np.int64)
+    starts = starts[newlines - starts > TIMESTAMP_LENGTH]
+    times, valid = parse_timestamps(buf, starts)
+    starts = starts[valid]
+    minutes = times[valid] - times[valid] % radiometer_index.INDEX_INTERVAL_NS
+    if not len(minutes):
+        return minutes, starts
+
+    previous = np.maximum.accumulate(minutes)
+    previous = np.concatenate(([np.iinfo(np.int64).min if after is None else after], previous[:-1]))
+    new_minute = minutes > previous
+    return minutes[new_minute], starts[new_minute]
+
+
+# Bring the index of a csv data file up to date, rebuilding it if it is missing or doesn't start at the
+# beginning of the file, and otherwise scanning only the lines after the last entry. The index is only used,
+# not saved, unless save is set
+def update_index(file_name, buf, save=True):
+    entries = radiometer_index.read_index(file_name)
+    if not len(entries) or entries['offset'][0] > 0:
+        times, offsets = index_entries(buf)
+        entries = entries[:0]
+        save_index = radiometer_index.write_index
+    else:
+        times, offsets = index_entries(buf, int(entries['offset'][-1]), int(entries['time'][-1]))
+        save_index = radiometer_index.append_index
+
+    if len(times) and save:
+        try:
+            save_index(file_name, times, offsets)
+        except OSError:
+            # The data directory may be read only, so use the index without saving it
+            pass
+    if len(times):
+        entries = np.concatenate((entries, radiometer_index.make_entries(times, offsets)))
+    return entries
+
+
+# Parse csv text read from a file object a block of bytes at a time, so only one block of text is in memory.
+# Yields the columns and the number of incomplete or corrupt lines skipped for each block
+def iterate_text_blocks(data_file, block_bytes=STREAM_BYTES, lux_dtype=np.float32):
+    remainder = b''
+    while True:
+        text = data_file.read(block_bytes)
+        if not text:
+            break
+        text = remainder + text
+        end = text.rfind(b'\n') + 1
+        remainder = text[end:]
+        if end:
+            yield parse_buffer(np.frombuffer(text, dtype=np.uint8, count=end), lux_dtype)
+    if remainder:
+        yield parse_buffer(np.frombuffer(remainder, dtype=np.uint8), lux_dtype)
+
+
+# Convert binary records into the same columns as a csv file
+def binary_columns(records, lux_dtype=np.float32):
+    return {'time': np.array(records['time']), 'lux': np.array(records['lux'], dtype=lux_dtype),
+            'visible': np.array(records['visible']), 'ir': np.array(records['ir']),
+            'gain': radiometer_binary.decode_gain(records['gain']).astype(np.float32),
+            'atime': radiometer_binary.decode_atime(records['atime']).astype(np.float32)}
+
+
+# Read a csv, gzipped csv, binary or compressed data file a block at a time, so the whole file is never held in
+# memory. Yields the columns and the number of incomplete or corrupt lines skipped for each block
+def iterate_file(file_name, lux_dtype=np.float32, block_bytes=STREAM_BYTES):
+    if file_name.endswith('.gz'):
+        with gzip.open(file_name, 'rb') as data_file:
+            yield from iterate_text_blocks(data_file, block_bytes, lux_dtype)
+    elif file_name.endswith(COMPRESSED_EXTENSION):
+        import radiometer_compress
+        for data in radiometer_compress.iterate_chunks(file_name, lux_dtype=lux_dtype):
+            yield data, 0
+    elif radiometer_binary.is_binary_file(file_name):
+        records = radiometer_binary.read_binary(file_name)
+        for first in range(0, len(records), BLOCK_LINES):
+            yield binary_columns(records[first:first + BLOCK_LINES], lux_dtype), 0
+    else:
+        with open(file_name, 'rb') as data_file:
+            yield from iterate_text_blocks(data_file, block_bytes, lux_dtype)
+
+
+# Load a binary data file into the same columns as a csv file. The records are in time order
+# so the start and end times are found with a binary search of the memory mapped file
+def load_binary_file(file_name, start=None, end=None, lux_dtype=np.float32):
+    records = radiometer_binary.read_binary(file_name)
+    first = np.searchsorted(records['time'], start, side='left') if start is not None else 0
+    last = np.searchsorted(records['time'], end, side='right') if end is not None else len(records)
+    return binary_columns(records[first:last], lux_dtype), 0
+
+
+# Parse the lines of a memory mapped csv file. If a time range is given, only the part of
+# the file found from the index is parsed
+def parse_mapped(file_name, buf, start=None, end=None, lux_dtype=np.float32):
+    if start is None and end is None:
+        return parse_buffer(buf, lux_dtype)
+    start_offset, end_offset = radiometer_index.byte_range(update_index(file_name, buf), start, end)
+    data, skipped = parse_buffer(buf[start_offset:end_offset], lux_dtype)
+    return select_time_range(data, start, end), skipped
+
+
+# Load a csv, gzipped csv, binary or compressed data file into numpy columns, optionally only between the start and
+# end times in ns. Gzipped and compressed files are decompressed a block at a time, keeping only the selected rows.
+# The lux is float32 unless another lux dtype is given
+def load_file(file_name, start=None, end=None, lux_dtype=np.float32):
+    if file_name.endswith('.gz'):
+        blocks = []
+        skipped = 0
+        for data, block_skipped in iterate_file(file_name, lux_dtype):
+            blocks.append(select_time_range(data, start, end))
+            skipped += block_skipped
+        return concatenate(blocks), skipped
+
+    if file_name.endswith(COMPRESSED_EXTENSION):
+        import radiometer_compress
+        return radiometer_compress.load_compressed_file(file_name, start, end, lux_dtype)
+
+    if radiometer_binary.is_binary_file(file_name):
+        return load_binary_file(file_name, start, end, lux_dtype)
+
+    with open(file_name, 'rb') as data_file:
+        try:
+            mapped = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be memory mapped
+            return empty_data(lux_dtype), 0
+        try:
+            return parse_mapped(file_name, np.frombuffer(mapped, dtype=np.uint8), start, end, lux_dtype)
+        finally:
+            try:
+                mapped.close()
+            except BufferError:
+                pass
+
+
+# Index entries of a csv data file, brought up to date with the lines logged since the index was last written.
+# The entries are saved to the index file unless save is False
+def file_index(file_name, save=True):
+    with open(file_name, 'rb') as data_file:
+        try:
+            mapped = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return radiometer_index.make_entries([], [])
+        try:
+            return update_index(file_name, np.frombuffer(mapped, dtype=np.uint8), save)
+        finally:
+            try:
+                mapped.close()
+            except BufferError:
+                pass
+
+
+# Number of lines of a csv data file between the start and end times in ns, counted in the byte range found from the
+# index without parsing them, so the lines of the minutes at each end of the range are included. Returns the count
+# and the index entries. The index is saved beside the file unless save is False
+def count_lines(file_name, start=None, end=None, save=True):
+    with open(file_name, 'rb') as data_file:
+        try:
+            mapped = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return 0, radiometer_index.make_entries([], [])
+        try:
+            buf = np.frombuffer(mapped, dtype=np.uint8)
+            entries = update_index(file_name, buf, save)
+            start_offset, end_offset = radiometer_index.byte_range(entries, start, end)
+            return int(np.count_nonzero(buf[start_offset:end_offset] == NEWLINE)), entries
+        finally:
+            try:
+                mapped.close()
+            except BufferError:
+                pass
+
+
+# Convert a time string such as "2023-01-31 00:01:15" or "2023/01/31T00:01:15.5" to ns
+def parse_time(time_string):
+    return int(np.datetime64(time_string.strip().replace('/', '-').replace(' ', 'T'), 'ns').astype(np.int64))
+
+
+# Find the data files in a directory for a sensor name (or all sensors if no name is given),
+# optionally only for the days overlapping the start and end times. Other files of each day, such as the
+# aggregates, can be found with a pattern of the date and extension
+def find_data_files(directory, name=None, start=None, end=None, file_pattern=DATA_FILE_PATTERN):
+    prefix = re.escape("R" + ("_" + name + "_" if name else "")) if name is not None else r'R(?:_.*_)?'
+    pattern = re.compile(prefix + file_pattern)
+    file_names = []
+    for file_name in glob.glob(os.path.join(directory, "R*")):
+        match = pattern.match(os.path.basename(file_name))
+        if not match:
+            continue
+        day = parse_time(match.group(1)[0:4] + '-' + match.group(1)[4:6] + '-' + match.group(1)[6:8])
+        if (end is not None and day > end) or (start is not None and day + NS_PER_DAY <= start):
+            continue
+        file_names.append(file_name)
+
+    # A day file is only removed once its compressed file is complete, so skip a day file that has both
+    compressed = set(file_names)
+    return sorted(file_name for file_name in file_names if file_name + COMPRESSED_EXTENSION not in compressed)
+
+
+# Convert the loaded columns to a dataframe with datetime times and categorical gain and integration times
+def to_dataframe(data):
+    # pandas is only needed by the analysis tools, so the acquisition scripts can parse data files without it
+    import pandas as pd
+    return pd.DataFrame({'Times': data['time'].astype('datetime64[ns]'), 'Lux': data['lux'],
+                         'Visible': data['visible'], 'IR': data['ir'],
+                         'Gain': pd.Categorical(data['gain']), 'IntTime': pd.Categorical(data['atime'])})
+
+
+# Load the data files into one dataframe, optionally only between the start and end times in ns
+def load_data(file_names, start=None, end=None, verbose=True):
+    blocks = []
+    for file_name in file_names:
+        data, skipped = load_file(file_name, start, end)
+        if skipped and verbose:
+            print("Skipped", skipped, "incomplete lines in", file_name)
+        blocks.append(data)
+    return to_dataframe(concatenate(blocks))
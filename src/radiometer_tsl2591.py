@@ -7,31 +7,58 @@ import threading
 import time
 import numpy as np
 import syslog
-import glob
 try:
     from flask import Flask, jsonify
 except:
     pass
 
-import board
-from adafruit_extended_bus import ExtendedI2C as I2C
-import adafruit_tsl2591
-
-DATA_DIR = os.path.expanduser('~/radiometer_data/')
-SECS_IN_3_HOURS = 3 * 60 * 60
+from data_logger import RadiometerDataLogger
+import sensor_backend
+from fireball_detector import FireballDetector
+from hdr_fusion import HdrFusion, HDR_NAME
+from auto_range import AutoRanger
+from reading_history import ReadingHistory, add_history_routes, run_server
+from shared_readings import SharedReadingsPublisher
 
 # Minimum time to wait after a sensor time or gain setting
 GUARD_TIME = 0.12
 
 # The tsl2591 default i2c address is 0x29
-DEFAULT_I2C_ADDRESS = adafruit_tsl2591._TSL2591_ADDR
+DEFAULT_I2C_ADDRESS = sensor_backend.DEFAULT_I2C_ADDRESS
+
+# TSL2591 gain for each gain name. Auto gain starts at maximum gain
+GAIN_SETTINGS = {"max": sensor_backend.GAIN_MAX, "high": sensor_backend.GAIN_HIGH, "med": sensor_backend.GAIN_MED,
+                 "low": sensor_backend.GAIN_LOW, "auto": sensor_backend.GAIN_MAX}
+
+
+radiometer_data_loggers = []
+shared_readings_publishers = []
 
 
 def signalHandler(signum, frame):
-    # Handle process signals
+    # Handle process signals. Write out the queued readings and remove the shared memory before exiting
+    for radiometer_data_logger in radiometer_data_loggers:
+        radiometer_data_logger.close()
+    for shared_readings_publisher in shared_readings_publishers:
+        shared_readings_publisher.close()
     os._exit(0)
 
 
+# Parse a sensor specification "bus:address:multiplexer:gain:name", with an optional ":int_pin".
+# Empty fields take the default values e.g. "3::::GAIN_MED" or "1:0x29:2:low:GAIN_LOW:22"
+def parse_sensor_spec(spec):
+    fields = spec.split(':')
+    if len(fields) not in (5, 6):
+        raise argparse.ArgumentTypeError("sensor specification should be bus:address:multiplexer:gain:name[:int_pin]")
+    bus, address, multiplexer, gain, name = fields[:5]
+    int_pin = fields[5] if len(fields) == 6 else ''
+    if gain and gain not in GAIN_SETTINGS:
+        raise argparse.ArgumentTypeError("sensor gain should be one of " + ", ".join(GAIN_SETTINGS))
+    return {'bus': int(bus) if bus else 1, 'address': int(address, 0) if address else DEFAULT_I2C_ADDRESS,
+            'multiplexer': int(multiplexer) if multiplexer else None, 'gain': gain or "auto", 'name': name,
+            'int_pin': int(int_pin) if int_pin else None}
+
+
 def reset_sensor(sensor, gain, integration_time):
     # Sensor reset
     if verbose:
@@ -46,8 +73,9 @@ def reset_sensor(sensor, gain, integration_time):
 
 
 def measure_sky_brightness(sensor, radiometer_data_logger):
-    # Measure sky brightness in mag/arcsec^2 using max integration time
-    sensor.integration_time = adafruit_tsl2591.INTEGRATIONTIME_600MS
+    # Measure sky brightness in mag/arcsec^2 using max integration time, then restore the integration time
+    integration_time = sensor.integration_time
+    sensor.integration_time = sensor_backend.INTEGRATIONTIME_600MS
     # Sleep to ensure next reading is valid
     sensor.wait_interrupt()
     sensor.wait_interrupt()
@@ -56,12 +84,12 @@ def measure_sky_brightness(sensor, radiometer_data_logger):
     try:
         lux, vis_level, ir_level, again, atime = sensor.get_light_levels()
     except:
-        sensor.integration_time = adafruit_tsl2591.INTEGRATIONTIME_100MS
+        sensor.integration_time = integration_time
         sensor.wait_interrupt()
         # time.sleep(1.3)
         return 0
 
-    sensor.integration_time = adafruit_tsl2591.INTEGRATIONTIME_100MS
+    sensor.integration_time = integration_time
     radiometer_data_logger.log_data(
         datetime.datetime.now(), lux, vis_level, ir_level, again, atime)
 
@@ -74,12 +102,17 @@ def measure_sky_brightness(sensor, radiometer_data_logger):
     return sky_brightness
 
 
+# REST server for the latest readings of one or more sensors, with an endpoint for each sensor name,
+# and the history and event stream endpoints of each sensor's recent readings
 class FlaskServer(threading.Thread):
-    def __init__(self, device_name='radiometer'):
+    def __init__(self, device_name='radiometer', device_names=None):
 
-        self.device_name = device_name
+        self.device_names = device_names or [device_name]
+        self.device_name = self.device_names[0]
         self.lux = np.nan
-        self.readings = [{'time_stamp': '', 'lux': '', 'vis_level': '', 'ir_level': '', 'again': '', 'atime': ''}]
+        self.readings = {name: [{'time_stamp': '', 'lux': '', 'vis_level': '', 'ir_level': '', 'again': '', 'atime': ''}]
+                         for name in self.device_names}
+        self.histories = {name: ReadingHistory() for name in self.device_names}
 
         # Initialise the thread
         threading.Thread.__init__(self)
@@ -88,198 +121,132 @@ class FlaskServer(threading.Thread):
         
         try:
             app = Flask(__name__)
-            @app.route('/' + self.device_name, methods=['GET'])
-            def get_data():
-                return jsonify({self.device_name: self.readings})
+            for name in self.device_names:
+                app.add_url_rule('/' + name, name, lambda name=name: jsonify({name: self.readings[name]}), methods=['GET'])
+                add_history_routes(app, name, self.histories[name])
 
-            print("REST service running on:", self.device_name)
-            app.run(host='0.0.0.0', port=5000) # debug=True)
+            print("REST service running on:", ", ".join(self.device_names))
+            run_server(app, host='0.0.0.0', port=5000)
         except:
             print("Unable to start flask REST server")
 
-    def set_data(self, time_stamp, lux, vis_level, ir_level, again, atime):
+    def set_data(self, time_stamp, lux, vis_level, ir_level, again, atime, device_name=None):
         self.lux = lux
-        self.readings = [{'time_stamp': time_stamp, 'lux': self.lux, 'vis_level': vis_level, 'ir_level': ir_level, 'again': again, 'atime': atime}]
-
-
-# Class for logging detections to radiometer data file
-class RadiometerDataLogger():
-
-    def __init__(self, name=""):
-        self.name = name
-        if name:
-            self.name = "_" + name + "_"
-        # Make the data logging directory
-        os.makedirs(DATA_DIR, exist_ok=True)
-
-        # Set the filename and open it for appending
-        self.filename = "R" + self.name + \
-            datetime.datetime.now().strftime("%Y%m%d") + ".csv"
-        if verbose:
-            print("Writing data to file:", DATA_DIR + self.filename)
-        self.rmfile = open(DATA_DIR + self.filename, "a")
-
-        # Start a thread to periodically flush the data to disk
-        self.flush_thread = threading.Thread(target=self.flush_file)
-        self.flush_thread.start()
- 
-        # Start a thread to periodically clean up old data files
-        if keep_days > 0 :
-            if verbose :
-                print("Starting old data cleanup thread")
-            self.cleanup_thread = threading.Thread(target=self.remove_old_files, args = [keep_days])
-            self.cleanup_thread.start()
-
-
-    # Log the date/time and lux reading
-    def log_data(self, obs_time, lux_value, vis_level, ir_level, again, atime):
-        # Check for date change
+        self.readings[device_name or self.device_name] = [{'time_stamp': time_stamp, 'lux': self.lux, 'vis_level': vis_level, 'ir_level': ir_level, 'again': again, 'atime': atime}]
+        self.histories[device_name or self.device_name].append(time_stamp, lux, vis_level, ir_level, again, atime)
+
+
+# Log an error in the handling of a reading, which isn't caused by the sensor saturating
+def log_consumer_error(device_name, message, e):
+    if verbose:
+        print(e)
+    syslog.syslog(syslog.LOG_WARNING, "TSL2591 " + device_name + " " + message + ": " + str(e))
+
+
+# Acquire the light levels from a sensor, logging each reading
+def acquire(sensor, gain_level, auto_gain, radiometer_data_logger, flask_server, device_name, fireball_detector=None, sqm=False, hdr_fusion=None,
+            max_integration_time=sensor_backend.INTEGRATIONTIME_100MS, shared_readings_publisher=None):
+
+    # Set gain and fastest integration time (100ms)
+    sensor.enable()
+    sensor.gain = gain_level
+    sensor.integration_time = sensor_backend.INTEGRATIONTIME_100MS
+    prev_lux = -100
+    saturation_counter = 0
+
+    # With auto gain, choose the gain and integration time from the counts of each reading
+    auto_ranger = AutoRanger(gain_level, sensor_backend.INTEGRATIONTIME_100MS, max_integration_time) if auto_gain else None
+
+    time.sleep(0.5)
+
+    while True:
         try:
-            filename = "R" + self.name + obs_time.strftime("%Y%m%d") + ".csv"
-            if filename != self.filename:
-                self.rmfile.close()
-                self.filename = filename
-                self.rmfile = open(DATA_DIR + self.filename, "a")
-
-            # Log the data
-            out_string = '{0:s} {1:.9f} {2:d} {3:d} {4:.1f} {5:.1f}\n'.format(obs_time.strftime(
-                "%Y/%m/%d %H:%M:%S.%f")[:-3], lux_value, vis_level, ir_level, again, atime)
-            self.rmfile.write(out_string)
-            if verbose:
-                print(out_string, end='')
+            # Wait for an ALS interrupt to signal a reading has completed
+            sensor.wait_interrupt()
+
+            # Get a time stamp for the latest reading
+            time_stamp = datetime.datetime.now()
+
+            # Read and calculate the light level in lux.
+            lux, vis_level, ir_level, again, atime = sensor.get_light_levels()
 
+        # An exception can occur if the light sensor saturates
         except Exception as e:
-            print(e)
-
-    # Flush the data log file to disk every 10s
-    def flush_file(self):
-        while True:
-            time.sleep(10)
-            try:
-                self.rmfile.flush()
-            except:
-                pass
-
-    """ Remove old data files """
-    def remove_old_files(self, days=30) :
-        seconds = days * 86400
-
-        # Check every 3 hours and clean up old data files
-        while True:
-            file_list = [filename for filename in glob.glob(DATA_DIR + '/*') if (time.time() - os.path.getmtime(filename)) > seconds]
-            for filename in file_list :
-                try:
-                    os.remove(filename)
-                    syslog.syslog(syslog.LOG_DEBUG, 'Removed file: ' + filename)
-                except OSError :
-                    syslog.syslog(syslog.LOG_DEBUG, 'Unable to remove file: ' + filename)
-
-            time.sleep(SECS_IN_3_HOURS)
-
-
-# Add a get_light_levels method to the adafruit_tsl2591 class
-class adafruit_tsl2591_extended(adafruit_tsl2591.TSL2591):
-
-    def get_light_levels(self, disable_exception=False):
-        """Read the sensor and calculate a lux value from both its infrared
-        and visible light channels.
-
-        .. note::
-            :attr:`lux` is not calibrated!
-
-        """
-        channel_0, channel_1 = self.raw_luminosity
-
-        # Compute the atime in milliseconds
-        atime = 100.0 * self._integration_time + 100.0
-
-        # Set the maximum sensor counts based on the integration time (atime) setting
-        if self._integration_time == adafruit_tsl2591.INTEGRATIONTIME_100MS:
-            max_counts = adafruit_tsl2591._TSL2591_MAX_COUNT_100MS
-        else:
-            max_counts = adafruit_tsl2591._TSL2591_MAX_COUNT
-
-        # Handle overflow.
-        if channel_0 >= max_counts or channel_1 >= max_counts:
-            message = (
-                "Overflow reading light channels!, Try to reduce the gain of\n "
-                + "the sensor using adafruit_tsl2591.GAIN_LOW"
-            )
-            if not disable_exception:
-                raise RuntimeError(message)
-        # Calculate lux using same equation as Arduino library:
-        #  https://github.com/adafruit/Adafruit_TSL2591_Library/blob/master/Adafruit_TSL2591.cpp
-        again = 1.0
-        if self._gain == adafruit_tsl2591.GAIN_MED:
-            again = 25.0
-        elif self._gain == adafruit_tsl2591.GAIN_HIGH:
-            again = 428.0
-        elif self._gain == adafruit_tsl2591.GAIN_MAX:
-            again = 9876.0
-        cpl = (atime * again) / adafruit_tsl2591._TSL2591_LUX_DF
-        lux1 = (channel_0 - (adafruit_tsl2591._TSL2591_LUX_COEFB * channel_1)) / cpl
-        lux2 = (
-            (adafruit_tsl2591._TSL2591_LUX_COEFC * channel_0) -
-            (adafruit_tsl2591._TSL2591_LUX_COEFD * channel_1)
-        ) / cpl
-
-        # Alternate lux calculation 1 - currently used by C++ libraries
-        # See: https://github.com/adafruit/Adafruit_TSL2591_Library/issues/14
-        #     lux = (((float)ch0 - (float)ch1)) * (1.0F - ((float)ch1 / (float)ch0)) / cpl;
-        # alt_lux = ((float(channel_0) - float(channel_1))) * (1.0 - (float(channel_1) / float(channel_0))) / cpl
-
-        return max(lux1, lux2), channel_0, channel_1, again, atime
-
-    # Switch off only the ADC_EN
-    def adc_en_off(self):
-        self._write_u8(
-            adafruit_tsl2591._TSL2591_REGISTER_ENABLE,
-            adafruit_tsl2591._TSL2591_ENABLE_POWERON
-            | adafruit_tsl2591.ENABLE_AIEN
-            | adafruit_tsl2591.ENABLE_NPIEN,
-        )
-
-    def reset(self):
-        # Perform a device reset
-        val = 0b10000000
-        # control = self._read_u8(adafruit_tsl2591._TSL2591_REGISTER_CONTROL)
-        # control &= 0b01111111
-        control = val
-
-        # A write to the reset register always generates an exception
-        try:
-            self._write_u8(adafruit_tsl2591._TSL2591_REGISTER_CONTROL, control)
-        except:
-            pass
-
-    def clear_interrupts(self):
-        # Clear ALS interrupts.
-        with self._device as i2c:
-            # Make sure to add command bit and special function bit to write request.
-            sf = 0x07
-            self._BUFFER[0] = (0xE0 | sf) & 0xFF
-            self._BUFFER[1] = 0x00 & 0xFF
-            i2c.write(self._BUFFER, end=2)
-
-    def wait_interrupt_600(self):
-        # Wait ~600ms for AINT interrupt to signal a reading has completed
-        # Initial sleep 500ms
-        time.sleep(0.5)
-        # Get the status to check for the AINT interrupt being asserted
-        while self._read_u8(0x13) & 0x10 == 0:
+            if verbose:
+                print(e)
+
+            # If there is an exception with fixed gain, reset the sensor every 1200 readings (120s)
+            if not auto_gain:
+                saturation_counter += 1
+                if saturation_counter > 1200:
+                    reset_sensor(sensor, gain_level,
+                                 sensor_backend.INTEGRATIONTIME_100MS)
+                    saturation_counter = 0
+                continue
+
+            # Log the sensor values anyway even though there has been an exception as the IR sensor values may still be useful.
+            if auto_ranger.gain == sensor_backend.GAIN_MAX and prev_lux > 0:
+                lux, vis_level, ir_level, again, atime = sensor.get_light_levels(
+                    disable_exception=True)
+                radiometer_data_logger.log_data(
+                    time_stamp, prev_lux, vis_level, ir_level, again, atime)
+
+            # Step down the gain and integration time so that readings can continue
+            setting = auto_ranger.saturated()
+            if setting:
+                auto_ranger.apply(sensor, setting)
+
+            # If the sensor is saturated at its lowest setting for a long time (120s), reset the sensor and keep reading
+            else:
+                saturation_counter += 1
+                if saturation_counter > 1200:
+                    reset_sensor(sensor, auto_ranger.gain, auto_ranger.integration_time)
+                    saturation_counter = 0
+
             time.sleep(0.05)
+            continue
 
-        self.clear_interrupts()
+        # Reset the saturation counter amd store the previous lux value
+        saturation_counter = 0
+        prev_lux = lux
 
-    def wait_interrupt(self):
-        # Wait for AINT interrupt to signal a reading has completed
-        # Initial sleep 50ms
-        time.sleep(0.05)
-        # Get the status to check for the AINT interrupt being asserted
-        while self._read_u8(0x13) & 0x10 == 0:
-            time.sleep(0.005)
+        # Pass the reading to its consumers. A consumer's failure is logged, and isn't treated as the sensor saturating
+        try:
+            # Log the latest reading
+            radiometer_data_logger.log_data(
+                time_stamp, lux, vis_level, ir_level, again, atime)
+
+            # Write the latest data to the flask server
+            flask_server.set_data(time_stamp, lux, vis_level, ir_level, again, atime, device_name)
 
-        self.clear_interrupts()
+            # Publish the latest reading in shared memory
+            if shared_readings_publisher:
+                shared_readings_publisher.publish(time_stamp, lux, vis_level, ir_level, again, atime)
+
+            # Check the latest reading for a fireball
+            if fireball_detector:
+                fireball_detector.update(time_stamp, lux, vis_level, ir_level, again, atime)
+
+            # Add the latest reading to the high dynamic range readings
+            if hdr_fusion:
+                hdr_fusion.update(device_name, time_stamp, lux, vis_level, ir_level, again, atime)
+        except Exception as e:
+            log_consumer_error(device_name, "unable to process reading", e)
+
+        try:
+            # Change the gain and integration time before the sensor saturates, or when the light level has fallen
+            if auto_ranger:
+                setting = auto_ranger.update(vis_level, ir_level)
+                if setting:
+                    if verbose:
+                        print("Auto range gain", sensor_backend.GAIN_FACTORS[setting[0]], "atime", 100 * setting[1] + 100)
+                    auto_ranger.apply(sensor, setting)
+
+            # On each hour change, measure the sky brightness if it's dark
+            if sqm and lux < 0.2 and time_stamp.minute == 0 and time_stamp.second == 0:
+                measure_sky_brightness(sensor, radiometer_data_logger)
+        except Exception as e:
+            log_consumer_error(device_name, "unable to change the sensor settings", e)
 
 
 # Main program
@@ -291,175 +258,126 @@ if __name__ == "__main__":
                     help="Set the light sensor's i2c address. Default is " + hex(DEFAULT_I2C_ADDRESS))
     ap.add_argument("-b", "--bus", type=int, default=1,
                     help="Specify the i2c bus used for connecting the sensor e.g. 3 if /dev/i2c-3 has been created using dtoverlay. Default is bus 1")
-    gain_choices = ["max", "high", "med", "low", "auto"]
+    ap.add_argument("--binary", action='store_true',
+                    help="Write the data in the compact binary record format instead of csv")
+    gain_choices = list(GAIN_SETTINGS)
+    ap.add_argument("-d", "--detect", action='store_true',
+                    help="Detect fireballs as the data is acquired and write the readings of each event to its own file")
     ap.add_argument(
         "-g", "--gain", choices=gain_choices, type=str, default="auto", help="Gain level for the light sensor. Default is auto")
+    ap.add_argument("--hdr", action='store_true',
+                    help="Fuse the readings of the --sensor sensors at different gains into one high dynamic range data file and REST endpoint named " + HDR_NAME)
     ap.add_argument("-k", "--keep", type=int, default=0,
-                    help="Keep only files produced in the last n days. Default is 0 - keep all data files")
+                    help="Keep the readings of only the last n days, and the aggregates of older days. Default is 0 - keep all data files")
+    ap.add_argument("--keep-1s", type=int, default=12,
+                    help="Keep the 1 second aggregates of the readings for n months when the readings are removed by --keep or --quota. The 1 minute aggregates are kept indefinitely. Default is 12, 0 keeps them all")
+    ap.add_argument("-i", "--int-pin", type=int, default=None,
+                    help="GPIO pin (BCM numbering) connected to the sensor's INT pin. Wait for the interrupt edge instead of polling the sensor over i2c")
     ap.add_argument("-m", "--multiplexer", type=int, default=None,
                     help="Connect to the i2c sensor via an adafruit TCA9548A multiplexer using the number of the multiplexer channel e.g. 0-7")
     ap.add_argument("-n", "--name", type=str, default="",
                     help="Optional name of the sensor for the output file name. Default is no name")
     ap.add_argument("-s", "--sqm", action='store_true',
                     help="Take hourly SQM measurements")
+    ap.add_argument("--sensor", type=parse_sensor_spec, action='append', default=None,
+                    help="Acquire from several sensors in one process. Specify each sensor as bus:address:multiplexer:gain:name[:int_pin], "
+                    "where empty fields take their default values e.g. --sensor 1:::max:GAIN_MAX --sensor 3:::med:GAIN_MED. Each sensor needs a different name")
+    ap.add_argument("--quota", type=int, default=0,
+                    help="Limit the space used by the sensor's data files and aggregates to n MB, removing the oldest readings first, then the oldest aggregates. Default is 0 - no limit")
+    ap.add_argument("--simulate", type=str, nargs='+', default=None,
+                    help="Replay the light levels in these data files with a simulated sensor instead of using the real sensor")
+    ap.add_argument("--speed", type=float, default=1.0,
+                    help="Replay speed of the simulated sensor relative to real time. 0 is as fast as possible. Default is 1")
+    ap.add_argument("-t", "--max-atime", type=int, choices=[100, 200, 300, 400, 500, 600], default=100,
+                    help="Longest integration time in ms that auto gain can choose when it's dark. Longer times lower the sampling rate. Default is 100")
     ap.add_argument("-v", "--verbose", action='store_true',
                     help="Verbose output to terminal")
+    ap.add_argument("-z", "--compress", action='store_true',
+                    help="Compress each day's data file in the background after midnight, and any earlier uncompressed data files")
     args = vars(ap.parse_args())
 
     i2c_address = args['address']
     i2c_bus = args['bus']
+    binary = args['binary']
+    compress = args['compress']
+    detect = args['detect']
     gain_name = args['gain']
+    hdr = args['hdr']
     keep_days = args['keep']
+    keep_1s_months = args['keep_1s']
+    quota_mb = args['quota']
     device_name = args['name']
+    int_pin = args['int_pin']
     multiplexer = args['multiplexer']
     sqm = args['sqm']
+    simulate = args['simulate']
+    speed = args['speed']
+    max_integration_time = args['max_atime'] // 100 - 1
     verbose = args['verbose']
 
-    # Get the TSL2591 gain from the command line string. If the gain is set to auto, set the gain to maximum
-    valid_device_gain_settings = [adafruit_tsl2591.GAIN_MAX,
-                                  adafruit_tsl2591.GAIN_HIGH, adafruit_tsl2591.GAIN_MED, adafruit_tsl2591.GAIN_LOW, adafruit_tsl2591.GAIN_MAX]
-    required_device_gain_setting = valid_device_gain_settings[gain_choices.index(
-        gain_name)]
-    auto_gain = True if gain_name == "auto" else False
+    # Use the single sensor options if no sensors are specified
+    sensor_specs = args['sensor'] or [{'bus': i2c_bus, 'address': i2c_address, 'multiplexer': multiplexer,
+                                       'gain': gain_name, 'name': device_name, 'int_pin': int_pin}]
+    device_names = [sensor_spec['name'] for sensor_spec in sensor_specs]
+    if len(set(device_names)) != len(device_names):
+        ap.error("each sensor needs a different name")
+    if hdr and (len(sensor_specs) < 2 or HDR_NAME in device_names):
+        ap.error("--hdr needs two or more --sensor sensors, not named " + HDR_NAME)
 
     # Handle termination signals gracefully
     signal.signal(signal.SIGINT, signalHandler)
     signal.signal(signal.SIGTERM, signalHandler)
 
-    # Open the i2c bus
-    i2c = I2C(i2c_bus)
-
-    # Create the sensor or TCA9548A object and pass it the I2C bus
-    if multiplexer is not None:
-        import adafruit_tca9548a
-        tca = adafruit_tca9548a.TCA9548A(i2c)
-        # For the sensor on the multiplexer, create it using the TCA9548A channel instead of the I2C object
-        sensor = adafruit_tsl2591_extended(tca[multiplexer])
-    else:
-        sensor = adafruit_tsl2591_extended(i2c, address=i2c_address)
-
-    # Set gain and fastest integration time (100ms)
-    sensor.enable()
-    gain_level = required_device_gain_setting
-    sensor.gain = gain_level
-    sensor.integration_time = adafruit_tsl2591.INTEGRATIONTIME_100MS
-    prev_lux = -100
-    saturation_counter = 0
-
-    time.sleep(0.5)
-
-    # Create the data logger
-    radiometer_data_logger = RadiometerDataLogger(name=device_name)
-
-    # Create the flask REST server
-    if device_name:
-        flask_server = FlaskServer(device_name=device_name)
-    else:
-        flask_server = FlaskServer()
+    # Create the flask REST server, shared by all of the sensors
+    flask_server = FlaskServer(device_names=[name or 'radiometer' for name in device_names] + ([HDR_NAME] if hdr else []))
     flask_server.start()
 
-    while True:
-        try:
-            # Wait for an ALS interrupt to signal a reading has completed
-            sensor.wait_interrupt()
-
-            # Get a time stamp for the latest reading
-            time_stamp = datetime.datetime.now()
-
-            # Read and calculate the light level in lux.
-            lux, vis_level, ir_level, again, atime = sensor.get_light_levels()
-
-            # Log the latest reading
-            radiometer_data_logger.log_data(
-                time_stamp, lux, vis_level, ir_level, again, atime)
-
-            # Write the latest data to the flask server
-            flask_server.set_data(time_stamp, lux, vis_level, ir_level, again, atime)
-
-            # Check if the gain level can be changed back to max
-            if auto_gain and gain_level != adafruit_tsl2591.GAIN_MAX and lux < 3.0:
-                # sensor.disable()
-                sensor.adc_en_off()
-                gain_level = adafruit_tsl2591.GAIN_MAX
-                sensor.gain = gain_level
-                sensor.enable()
-                sensor.integration_time = adafruit_tsl2591.INTEGRATIONTIME_100MS
-                # Wait for next valid reading
-                sensor.wait_interrupt()
-                # time.sleep(GUARD_TIME)
-
-            # Reset the saturation counter amd store the previous lux value
-            saturation_counter = 0
-            prev_lux = lux
-
-            # On each hour change, measure the sky brightness if it's dark
-            if sqm and lux < 0.2 and time_stamp.minute == 0 and time_stamp.second == 0:
-                measure_sky_brightness(sensor, radiometer_data_logger)
-
-        # An exception can occur if the light sensor saturates
-        except Exception as e:
-            if verbose:
-                print(e)
-
-            # If there is an exception with fixed gain, reset the sensor every 1200 readings (120s)
-            if not auto_gain:
-                saturation_counter += 1
-                if saturation_counter > 1200:
-                    reset_sensor(sensor, gain_level,
-                                 adafruit_tsl2591.INTEGRATIONTIME_100MS)
-                    saturation_counter = 0
-                continue
-
-            # Attempt to lower gain so that readings can continue
-            # Gain at GAIN_MED will allow measurements to be taken up to about 3000 lux
-            if gain_level == adafruit_tsl2591.GAIN_MAX:
-
-                # Log the sensor values anyway even though there has been an exception as the IR sensor values may still be useful.
-                if prev_lux > 0:
-                    lux, vis_level, ir_level, again, atime = sensor.get_light_levels(
-                        disable_exception=True)
-                    radiometer_data_logger.log_data(
-                        time_stamp, prev_lux, vis_level, ir_level, again, atime)
-
-                # sensor.disable()
-                sensor.adc_en_off()
-                gain_level = adafruit_tsl2591.GAIN_MED
-                sensor.gain = gain_level
-                sensor.enable()
-                sensor.integration_time = adafruit_tsl2591.INTEGRATIONTIME_100MS
-                # Sleep to ensure next reading is valid
-                sensor.wait_interrupt()
-                # time.sleep(GUARD_TIME)
-
-            # If the sensor has been saturated for a long time (120s), reset the sensor and then stay asleep
-            else:
-                saturation_counter += 1
-                if saturation_counter > 1200:
-                    reset_sensor(sensor, gain_level,
-                                 adafruit_tsl2591.INTEGRATIONTIME_100MS)
-                    time.sleep(120)
-
-                    # Take a reading at lowest gain, then set the gain back to medium
-                    sensor.gain = adafruit_tsl2591.GAIN_LOW
-                    sensor.enable()
-                    time.sleep(1)
-                    try:
-                        lux, vis_level, ir_level, again, atime = sensor.get_light_levels()
-                        time_stamp = datetime.datetime.now()
-                        radiometer_data_logger.log_data(
-                            time_stamp, lux, vis_level, ir_level, again, atime)
-                        # Write the data to the flask server
-                        flask_server.set_data(time_stamp, lux, vis_level, ir_level, again, atime)
-
-                    except Exception as e:
-                        print(e)
-
-                    # sensor.disable()
-                    sensor.adc_en_off()
-                    time.sleep(1)
-                    gain_level = adafruit_tsl2591.GAIN_MED
-                    sensor.gain = gain_level
-                    sensor.enable()
-                    time.sleep(1)
-
-            time.sleep(0.05)
+    # Create the high dynamic range data logger, and the fusion of the sensors' readings
+    hdr_fusion = None
+    if hdr:
+        hdr_data_logger = RadiometerDataLogger(name=HDR_NAME, keep_days=keep_days, binary=binary, compress=compress, keep_1s_months=keep_1s_months, quota_mb=quota_mb)
+        radiometer_data_loggers.append(hdr_data_logger)
+        hdr_publisher = SharedReadingsPublisher(HDR_NAME)
+        shared_readings_publishers.append(hdr_publisher)
+
+        def log_hdr_data(time_stamp, lux, vis_level, ir_level, again, atime):
+            hdr_data_logger.log_data(time_stamp, lux, vis_level, ir_level, again, atime)
+            flask_server.set_data(time_stamp, lux, vis_level, ir_level, again, atime, HDR_NAME)
+            hdr_publisher.publish(time_stamp, lux, vis_level, ir_level, again, atime)
+        hdr_fusion = HdrFusion(log_hdr_data)
+
+    # The sensors on the same i2c bus or multiplexer share it
+    i2c_buses = sensor_backend.I2cBuses()
+    acquisitions = []
+    for sensor_spec in sensor_specs:
+        # Open the sensor, or a simulated sensor replaying data files. Exit when the replay has finished
+        sensor = sensor_backend.open_sensor(sensor_spec['bus'], sensor_spec['address'], sensor_spec['multiplexer'], sensor_spec['int_pin'],
+                                            simulate, speed, on_finished=lambda: signalHandler(signal.SIGTERM, None), buses=i2c_buses)
+
+        # Create the data logger
+        radiometer_data_logger = RadiometerDataLogger(name=sensor_spec['name'], keep_days=keep_days, binary=binary, compress=compress, keep_1s_months=keep_1s_months, quota_mb=quota_mb, verbose=verbose)
+        radiometer_data_loggers.append(radiometer_data_logger)
+
+        # Publish the latest readings in shared memory
+        shared_readings_publisher = SharedReadingsPublisher(sensor_spec['name'] or 'radiometer')
+        shared_readings_publishers.append(shared_readings_publisher)
+
+        # Create the fireball detector
+        fireball_detector = FireballDetector(name=sensor_spec['name'], verbose=verbose) if detect else None
+
+        # Get the TSL2591 gain from the gain name. If the gain is set to auto, set the gain to maximum
+        acquisitions.append((sensor, GAIN_SETTINGS[sensor_spec['gain']], sensor_spec['gain'] == "auto", radiometer_data_logger,
+                             flask_server, sensor_spec['name'] or 'radiometer', fireball_detector, sqm, hdr_fusion, max_integration_time,
+                             shared_readings_publisher))
+
+    # Acquire from a single sensor in the main thread, or from each sensor in its own thread. The sensors'
+    # interrupt waits sleep, so the threads interleave their readings, and the lock of each shared i2c bus keeps the
+    # transfers and multiplexer channel selects of its sensors apart
+    if len(acquisitions) == 1:
+        acquire(*acquisitions[0])
+    else:
+        threads = [threading.Thread(target=acquire, args=acquisition) for acquisition in acquisitions]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,129 @@
+import datetime
+import json
+import threading
+import time
+import numpy as np
+
+import radiometer_binary
+
+# Minutes of readings kept in the history of each sensor, and the most readings per second expected
+HISTORY_MINUTES = 10
+READINGS_PER_SECOND = 10
+
+# Interval at which each event stream client checks the history for new readings. The clients read the history
+# under its lock, so the acquisition thread does no work for each client
+STREAM_POLL_INTERVAL = 0.05
+
+# Seconds between keep alive comments on an event stream with no new readings
+STREAM_KEEP_ALIVE = 15.0
+
+# Worker threads of the waitress server. Each event stream client holds a thread while it is connected
+SERVER_THREADS = 48
+
+COLUMNS = ['lux', 'vis_level', 'ir_level', 'again', 'atime']
+
+
+# Ring buffer of the latest readings of a sensor, held in numpy arrays. Each reading has a sequence number,
+# so that clients can fetch the readings they haven't seen by time or by sequence number
+class ReadingHistory():
+
+    def __init__(self, minutes=HISTORY_MINUTES, readings_per_second=READINGS_PER_SECOND):
+        self.size = int(minutes * 60 * readings_per_second)
+        self.times = np.zeros(self.size, dtype=np.int64)
+        self.values = np.zeros((self.size, len(COLUMNS)), dtype=np.float64)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    # Add a reading. Called by the acquisition thread, so it only copies the values into the arrays
+    def append(self, time_stamp, lux, vis_level, ir_level, again, atime):
+        with self.lock:
+            index = self.count % self.size
+            self.times[index] = radiometer_binary.datetime_to_ns(time_stamp)
+            self.values[index] = (lux, vis_level, ir_level, again, atime)
+            self.count += 1
+
+    # Readings after the sequence number, in time order. Returns the times, values and the sequence number of the last reading
+    def since_sequence(self, sequence):
+        with self.lock:
+            first = max(sequence, self.count - self.size, 0)
+            indexes = np.arange(first, self.count) % self.size
+            return self.times[indexes], self.values[indexes], self.count
+
+    # Readings after the time in ns, in time order
+    def since_time(self, time_ns):
+        with self.lock:
+            first = max(self.count - self.size, 0)
+            indexes = np.arange(first, self.count) % self.size
+            times = self.times[indexes]
+            start = np.searchsorted(times, time_ns, side='right')
+            return times[start:], self.values[indexes[start:]], self.count
+
+
+def format_time(time_ns):
+    return (radiometer_binary.EPOCH + datetime.timedelta(microseconds=int(time_ns) // 1000)).isoformat(timespec='microseconds')
+
+
+# Readings as columns of a JSON object
+def readings_to_json(times, values):
+    readings = {'time_stamp': [format_time(time_ns) for time_ns in times]}
+    for column, name in enumerate(COLUMNS):
+        readings[name] = values[:, column].tolist()
+    return readings
+
+
+# Generate server sent events of the readings after the sequence number, one event per reading with the
+# sequence number as the event id, so a client that reconnects with Last-Event-ID gets each reading once
+def stream_events(history, sequence):
+    last_event = time.monotonic()
+    while True:
+        times, values, sequence_end = history.since_sequence(sequence)
+        first = sequence_end - len(times)
+        for row in range(len(times)):
+            reading = {'time_stamp': format_time(times[row])}
+            reading.update(zip(COLUMNS, values[row].tolist()))
+            yield "id: {0}\ndata: {1}\n\n".format(first + row + 1, json.dumps(reading))
+        if len(times):
+            last_event = time.monotonic()
+        elif time.monotonic() - last_event > STREAM_KEEP_ALIVE:
+            last_event = time.monotonic()
+            yield ": keep alive\n\n"
+        sequence = sequence_end
+        time.sleep(STREAM_POLL_INTERVAL)
+
+
+# Add the history and event stream endpoints of a sensor to a flask app:
+#   /<name>/history?since=<time_stamp>  readings after the ISO time stamp e.g. 2026-02-04T03:15:22.123456, or all of the history
+#   /<name>/stream                      server sent events of each new reading
+def add_history_routes(app, device_name, history):
+    from flask import Response, jsonify, request
+
+    def get_history():
+        since = request.args.get('since')
+        if since:
+            try:
+                since_ns = radiometer_binary.datetime_to_ns(datetime.datetime.fromisoformat(since))
+            except ValueError:
+                return jsonify({'error': 'since should be an ISO time stamp e.g. 2026-02-04T03:15:22.123456'}), 400
+            times, values, sequence = history.since_time(since_ns)
+        else:
+            times, values, sequence = history.since_sequence(0)
+        return jsonify({device_name: readings_to_json(times, values)})
+
+    def get_stream():
+        last_event_id = request.headers.get('Last-Event-ID', '')
+        sequence = int(last_event_id) if last_event_id.isdigit() else history.count
+        return Response(stream_events(history, sequence), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    app.add_url_rule('/' + device_name + '/history', device_name + '_history', get_history, methods=['GET'])
+    app.add_url_rule('/' + device_name + '/stream', device_name + '_stream', get_stream, methods=['GET'])
+
+
+# Run the flask app on the waitress server if it's installed, otherwise on flask's threaded server
+def run_server(app, host='0.0.0.0', port=5000):
+    try:
+        from waitress import serve
+    except ImportError:
+        app.run(host=host, port=port, threaded=True)
+        return
+    serve(app, host=host, port=port, threads=SERVER_THREADS)
@@ -0,0 +1,108 @@
+import math
+from collections import deque
+
+
+# Sky brightness in mag/arcsec^2 of a lux value
+def sky_brightness(lux):
+    return math.log10(lux / 108000) / -0.4 if lux > 0 else math.nan
+
+
+# Mean, variance, minimum and maximum of the values in a window of the latest samples or the latest seconds.
+# The mean and variance are updated as each value enters and leaves the window (Welford's method), and the
+# minimum and maximum are kept in monotonic queues, so the cost per value doesn't grow with the window length.
+# Values that aren't finite, e.g. the sky brightness of a zero lux reading, are skipped
+class RollingStats():
+
+    def __init__(self, window_samples=None, window_seconds=None):
+        self.window_samples = window_samples
+        self.window_seconds = window_seconds
+        self.values = deque()
+        self.minimums = deque()
+        self.maximums = deque()
+        self.mean = math.nan
+        self.m2 = 0.0
+        self.sequence = 0
+
+    # Add a value. The time is in seconds, and is only needed for a window in seconds
+    def update(self, value, time=None):
+        if self.window_seconds is not None:
+            while self.values and self.values[0][0] <= time - self.window_seconds:
+                self.remove()
+        if not math.isfinite(value):
+            return
+        if self.window_samples is not None and len(self.values) >= self.window_samples:
+            self.remove()
+
+        count = len(self.values) + 1
+        if count == 1:
+            self.mean, self.m2 = value, 0.0
+        else:
+            delta = value - self.mean
+            self.mean += delta / count
+            self.m2 += delta * (value - self.mean)
+        self.values.append((time, value, self.sequence))
+
+        while self.minimums and self.minimums[-1][1] >= value:
+            self.minimums.pop()
+        self.minimums.append((self.sequence, value))
+        while self.maximums and self.maximums[-1][1] <= value:
+            self.maximums.pop()
+        self.maximums.append((self.sequence, value))
+        self.sequence += 1
+
+    # Remove the oldest value from the window
+    def remove(self):
+        time, value, sequence = self.values.popleft()
+        count = len(self.values)
+        if count == 0:
+            self.mean, self.m2 = math.nan, 0.0
+        else:
+            delta = value - self.mean
+            self.mean -= delta / count
+            self.m2 = max(self.m2 - delta * (value - self.mean), 0.0)
+        if self.minimums[0][0] == sequence:
+            self.minimums.popleft()
+        if self.maximums[0][0] == sequence:
+            self.maximums.popleft()
+
+    def count(self):
+        return len(self.values)
+
+    # Population variance of the values in the window
+    def variance(self):
+        return self.m2 / len(self.values) if self.values else math.nan
+
+    def std(self):
+        return math.sqrt(self.variance())
+
+    def minimum(self):
+        return self.minimums[0][1] if self.minimums else math.nan
+
+    def maximum(self):
+        return self.maximums[0][1] if self.maximums else math.nan
+
+    def summary(self, prefix=''):
+        return {prefix + 'mean': self.mean, prefix + 'std': self.std(), prefix + 'min': self.minimum(),
+                prefix + 'max': self.maximum(), prefix + 'count': self.count()}
+
+
+# Rolling statistics of lux readings, both in lux and as sky brightness in mag/arcsec^2.
+# The sky brightness of each reading is calculated once, for all of the outputs that use it
+class LuxStats():
+
+    def __init__(self, window_samples=None, window_seconds=None):
+        self.lux = RollingStats(window_samples, window_seconds)
+        self.sky_brightness = RollingStats(window_samples, window_seconds)
+        self.latest_sky_brightness = math.nan
+
+    # Add a lux reading. The time stamp is a datetime
+    def update(self, time_stamp, lux):
+        time = time_stamp.timestamp() if time_stamp is not None else None
+        self.latest_sky_brightness = sky_brightness(lux)
+        self.lux.update(lux, time)
+        self.sky_brightness.update(self.latest_sky_brightness, time)
+
+    def summary(self):
+        summary = self.lux.summary('lux_')
+        summary.update(self.sky_brightness.summary('sky_brightness_'))
+        return summary
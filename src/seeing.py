@@ -0,0 +1,52 @@
+import numpy as np
+
+from rolling_stats import RollingStats
+
+# Solar scintillation seeing is the RMS variation of the lux readings over a chunk of readings (1 second at 10 Hz),
+# relative to the mean, scaled by the solar diameter
+SSSM_FACTOR = 1900   # Solar diameter is ~1900 arcsec
+CHUNK_SIZE = 10
+
+# Minimum lux value for a valid seeing reading
+SEEING_MIN_LUX = 2000
+
+
+# Calculate the seeing for each complete chunk of consecutive lux readings.
+# Returns the seeing values and the index of the last reading in each chunk
+def chunked_seeing(lux, chunk_size=CHUNK_SIZE):
+    chunks_count = len(lux) // chunk_size
+    chunks = np.asarray(lux[:chunks_count * chunk_size], dtype=np.float64).reshape(chunks_count, chunk_size)
+    average = chunks.mean(axis=1)
+    rms = np.sqrt(np.mean(np.square(chunks - average[:, None]), axis=1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        seeings = SSSM_FACTOR * np.abs(rms / average)
+    return seeings, np.arange(chunks_count) * chunk_size + chunk_size - 1
+
+
+# Class to calculate the seeing one reading at a time for the live writer. The mean and variance of the
+# current chunk are kept by the rolling statistics of the last chunk of readings, so the cost per reading is constant
+class SeeingCalculator():
+
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.stats = RollingStats(window_samples=chunk_size)
+        self.readings = 0
+        self.average = np.nan
+        self.rms = np.nan
+
+    # Add a lux reading. Returns the seeing when a chunk is complete, otherwise None
+    def update(self, lux_value):
+        self.stats.update(lux_value)
+        self.readings += 1
+        if self.readings % self.chunk_size:
+            return None
+
+        # Chunks with invalid readings are skipped
+        if self.stats.count() < self.chunk_size:
+            return np.nan
+
+        self.average = self.stats.mean
+        self.rms = self.stats.std()
+        if self.average == 0:
+            return np.nan
+        return SSSM_FACTOR * abs(self.rms / self.average)
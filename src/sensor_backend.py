@@ -0,0 +1,323 @@
+import argparse
+import threading
+import time
+import numpy as np
+
+# Sensor backends for the acquisition scripts. A backend provides the methods and properties of the
+# adafruit TSL2591 driver used by the scripts:
+#   get_light_levels(disable_exception=False) -> lux, visible counts, IR counts, gain, integration time (ms)
+#   wait_interrupt(), wait_interrupt_600()
+#   gain, integration_time (settable)
+#   enable(), disable(), adc_en_off(), reset(), clear_interrupts()
+# The real sensor is tsl2591_driver.adafruit_tsl2591_extended. SimulatedTSL2591 replays recorded data files,
+# so the acquisition scripts can be run, profiled and load tested without the hardware.
+
+# TSL2591 settings, with the same values as the adafruit_tsl2591 module, so that the scripts can use them
+# without importing the hardware modules
+DEFAULT_I2C_ADDRESS = 0x29
+DEFAULT_MUX_ADDRESS = 0x70
+GAIN_LOW = 0x00     # 1x
+GAIN_MED = 0x10     # 25x
+GAIN_HIGH = 0x20    # 428x
+GAIN_MAX = 0x30     # 9876x
+INTEGRATIONTIME_100MS = 0x00
+INTEGRATIONTIME_200MS = 0x01
+INTEGRATIONTIME_300MS = 0x02
+INTEGRATIONTIME_400MS = 0x03
+INTEGRATIONTIME_500MS = 0x04
+INTEGRATIONTIME_600MS = 0x05
+
+GAIN_FACTORS = {GAIN_LOW: 1.0, GAIN_MED: 25.0, GAIN_HIGH: 428.0, GAIN_MAX: 9876.0}
+
+# Counts at which a channel is treated as saturated, and the ADC full scale counts
+MAX_COUNT_100MS = 0x8FFF
+MAX_COUNT = 0xFFFF
+FULL_SCALE_100MS = 37888
+
+# Lux calculation coefficients, as used by the adafruit library
+LUX_DF = 408.0
+LUX_COEFB = 1.64
+LUX_COEFC = 0.59
+LUX_COEFD = 0.86
+
+NS_PER_MS = 1000000
+
+# Gaps in the replayed data longer than this are skipped, e.g. between data files
+MAX_GAP_NS = 10 * 1000000000
+
+
+class ReplayFinished(Exception):
+    pass
+
+
+# Calculate a lux value from the visible and IR channel counts using the same equation as the Arduino library:
+# https://github.com/adafruit/Adafruit_TSL2591_Library/blob/master/Adafruit_TSL2591.cpp
+# Returns the lux, channel counts, gain and integration time in ms
+def calculate_lux(channel_0, channel_1, gain, integration_time, disable_exception=False):
+    # Compute the atime in milliseconds
+    atime = 100.0 * integration_time + 100.0
+
+    # Set the maximum sensor counts based on the integration time (atime) setting
+    if integration_time == INTEGRATIONTIME_100MS:
+        max_counts = MAX_COUNT_100MS
+    else:
+        max_counts = MAX_COUNT
+
+    # Handle overflow.
+    if channel_0 >= max_counts or channel_1 >= max_counts:
+        message = (
+            "Overflow reading light channels!, Try to reduce the gain of\n "
+            + "the sensor using adafruit_tsl2591.GAIN_LOW"
+        )
+        if not disable_exception:
+            raise RuntimeError(message)
+
+    again = GAIN_FACTORS.get(gain, 1.0)
+    cpl = (atime * again) / LUX_DF
+    lux1 = (channel_0 - (LUX_COEFB * channel_1)) / cpl
+    lux2 = ((LUX_COEFC * channel_0) - (LUX_COEFD * channel_1)) / cpl
+
+    # Alternate lux calculation 1 - currently used by C++ libraries
+    # See: https://github.com/adafruit/Adafruit_TSL2591_Library/issues/14
+    #     lux = (((float)ch0 - (float)ch1)) * (1.0F - ((float)ch1 / (float)ch0)) / cpl;
+    # alt_lux = ((float(channel_0) - float(channel_1))) * (1.0 - (float(channel_1) / float(channel_0))) / cpl
+
+    return max(lux1, lux2), channel_0, channel_1, again, atime
+
+
+# Simulated TSL2591 that replays the light levels in recorded data files. The counts of each reading are the
+# average count rates of the recorded readings during the integration period, scaled by the current gain and
+# integration time and clipped at the ADC full scale, so readings saturate as they would on the real sensor.
+# Readings complete at the end of each integration period, and changing the gain or integration time restarts
+# the integration. With a speed of 0, the replay runs as fast as the caller reads the sensor.
+class SimulatedTSL2591():
+
+    def __init__(self, file_names, speed=1.0, on_finished=None):
+        import radiometer_loader
+
+        data = radiometer_loader.concatenate([radiometer_loader.load_file(file_name)[0] for file_name in file_names])
+        if not len(data['time']):
+            raise ValueError("No readings to replay in " + " ".join(file_names))
+        self.times = data['time']
+
+        # Cumulative count rates (counts per ms at 1x gain) for averaging over each integration period
+        exposure = data['gain'].astype(np.float64) * data['atime']
+        self.visible_rates = np.concatenate(([0.0], np.cumsum(data['visible'] / exposure)))
+        self.ir_rates = np.concatenate(([0.0], np.cumsum(data['ir'] / exposure)))
+
+        self.speed = speed
+        self.on_finished = on_finished
+        self.start_time = int(self.times[0])
+        self.end_time = int(self.times[-1])
+        self.wall_start = time.monotonic()
+        self.clock = self.start_time
+        self.skipped = 0
+
+        self._gain = GAIN_MED
+        self._integration_time = INTEGRATIONTIME_100MS
+        self.enabled = False
+        self.restart_integration()
+        self.reading_end = None
+
+    # Current time in the recording
+    def now(self):
+        if self.speed:
+            return self.start_time + self.skipped + int((time.monotonic() - self.wall_start) * self.speed * 1e9)
+        return self.clock + self.skipped
+
+    def sleep_until(self, sim_time):
+        if self.speed:
+            delay = (sim_time - self.now()) / self.speed / 1e9
+            if delay > 0:
+                time.sleep(delay)
+        else:
+            self.clock = max(self.clock, sim_time - self.skipped)
+
+    def period(self):
+        return (100 * self._integration_time + 100) * NS_PER_MS
+
+    def restart_integration(self):
+        self.next_reading_end = self.now() + self.period()
+
+    @property
+    def gain(self):
+        return self._gain
+
+    @gain.setter
+    def gain(self, value):
+        self._gain = value
+        self.restart_integration()
+
+    @property
+    def integration_time(self):
+        return self._integration_time
+
+    @integration_time.setter
+    def integration_time(self, value):
+        self._integration_time = value
+        self.restart_integration()
+
+    def enable(self):
+        self.enabled = True
+        self.restart_integration()
+
+    def disable(self):
+        self.enabled = False
+
+    def adc_en_off(self):
+        self.enabled = False
+
+    def reset(self):
+        self._gain = GAIN_MED
+        self._integration_time = INTEGRATIONTIME_100MS
+        self.enabled = False
+
+    def clear_interrupts(self):
+        pass
+
+    # Wait for the end of the next integration period. If the caller has been too slow to read the
+    # previous readings, the sensor holds the latest completed reading
+    def wait_interrupt(self):
+        self.skip_gap()
+        now = self.now()
+        if now < self.next_reading_end:
+            self.sleep_until(self.next_reading_end)
+        else:
+            self.next_reading_end += (now - self.next_reading_end) // self.period() * self.period()
+        self.reading_end = self.next_reading_end
+        self.next_reading_end += self.period()
+
+        if self.reading_end > self.end_time:
+            if self.on_finished:
+                self.on_finished()
+            raise ReplayFinished("End of the replayed data")
+
+    # Skip the replay forward to the next recorded reading if the next reading would be in a long gap
+    def skip_gap(self):
+        next_index = np.searchsorted(self.times, self.next_reading_end - self.period(), side='right')
+        if next_index < len(self.times) and self.times[next_index] > self.next_reading_end + MAX_GAP_NS:
+            gap = int(self.times[next_index]) - self.next_reading_end
+            gap -= gap % self.period()
+            self.skipped += gap
+            self.next_reading_end += gap
+
+    def wait_interrupt_600(self):
+        self.wait_interrupt()
+
+    def get_light_levels(self, disable_exception=False):
+        if self.reading_end is None:
+            self.wait_interrupt()
+
+        # Average the recorded count rates over the integration period
+        period = self.period()
+        last = np.searchsorted(self.times, self.reading_end, side='right')
+        first = np.searchsorted(self.times, self.reading_end - period, side='right')
+        if last <= first:
+            first = max(last - 1, 0)
+            last = first + 1
+        exposure = GAIN_FACTORS[self._gain] * period / NS_PER_MS / (last - first)
+        full_scale = FULL_SCALE_100MS if self._integration_time == INTEGRATIONTIME_100MS else MAX_COUNT
+        channel_0 = min(int(round((self.visible_rates[last] - self.visible_rates[first]) * exposure)), full_scale)
+        channel_1 = min(int(round((self.ir_rates[last] - self.ir_rates[first]) * exposure)), full_scale)
+
+        return calculate_lux(channel_0, channel_1, self._gain, self._integration_time, disable_exception)
+
+
+# An i2c bus or TCA9548A channel used by a sensor, with the lock of its bus. The blinka bus lock isn't safe between
+# threads, so each transfer of the sensor, with the multiplexer channel select and deselect around it, holds the lock
+class LockedI2C():
+
+    def __init__(self, i2c, lock):
+        self.i2c = i2c
+        self.lock = lock
+
+    def try_lock(self):
+        self.lock.acquire()
+        while not self.i2c.try_lock():
+            time.sleep(0)
+        return True
+
+    def unlock(self):
+        try:
+            self.i2c.unlock()
+        finally:
+            self.lock.release()
+
+    def __getattr__(self, name):
+        return getattr(self.i2c, name)
+
+
+# The i2c buses and TCA9548A multiplexers of the sensors in a process. The sensors on a bus share one I2C object
+# and lock, and the sensors on a multiplexer share one TCA9548A object, so the transfers of sensors read from
+# different threads can't interleave, and a channel select holds until the read on that channel is done
+class I2cBuses():
+
+    def __init__(self):
+        self.buses = {}
+        self.multiplexers = {}
+
+    def bus(self, bus):
+        if bus not in self.buses:
+            import board
+            from adafruit_extended_bus import ExtendedI2C as I2C
+            self.buses[bus] = (I2C(bus), threading.Lock())
+        return self.buses[bus]
+
+    # The i2c device of a sensor on the bus, or on a channel of the multiplexer at the address on the bus
+    def device(self, bus, multiplexer=None, mux_address=DEFAULT_MUX_ADDRESS):
+        i2c, lock = self.bus(bus)
+        if multiplexer is None:
+            return LockedI2C(i2c, lock)
+        if (bus, mux_address) not in self.multiplexers:
+            import adafruit_tca9548a
+            self.multiplexers[(bus, mux_address)] = adafruit_tca9548a.TCA9548A(i2c, mux_address)
+        return LockedI2C(self.multiplexers[(bus, mux_address)][multiplexer], lock)
+
+
+# Open the real sensor on an i2c bus or TCA9548A multiplexer channel, or a simulated sensor replaying data files.
+# Sensors opened with the same buses share their i2c buses and multiplexers
+def open_sensor(bus=1, address=DEFAULT_I2C_ADDRESS, multiplexer=None, int_pin=None, simulate=None, speed=1.0, on_finished=None,
+                buses=None):
+    if simulate:
+        return SimulatedTSL2591(simulate, speed=speed, on_finished=on_finished)
+
+    from tsl2591_driver import adafruit_tsl2591_extended
+    import interrupt_wait
+
+    # Create the sensor on the i2c bus, or for the sensor on the multiplexer, on the TCA9548A channel
+    buses = buses or I2cBuses()
+    sensor = adafruit_tsl2591_extended(buses.device(bus, multiplexer), address=address)
+
+    # Wait for the sensor's interrupt on a GPIO pin
+    if int_pin is not None:
+        sensor.wait_strategy = interrupt_wait.EdgeWait(interrupt_wait.GpioEdgeSource(int_pin))
+
+    return sensor
+
+
+# Main program. Print the readings of a simulated sensor
+if __name__ == "__main__":
+
+    # Construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser(description='Print the readings of a simulated TSL2591 replaying data files')
+    ap.add_argument("file", type=str, nargs='+',
+                    help="Data files to replay")
+    gain_choices = ["max", "high", "med", "low"]
+    ap.add_argument("-g", "--gain", choices=gain_choices, type=str, default="max",
+                    help="Gain level for the simulated sensor. Default is max")
+    ap.add_argument("--speed", type=float, default=0,
+                    help="Replay speed relative to real time. Default is 0 - as fast as possible")
+
+    args = vars(ap.parse_args())
+
+    sensor = SimulatedTSL2591(args['file'], speed=args['speed'])
+    sensor.gain = [GAIN_MAX, GAIN_HIGH, GAIN_MED, GAIN_LOW][gain_choices.index(args['gain'])]
+    sensor.enable()
+    while True:
+        try:
+            sensor.wait_interrupt()
+            print(np.datetime64(sensor.reading_end, 'ns'), *sensor.get_light_levels())
+        except ReplayFinished:
+            break
+        except RuntimeError as e:
+            print(np.datetime64(sensor.reading_end, 'ns'), "Overflow")
@@ -0,0 +1,150 @@
+import argparse
+import datetime
+import math
+import os
+import struct
+import time
+from multiprocessing import shared_memory
+
+import radiometer_binary
+
+# Prefix of the shared memory names. The latest readings of a sensor named SQM are in /dev/shm/tsl2591_SQM
+SHM_PREFIX = 'tsl2591_'
+
+# Shared memory record. The header is the magic, the layout version and the sequence number, followed by the
+# latest reading: time (ns since 1970), lux, visible and IR counts, gain, integration time (ms), sky brightness
+# (mag/arcsec^2) and seeing (arcsec). Values that a script doesn't measure are NaN
+MAGIC = b'TSLR'
+VERSION = 1
+HEADER = struct.Struct('<4sIQ')
+SEQUENCE = struct.Struct('<Q')
+SEQUENCE_OFFSET = 8
+READING = struct.Struct('<q7d')
+READING_OFFSET = HEADER.size
+FIELDS = ['time', 'lux', 'vis_level', 'ir_level', 'again', 'atime', 'sky_brightness', 'seeing']
+
+# Interval at which a client checks for a new reading while waiting
+POLL_INTERVAL = 0.005
+
+
+def shared_memory_name(device_name):
+    return SHM_PREFIX + device_name
+
+
+# Write a text file by writing a temporary file and renaming it over the file, so readers never see a partly written file
+def write_text_file(file_name, text):
+    temp_file_name = file_name + '.tmp'
+    with open(temp_file_name, 'w') as temp_file:
+        temp_file.write(text)
+    os.replace(temp_file_name, file_name)
+
+
+# Publish the latest reading of a sensor in shared memory, as a seqlock. The sequence number is odd while the
+# reading is being written and even once it is complete, so a client that sees the same even sequence number
+# before and after copying the reading has a complete reading. Publishing doesn't block, whatever the clients are doing
+class SharedReadingsPublisher():
+
+    def __init__(self, device_name):
+        self.name = shared_memory_name(device_name)
+        size = READING_OFFSET + READING.size
+        try:
+            self.shm = shared_memory.SharedMemory(self.name, create=True, size=size)
+            self.sequence = 0
+        except FileExistsError:
+            # Reuse the memory left by a previous run, carrying on from its sequence number
+            self.shm = shared_memory.SharedMemory(self.name)
+            magic, version, sequence = HEADER.unpack_from(self.shm.buf, 0)
+            self.sequence = sequence + (sequence & 1) if magic == MAGIC and version == VERSION else 0
+        HEADER.pack_into(self.shm.buf, 0, MAGIC, VERSION, self.sequence)
+
+    def publish(self, time_stamp, lux, vis_level, ir_level, again, atime, sky_brightness=math.nan, seeing=math.nan):
+        buf = self.shm.buf
+        self.sequence += 1
+        SEQUENCE.pack_into(buf, SEQUENCE_OFFSET, self.sequence)
+        READING.pack_into(buf, READING_OFFSET, radiometer_binary.datetime_to_ns(time_stamp), lux, vis_level, ir_level,
+                          again, atime, sky_brightness, seeing)
+        self.sequence += 1
+        SEQUENCE.pack_into(buf, SEQUENCE_OFFSET, self.sequence)
+
+    def close(self):
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+# Client for the latest readings published by an acquisition script on the same machine e.g. for camera software:
+#   client = SharedReadingsClient('SQM')
+#   reading = client.read()               the latest reading, or None if there isn't one yet
+#   reading = client.wait_next(timeout)   wait for a reading newer than the last one returned, or None on timeout
+# If the acquisition script is restarted, it publishes in new shared memory, so create a new client
+class SharedReadingsClient():
+
+    def __init__(self, device_name):
+        name = shared_memory_name(device_name)
+        try:
+            self.shm = shared_memory.SharedMemory(name, track=False)
+        except TypeError:
+            # Before Python 3.13, stop the resource tracker from removing the publisher's memory when the client exits
+            from multiprocessing import resource_tracker
+            self.shm = shared_memory.SharedMemory(name)
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        magic, version, sequence = HEADER.unpack_from(self.shm.buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Shared memory " + name + " isn't a version " + str(VERSION) + " readings record")
+        # The last complete reading has been seen, so wait_next waits for the next one
+        self.sequence = sequence - (sequence & 1)
+
+    # Copy the reading, retrying while the publisher is writing it. Returns the sequence number and the reading
+    def read_record(self):
+        buf = self.shm.buf
+        while True:
+            sequence = SEQUENCE.unpack_from(buf, SEQUENCE_OFFSET)[0]
+            if sequence & 1:
+                time.sleep(0)
+                continue
+            values = READING.unpack_from(buf, READING_OFFSET)
+            if SEQUENCE.unpack_from(buf, SEQUENCE_OFFSET)[0] == sequence:
+                return sequence, values
+
+    def read(self):
+        sequence, values = self.read_record()
+        if sequence == 0:
+            return None
+        self.sequence = sequence
+        reading = dict(zip(FIELDS, values))
+        reading['time_stamp'] = radiometer_binary.EPOCH + datetime.timedelta(microseconds=reading['time'] // 1000)
+        return reading
+
+    def wait_next(self, timeout=None):
+        end_time = time.monotonic() + timeout if timeout is not None else None
+        while SEQUENCE.unpack_from(self.shm.buf, SEQUENCE_OFFSET)[0] in (self.sequence, self.sequence + 1):
+            if end_time is not None and time.monotonic() > end_time:
+                return None
+            time.sleep(POLL_INTERVAL)
+        return self.read()
+
+    def close(self):
+        self.shm.close()
+
+
+# Main program. Print the readings published by an acquisition script
+if __name__ == "__main__":
+
+    # Construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser(description='Print the latest readings published in shared memory by an acquisition script')
+    ap.add_argument("name", type=str, nargs='?', default='radiometer',
+                    help="Name of the sensor e.g. SQM, SSSM, GAIN_MAX. Default is radiometer")
+    ap.add_argument("-t", "--timeout", type=float, default=5.0,
+                    help="Seconds to wait for each reading. Default is 5")
+
+    args = vars(ap.parse_args())
+
+    client = SharedReadingsClient(args['name'])
+    while True:
+        reading = client.wait_next(args['timeout'])
+        if reading is None:
+            print("No new reading in", args['timeout'], "seconds")
+            continue
+        print(reading['time_stamp'], *[reading[field] for field in FIELDS[1:]])
@@ -5,31 +5,38 @@ import signal
 import threading
 import time
 import numpy as np
-from collections import deque
 import syslog
 try:
     from flask import Flask, jsonify
 except:
     pass
-import board
-from adafruit_extended_bus import ExtendedI2C as I2C
-import adafruit_tsl2591
 
-from radiometer_tsl2591 import adafruit_tsl2591_extended
+from data_logger import RadiometerDataLogger
+import sensor_backend
+from reading_history import ReadingHistory, add_history_routes, run_server
+from shared_readings import SharedReadingsPublisher, write_text_file
+from rolling_stats import LuxStats
 
 
-DATA_DIR = os.path.expanduser('~/radiometer_data/')
 SQM_FILE = '/tmp/sqm_tsl2591.txt'
 
 # Minimum time to wait after a sensor time or gain setting
 GUARD_TIME = 0.12
 
 # The tsl2591 default i2c address is 0x29
-DEFAULT_I2C_ADDRESS = adafruit_tsl2591._TSL2591_ADDR
+DEFAULT_I2C_ADDRESS = sensor_backend.DEFAULT_I2C_ADDRESS
+
+
+radiometer_data_logger = None
+shared_readings_publisher = None
 
 
 def signalHandler(signum, frame):
-    # Handle process signals
+    # Handle process signals. Write out the queued readings and remove the shared memory before exiting
+    if radiometer_data_logger:
+        radiometer_data_logger.close()
+    if shared_readings_publisher:
+        shared_readings_publisher.close()
     os._exit(0)
 
 
@@ -46,29 +53,34 @@ def reset_sensor(sensor, gain, integration_time):
     sensor.wait_interrupt_600()
 
 
+# Class to publish the SQM readings in shared memory, and optionally write them to /tmp/sqm_tsl2591.txt
 class Sqm_Writer():
-    def __init__(self):
-        self.rolling = deque(maxlen=10)
+    def __init__(self, sky_stats, publisher=None, text_file=True):
+        self.sky_stats = sky_stats
+        self.publisher = publisher
+        self.text_file = text_file
 
 
-    def update(self, sky_brightness):
-        # Take a rolling average over last 10 measurements (6s) and write it to /tmp/sqm_tsl2591.txt
+    def update(self, time_stamp, lux, vis_level, ir_level, again, atime):
+        # Write the rolling average of the sky brightness (over 6s by default)
+        rolling_average = self.sky_stats.sky_brightness.mean
 
-        self.rolling.append(sky_brightness)
-        rolling_average = np.average(self.rolling)
+        if self.publisher:
+            self.publisher.publish(time_stamp, lux, vis_level, ir_level, again, atime, sky_brightness=rolling_average)
 
-        with open(SQM_FILE, 'w') as sqm_file:
-            sqm_file.write(str(rolling_average) + "\n")
+        if self.text_file:
+            write_text_file(SQM_FILE, str(rolling_average) + "\n")
 
         return
 
 
-# Class to run a REST API
+# Class to run a REST API, with the history and event stream endpoints of the recent readings
 class FlaskServer(threading.Thread):
-    def __init__(self, device_name='SQM'):
+    def __init__(self, sky_stats, device_name='SQM'):
         self.device_name = device_name
-        self.rolling = deque(maxlen=10)
+        self.sky_stats = sky_stats
         self.readings = [{'time_stamp': '', 'sky_brightness': '', 'lux': '', 'vis_level': '', 'ir_level': '', 'again': '', 'atime': ''}]
+        self.history = ReadingHistory(readings_per_second=2)
 
         # Initialise the thread
         threading.Thread.__init__(self)
@@ -79,71 +91,18 @@ class FlaskServer(threading.Thread):
             @app.route('/' + self.device_name, methods=['GET'])
             def get_data():
                 return jsonify({self.device_name: self.readings})
+            add_history_routes(app, self.device_name, self.history)
 
             print("REST service running on:", self.device_name)
-            app.run(host='0.0.0.0', port=5000) # debug=True)
+            run_server(app, host='0.0.0.0', port=5000)
         except:
             print("Unable to start flask REST server")
 
     def set_data(self, time_stamp, lux, vis_level, ir_level, again, atime):
-        # Take a rolling average of the sky brightness over last 10 measurements (6s)
-        sky_brightness = np.log10(lux/108000)/-0.4
-        self.rolling.append(sky_brightness)
-        sky_brighness_rolling_average = np.average(self.rolling)
-
-        # Publish the readings
-        self.readings = [{'time_stamp': time_stamp, 'sky_brightness': sky_brighness_rolling_average, 'lux': lux, 'vis_level': vis_level, 'ir_level': ir_level, 'again': again, 'atime': atime}]
-
-
-# Class for logging detections to radiometer data file
-class RadiometerDataLogger():
-
-    def __init__(self, name=""):
-        self.name = name
-        if name:
-            self.name = "_" + name + "_"
-        # Make the data logging directory
-        os.makedirs(DATA_DIR, exist_ok=True)
-
-        # Set the filename and open it for appending
-        self.filename = "R" + self.name + \
-            datetime.datetime.now().strftime("%Y%m%d") + ".csv"
-        if verbose:
-            print("Writing data to file:", DATA_DIR + self.filename)
-        self.rmfile = open(DATA_DIR + self.filename, "a")
-
-        # Start a thread to periodically flush the data to disk
-        self.flush_thread = threading.Thread(target=self.flush_file)
-        self.flush_thread.start()
-
-    # Log the date/time and lux reading
-    def log_data(self, obs_time, lux_value, vis_level, ir_level, again, atime):
-        # Check for date change
-        try:
-            filename = "R" + self.name + obs_time.strftime("%Y%m%d") + ".csv"
-            if filename != self.filename:
-                self.rmfile.close()
-                self.filename = filename
-                self.rmfile = open(DATA_DIR + self.filename, "a")
-
-            # Log the data
-            out_string = '{0:s} {1:.9f} {2:d} {3:d} {4:.1f} {5:.1f}\n'.format(obs_time.strftime(
-                "%Y/%m/%d %H:%M:%S.%f")[:-3], lux_value, vis_level, ir_level, again, atime)
-            self.rmfile.write(out_string)
-            if verbose:
-                print(out_string, end='')
-
-        except Exception as e:
-            print(e)
-
-    # Flush the data log file to disk every 10s
-    def flush_file(self):
-        while True:
-            time.sleep(10)
-            try:
-                self.rmfile.flush()
-            except:
-                pass
+        # Publish the readings, with the rolling average and statistics of the sky brightness (over 6s by default)
+        self.readings = [{'time_stamp': time_stamp, 'sky_brightness': self.sky_stats.sky_brightness.mean, 'lux': lux, 'vis_level': vis_level, 'ir_level': ir_level, 'again': again, 'atime': atime,
+                          'statistics': self.sky_stats.summary()}]
+        self.history.append(time_stamp, lux, vis_level, ir_level, again, atime)
 
 
 # Main program
@@ -155,27 +114,57 @@ if __name__ == "__main__":
                     help="Set the light sensor's i2c address. Default is " + hex(DEFAULT_I2C_ADDRESS))
     ap.add_argument("-b", "--bus", type=int, default=1,
                     help="Specify the i2c bus used for connecting the sensor e.g. 3 if /dev/i2c-3 has been created using dtoverlay. Default is bus 1")
+    ap.add_argument("--binary", action='store_true',
+                    help="Write the data in the compact binary record format instead of csv")
     gain_choices = ["max", "high", "med", "low", "auto"]
     ap.add_argument(
         "-g", "--gain", choices=gain_choices, type=str, default="auto", help="Gain level for the light sensor. Default is auto")
+    ap.add_argument("-i", "--int-pin", type=int, default=None,
+                    help="GPIO pin (BCM numbering) connected to the sensor's INT pin. Wait for the interrupt edge instead of polling the sensor over i2c")
+    ap.add_argument("-k", "--keep", type=int, default=0,
+                    help="Keep the readings of only the last n days, and the aggregates of older days. Default is 0 - keep all data files")
+    ap.add_argument("--keep-1s", type=int, default=12,
+                    help="Keep the 1 second aggregates of the readings for n months when the readings are removed by --keep or --quota. The 1 minute aggregates are kept indefinitely. Default is 12, 0 keeps them all")
     ap.add_argument("-m", "--multiplexer", type=int, default=None,
                     help="Connect to the i2c sensor via an adafruit TCA9548A multiplexer using the number of the multiplexer channel e.g. 0-7")
     ap.add_argument("-n", "--name", type=str, default="SQM",
                     help="Optional name of the sensor for the output file name. Default is SQM")
+    ap.add_argument("--no-text-file", action='store_true',
+                    help="Only publish the readings in shared memory, without writing them to " + SQM_FILE)
+    ap.add_argument("--quota", type=int, default=0,
+                    help="Limit the space used by the sensor's data files and aggregates to n MB, removing the oldest readings first, then the oldest aggregates. Default is 0 - no limit")
+    ap.add_argument("--simulate", type=str, nargs='+', default=None,
+                    help="Replay the light levels in these data files with a simulated sensor instead of using the real sensor")
+    ap.add_argument("--speed", type=float, default=1.0,
+                    help="Replay speed of the simulated sensor relative to real time. 0 is as fast as possible. Default is 1")
+    ap.add_argument("-w", "--window", type=float, default=6.0,
+                    help="Length in seconds of the rolling average of the sky brightness. Default is 6")
     ap.add_argument("-v", "--verbose", action='store_true',
                     help="Verbose output to terminal")
+    ap.add_argument("-z", "--compress", action='store_true',
+                    help="Compress each day's data file in the background after midnight, and any earlier uncompressed data files")
     args = vars(ap.parse_args())
 
     i2c_address = args['address']
     i2c_bus = args['bus']
+    binary = args['binary']
+    compress = args['compress']
+    keep_days = args['keep']
+    keep_1s_months = args['keep_1s']
+    quota_mb = args['quota']
     gain_name = args['gain']
     device_name = args['name']
+    int_pin = args['int_pin']
     multiplexer = args['multiplexer']
+    simulate = args['simulate']
+    text_file = not args['no_text_file']
+    speed = args['speed']
     verbose = args['verbose']
+    window = args['window']
 
     # Get the TSL2591 gain from the command line string. If the gain is set to auto, set the gain to maximum
-    valid_device_gain_settings = [adafruit_tsl2591.GAIN_MAX,
-                                  adafruit_tsl2591.GAIN_HIGH, adafruit_tsl2591.GAIN_MED, adafruit_tsl2591.GAIN_LOW, adafruit_tsl2591.GAIN_MAX]
+    valid_device_gain_settings = [sensor_backend.GAIN_MAX,
+                                  sensor_backend.GAIN_HIGH, sensor_backend.GAIN_MED, sensor_backend.GAIN_LOW, sensor_backend.GAIN_MAX]
     required_device_gain_setting = valid_device_gain_settings[gain_choices.index(
         gain_name)]
     auto_gain = True if gain_name == "auto" else False
@@ -184,37 +173,31 @@ if __name__ == "__main__":
     signal.signal(signal.SIGINT, signalHandler)
     signal.signal(signal.SIGTERM, signalHandler)
 
-    # Open the i2c bus
-    i2c = I2C(i2c_bus)
-
-    # Create the sensor or TCA9548A object and pass it the I2C bus
-    if multiplexer is not None:
-        import adafruit_tca9548a
-        tca = adafruit_tca9548a.TCA9548A(i2c)
-        # For the sensor on the multiplexer, create it using the TCA9548A channel instead of the I2C object
-        sensor = adafruit_tsl2591_extended(tca[multiplexer])
-    else:
-        sensor = adafruit_tsl2591_extended(i2c, address=i2c_address)
+    # Open the sensor, or a simulated sensor replaying data files. Exit when the replay has finished
+    sensor = sensor_backend.open_sensor(i2c_bus, i2c_address, multiplexer, int_pin, simulate, speed,
+                                        on_finished=lambda: signalHandler(signal.SIGTERM, None))
 
     # Set gain and integration time (600ms)
     sensor.enable()
     gain_level = required_device_gain_setting
     sensor.gain = gain_level
-    # sensor.gain = adafruit_tsl2591.GAIN_LOW # for testing
-    sensor.integration_time = adafruit_tsl2591.INTEGRATIONTIME_600MS
+    # sensor.gain = sensor_backend.GAIN_LOW # for testing
+    sensor.integration_time = sensor_backend.INTEGRATIONTIME_600MS
     prev_lux = -100
     saturation_counter = 0
 
     time.sleep(0.5)
 
     # Create the data logger
-    radiometer_data_logger = RadiometerDataLogger(name=device_name)
+    radiometer_data_logger = RadiometerDataLogger(name=device_name, keep_days=keep_days, binary=binary, compress=compress, keep_1s_months=keep_1s_months, quota_mb=quota_mb, verbose=verbose)
 
-    # Create the SQM readings writer
-    sqm_writer = Sqm_Writer()
+    # Create the SQM readings writer, publishing the readings in shared memory
+    shared_readings_publisher = SharedReadingsPublisher(device_name)
+    sky_stats = LuxStats(window_seconds=window)
+    sqm_writer = Sqm_Writer(sky_stats, shared_readings_publisher, text_file)
 
     # Create the flask REST server
-    flask_server = FlaskServer(device_name=device_name)
+    flask_server = FlaskServer(sky_stats, device_name=device_name)
     flask_server.start()
 
 
@@ -234,19 +217,20 @@ if __name__ == "__main__":
                 time_stamp, lux, vis_level, ir_level, again, atime)
 
             # Write the latest SQM value
-            sqm_writer.update(np.log10(lux/108000)/-0.4)
+            sky_stats.update(time_stamp, lux)
+            sqm_writer.update(time_stamp, lux, vis_level, ir_level, again, atime)
 
             # Write the latest data to the flask server
             flask_server.set_data(time_stamp, lux, vis_level, ir_level, again, atime)
 
             # Check if the gain level can be changed back to max
-            if auto_gain and gain_level != adafruit_tsl2591.GAIN_MAX and lux < 1.0:
+            if auto_gain and gain_level != sensor_backend.GAIN_MAX and lux < 1.0:
                 # sensor.disable()
                 sensor.adc_en_off()
-                gain_level = adafruit_tsl2591.GAIN_MAX
+                gain_level = sensor_backend.GAIN_MAX
                 sensor.gain = gain_level
                 sensor.enable()
-                sensor.integration_time = adafruit_tsl2591.INTEGRATIONTIME_600MS
+                sensor.integration_time = sensor_backend.INTEGRATIONTIME_600MS
                 # Wait for next valid reading
                 sensor.wait_interrupt_600()
                 # time.sleep(GUARD_TIME)
@@ -266,13 +250,13 @@ if __name__ == "__main__":
                 saturation_counter += 1
                 if saturation_counter > 100:
                     reset_sensor(sensor, gain_level,
-                                 adafruit_tsl2591.INTEGRATIONTIME_100MS)
+                                 sensor_backend.INTEGRATIONTIME_100MS)
                     saturation_counter = 0
                 continue
 
             # Attempt to lower gain so that readings can continue
             # Gain at GAIN_MED will allow measurements to be taken up to about 3000 lux
-            if gain_level == adafruit_tsl2591.GAIN_MAX:
+            if gain_level == sensor_backend.GAIN_MAX:
 
                 # Log the sensor values anyway even though there has been an exception as the IR sensor values may still be useful.
                 if prev_lux > 0:
@@ -283,10 +267,10 @@ if __name__ == "__main__":
 
                 # sensor.disable()
                 sensor.adc_en_off()
-                gain_level = adafruit_tsl2591.GAIN_MED
+                gain_level = sensor_backend.GAIN_MED
                 sensor.gain = gain_level
                 sensor.enable()
-                sensor.integration_time = adafruit_tsl2591.INTEGRATIONTIME_100MS
+                sensor.integration_time = sensor_backend.INTEGRATIONTIME_100MS
                 # Sleep to ensure next reading is valid
                 sensor.wait_interrupt_600()
                 # time.sleep(GUARD_TIME)
@@ -296,11 +280,11 @@ if __name__ == "__main__":
                 saturation_counter += 1
                 if saturation_counter > 100:
                     reset_sensor(sensor, gain_level,
-                                 adafruit_tsl2591.INTEGRATIONTIME_100MS)
+                                 sensor_backend.INTEGRATIONTIME_100MS)
                     time.sleep(120)
 
                     # Take a reading at lowest gain, then set the gain back to medium
-                    sensor.gain = adafruit_tsl2591.GAIN_LOW
+                    sensor.gain = sensor_backend.GAIN_LOW
                     sensor.enable()
                     time.sleep(1)
                     try:
@@ -310,7 +294,8 @@ if __name__ == "__main__":
                             time_stamp, lux, vis_level, ir_level, again, atime)
  
                          # Write the new SQM value
-                        sqm_writer.update(np.log10(lux/108000)/-0.4)
+                        sky_stats.update(time_stamp, lux)
+                        sqm_writer.update(time_stamp, lux, vis_level, ir_level, again, atime)
                         flask_server.set_data(time_stamp, lux, vis_level, ir_level, again, atime)
 
                     except Exception as e:
@@ -319,7 +304,7 @@ if __name__ == "__main__":
                     # sensor.disable()
                     sensor.adc_en_off()
                     time.sleep(1)
-                    gain_level = adafruit_tsl2591.GAIN_MED
+                    gain_level = sensor_backend.GAIN_MED
                     sensor.gain = gain_level
                     sensor.enable()
                     time.sleep(1)
@@ -1,33 +1,38 @@
 import argparse
 import datetime
+import math
 import os
 import signal
 import threading
 import time
 import numpy as np
 import syslog
-import board
-from collections import deque
-from adafruit_extended_bus import ExtendedI2C as I2C
-import adafruit_tsl2591
 
+from data_logger import RadiometerDataLogger
+import sensor_backend
+from auto_range import AutoRanger
+from seeing import SeeingCalculator
+from shared_readings import SharedReadingsPublisher, write_text_file
 
-from radiometer_tsl2591 import adafruit_tsl2591_extended
-
-DATA_DIR = os.path.expanduser('~/radiometer_data/')
 SSSM_FILE = '/tmp/sssm_tsl2591.txt'
 
 # Minimum time to wait after a sensor time or gain setting
 GUARD_TIME = 0.12
 
 # The tsl2591 default i2c address is 0x29
-DEFAULT_I2C_ADDRESS = adafruit_tsl2591._TSL2591_ADDR
+DEFAULT_I2C_ADDRESS = sensor_backend.DEFAULT_I2C_ADDRESS
+
 
-SSSM_FACTOR = 1900   # Solar diameter is ~1900 arcsec 
+radiometer_data_logger = None
+shared_readings_publisher = None
 
 
 def signalHandler(signum, frame):
-    # Handle process signals
+    # Handle process signals. Write out the queued readings and remove the shared memory before exiting
+    if radiometer_data_logger:
+        radiometer_data_logger.close()
+    if shared_readings_publisher:
+        shared_readings_publisher.close()
     os._exit(0)
 
 
@@ -44,87 +49,32 @@ def reset_sensor(sensor, gain, integration_time):
     sensor.wait_interrupt()
 
 
-# Class to calculate and write the SSSM readings
+# Class to calculate the SSSM readings, publish them in shared memory, and optionally write them to /tmp/sssm_tsl2591.txt
 class Sssm_Writer():
-    def __init__(self):
-        self.rolling = deque(maxlen=10)
+    def __init__(self, publisher=None, text_file=True):
+        self.seeing_calculator = SeeingCalculator()
+        self.publisher = publisher
+        self.text_file = text_file
+        self.seeing = math.nan
 
 
-    def update(self, lux_value):
-        # Take a rolling average over the last 10 measurements (1s)
+    def update(self, time_stamp, lux, vis_level, ir_level, again, atime):
+        # Calculate the seeing over each chunk of 10 measurements (1s)
+        seeing = self.seeing_calculator.update(lux)
 
-        self.rolling.append(lux_value)
-
-        # If the deque is full
-        if len(self.rolling) == self.rolling.maxlen:
-            rolling = np.array(self.rolling)
-            average = np.average(rolling)
-            rms = np.sqrt(np.mean((rolling - average)**2))
-            average1 = np.average(rolling[0:4])
-            average2 = np.average(rolling[5:9])
-            seeing = SSSM_FACTOR * abs(rms / average)
+        if seeing is not None:
             if verbose:
-                print(average1, average2, rms, seeing)
-            
-            # Clear the deque for the next set of readings
-            self.rolling.clear()
-
-            with open(SSSM_FILE, 'w') as sqm_file:
-                sqm_file.write(str(seeing) + "\n")
-
-        return
+                print(self.seeing_calculator.average, self.seeing_calculator.rms, seeing)
 
+            self.seeing = seeing
+            if self.text_file:
+                write_text_file(SSSM_FILE, str(seeing) + "\n")
 
-# Class for logging detections to radiometer data file
-class RadiometerDataLogger():
-
-    def __init__(self, name=""):
-        self.name = name
-        if name:
-            self.name = "_" + name + "_"
-        # Make the data logging directory
-        os.makedirs(DATA_DIR, exist_ok=True)
-
-        # Set the filename and open it for appending
-        self.filename = "R" + self.name + \
-            datetime.datetime.now().strftime("%Y%m%d") + ".csv"
-        if verbose:
-            print("Writing data to file:", DATA_DIR + self.filename)
-        self.rmfile = open(DATA_DIR + self.filename, "a")
-
-        # Start a thread to periodically flush the data to disk
-        self.flush_thread = threading.Thread(target=self.flush_file)
-        self.flush_thread.start()
-
-    # Log the date/time and lux reading
-    def log_data(self, obs_time, lux_value, vis_level, ir_level, again, atime):
-        # Check for date change
-        try:
-            filename = "R" + self.name + obs_time.strftime("%Y%m%d") + ".csv"
-            if filename != self.filename:
-                self.rmfile.close()
-                self.filename = filename
-                self.rmfile = open(DATA_DIR + self.filename, "a")
-
-            # Log the data
-            out_string = '{0:s} {1:.9f} {2:d} {3:d} {4:.1f} {5:.1f}\n'.format(obs_time.strftime(
-                "%Y/%m/%d %H:%M:%S.%f")[:-3], lux_value, vis_level, ir_level, again, atime)
-            self.rmfile.write(out_string)
-            if verbose:
-                print(out_string, end='')
-
-        except Exception as e:
-            print(e)
-
-    # Flush the data log file to disk every 10s
-    def flush_file(self):
-        while True:
-            time.sleep(10)
-            try:
-                self.rmfile.flush()
-            except:
-                pass
+        # Publish each reading with the latest seeing
+        if self.publisher:
+            self.publisher.publish(time_stamp, lux, vis_level, ir_level, again, atime, seeing=self.seeing)
 
+        return
 
 
 # Main program
@@ -136,27 +86,54 @@ if __name__ == "__main__":
                     help="Set the light sensor's i2c address. Default is " + hex(DEFAULT_I2C_ADDRESS))
     ap.add_argument("-b", "--bus", type=int, default=1,
                     help="Specify the i2c bus used for connecting the sensor e.g. 3 if /dev/i2c-3 has been created using dtoverlay. Default is bus 1")
+    ap.add_argument("--binary", action='store_true',
+                    help="Write the data in the compact binary record format instead of csv")
     gain_choices = ["max", "high", "med", "low", "auto"]
     ap.add_argument(
         "-g", "--gain", choices=gain_choices, type=str, default="auto", help="Gain level for the light sensor. Default is auto")
+    ap.add_argument("-i", "--int-pin", type=int, default=None,
+                    help="GPIO pin (BCM numbering) connected to the sensor's INT pin. Wait for the interrupt edge instead of polling the sensor over i2c")
+    ap.add_argument("-k", "--keep", type=int, default=0,
+                    help="Keep the readings of only the last n days, and the aggregates of older days. Default is 0 - keep all data files")
+    ap.add_argument("--keep-1s", type=int, default=12,
+                    help="Keep the 1 second aggregates of the readings for n months when the readings are removed by --keep or --quota. The 1 minute aggregates are kept indefinitely. Default is 12, 0 keeps them all")
     ap.add_argument("-m", "--multiplexer", type=int, default=None,
                     help="Connect to the i2c sensor via an adafruit TCA9548A multiplexer using the number of the multiplexer channel e.g. 0-7")
     ap.add_argument("-n", "--name", type=str, default="",
                     help="Optional name of the sensor for the output file name. Default is no name")
+    ap.add_argument("--no-text-file", action='store_true',
+                    help="Only publish the readings in shared memory, without writing them to " + SSSM_FILE)
+    ap.add_argument("--quota", type=int, default=0,
+                    help="Limit the space used by the sensor's data files and aggregates to n MB, removing the oldest readings first, then the oldest aggregates. Default is 0 - no limit")
+    ap.add_argument("--simulate", type=str, nargs='+', default=None,
+                    help="Replay the light levels in these data files with a simulated sensor instead of using the real sensor")
+    ap.add_argument("--speed", type=float, default=1.0,
+                    help="Replay speed of the simulated sensor relative to real time. 0 is as fast as possible. Default is 1")
     ap.add_argument("-v", "--verbose", action='store_true',
                     help="Verbose output to terminal")
+    ap.add_argument("-z", "--compress", action='store_true',
+                    help="Compress each day's data file in the background after midnight, and any earlier uncompressed data files")
     args = vars(ap.parse_args())
 
     i2c_address = args['address']
     i2c_bus = args['bus']
+    binary = args['binary']
+    compress = args['compress']
+    keep_days = args['keep']
+    keep_1s_months = args['keep_1s']
+    quota_mb = args['quota']
     gain_name = args['gain']
     device_name = args['name']
+    int_pin = args['int_pin']
     multiplexer = args['multiplexer']
+    simulate = args['simulate']
+    text_file = not args['no_text_file']
+    speed = args['speed']
     verbose = args['verbose']
 
     # Get the TSL2591 gain from the command line string. If the gain is set to auto, set the gain to maximum
-    valid_device_gain_settings = [adafruit_tsl2591.GAIN_MAX,
-                                  adafruit_tsl2591.GAIN_HIGH, adafruit_tsl2591.GAIN_MED, adafruit_tsl2591.GAIN_LOW, adafruit_tsl2591.GAIN_MAX]
+    valid_device_gain_settings = [sensor_backend.GAIN_MAX,
+                                  sensor_backend.GAIN_HIGH, sensor_backend.GAIN_MED, sensor_backend.GAIN_LOW, sensor_backend.GAIN_MAX]
     required_device_gain_setting = valid_device_gain_settings[gain_choices.index(
         gain_name)]
     auto_gain = True if gain_name == "auto" else False
@@ -165,33 +142,29 @@ if __name__ == "__main__":
     signal.signal(signal.SIGINT, signalHandler)
     signal.signal(signal.SIGTERM, signalHandler)
 
-    # Open the i2c bus
-    i2c = I2C(i2c_bus)
-
-    # Create the sensor or TCA9548A object and pass it the I2C bus
-    if multiplexer is not None:
-        import adafruit_tca9548a
-        tca = adafruit_tca9548a.TCA9548A(i2c)
-        # For the sensor on the multiplexer, create it using the TCA9548A channel instead of the I2C object
-        sensor = adafruit_tsl2591_extended(tca[multiplexer])
-    else:
-        sensor = adafruit_tsl2591_extended(i2c, address=i2c_address)
+    # Open the sensor, or a simulated sensor replaying data files. Exit when the replay has finished
+    sensor = sensor_backend.open_sensor(i2c_bus, i2c_address, multiplexer, int_pin, simulate, speed,
+                                        on_finished=lambda: signalHandler(signal.SIGTERM, None))
 
     # Set gain and fastest integration time (100ms)
     sensor.enable()
     gain_level = required_device_gain_setting
     sensor.gain = gain_level
-    sensor.integration_time = adafruit_tsl2591.INTEGRATIONTIME_100MS
+    sensor.integration_time = sensor_backend.INTEGRATIONTIME_100MS
     prev_lux = -100
     saturation_counter = 0
 
+    # With auto gain, choose the gain from the counts of each reading. The integration time stays at 100ms for the scintillation
+    auto_ranger = AutoRanger(gain_level) if auto_gain else None
+
     time.sleep(0.5)
 
     # Create the data logger
-    radiometer_data_logger = RadiometerDataLogger(name=device_name)
+    radiometer_data_logger = RadiometerDataLogger(name=device_name, keep_days=keep_days, binary=binary, compress=compress, keep_1s_months=keep_1s_months, quota_mb=quota_mb, verbose=verbose)
 
-    # Create the SSSM writer
-    sssm_writer = Sssm_Writer()
+    # Create the SSSM writer, publishing the readings in shared memory
+    shared_readings_publisher = SharedReadingsPublisher(device_name or "SSSM")
+    sssm_writer = Sssm_Writer(shared_readings_publisher, text_file)
 
 
     while True:
@@ -209,29 +182,13 @@ if __name__ == "__main__":
             radiometer_data_logger.log_data(
                 time_stamp, lux, vis_level, ir_level, again, atime)
             
-            sssm_writer.update(lux)
-
-            # Check if the gain level can be increased
-            if auto_gain :
-                if gain_level == adafruit_tsl2591.GAIN_MED and lux < 3.0:
-                    sensor.adc_en_off()
-                    gain_level = adafruit_tsl2591.GAIN_MAX
-
-                    sensor.gain = gain_level
-                    sensor.enable()
-                    sensor.integration_time = adafruit_tsl2591.INTEGRATIONTIME_100MS
-                    # Wait for next valid reading
-                    sensor.wait_interrupt()
-
-                elif gain_level == adafruit_tsl2591.GAIN_LOW and lux < 2000.0:
-                    sensor.adc_en_off()
-                    gain_level = adafruit_tsl2591.GAIN_MED
-
-                    sensor.gain = gain_level
-                    sensor.enable()
-                    sensor.integration_time = adafruit_tsl2591.INTEGRATIONTIME_100MS
-                    # Wait for next valid reading
-                    sensor.wait_interrupt()
+            sssm_writer.update(time_stamp, lux, vis_level, ir_level, again, atime)
+
+            # Change the gain before the sensor saturates, or when the light level has fallen
+            if auto_ranger:
+                setting = auto_ranger.update(vis_level, ir_level)
+                if setting:
+                    auto_ranger.apply(sensor, setting)
 
             # Reset the saturation counter amd store the previous lux value
             saturation_counter = 0
@@ -248,32 +205,19 @@ if __name__ == "__main__":
                 saturation_counter += 1
                 if saturation_counter > 1200:
                     reset_sensor(sensor, gain_level,
-                                 adafruit_tsl2591.INTEGRATIONTIME_100MS)
+                                 sensor_backend.INTEGRATIONTIME_100MS)
                     saturation_counter = 0
                 continue
 
-            # Attempt to lower gain so that readings can continue
-            # Gain at GAIN_MED will allow measurements to be taken up to about 3000 lux
-            if gain_level == adafruit_tsl2591.GAIN_MAX:
-
-                # sensor.disable()
-                sensor.adc_en_off()
-                gain_level = adafruit_tsl2591.GAIN_MED
-                sensor.gain = gain_level
-                sensor.enable()
-                sensor.integration_time = adafruit_tsl2591.INTEGRATIONTIME_100MS
-                # Sleep to ensure next reading is valid
-                sensor.wait_interrupt()
-
-            # If the sensor is still saturated set to lowest gain
+            # Step down the gain so that readings can continue. If the sensor is saturated at
+            # the lowest gain for a long time (120s), reset the sensor and keep reading
+            setting = auto_ranger.saturated()
+            if setting:
+                auto_ranger.apply(sensor, setting)
             else:
-                reset_sensor(sensor, gain_level, adafruit_tsl2591.INTEGRATIONTIME_100MS)
-                sensor.adc_en_off()
-                gain_level = adafruit_tsl2591.GAIN_LOW
-                sensor.gain = gain_level
-                sensor.enable()
-                sensor.integration_time = adafruit_tsl2591.INTEGRATIONTIME_100MS
-                # Sleep to ensure next reading is valid
-                sensor.wait_interrupt()
+                saturation_counter += 1
+                if saturation_counter > 1200:
+                    reset_sensor(sensor, auto_ranger.gain, auto_ranger.integration_time)
+                    saturation_counter = 0
 
             time.sleep(0.05)
@@ -0,0 +1,203 @@
+import datetime
+import json
+import os
+import queue
+import re
+import syslog
+import threading
+
+import aggregates
+import radiometer_compress
+import radiometer_index
+import radiometer_loader
+
+# The data of each closed day is kept in tiers: the raw readings for the number of days to keep, the 1 second and
+# 10 second aggregates for the number of months to keep, and the 1 minute and 10 minute aggregates indefinitely.
+# The aggregates of a day are kept while its raw readings are, so a day whose readings are kept is never taken as
+# missing aggregates and aggregated again. An optional quota caps the space used by the sensor's closed days,
+# removing the oldest raw files first, then the oldest aggregates from the finest level up
+TIERS = ['raw', '1s', '10s', '1m', '10m']
+DAYS_PER_MONTH = 31
+
+MANIFEST_VERSION = 1
+
+# Pause between the chunks of a file being compressed, to leave the CPU and the SD card to the acquisition
+CHUNK_PAUSE = 0.05
+
+
+# Lower the priority of the calling thread so the archiving only uses CPU time the acquisition doesn't need.
+# On Linux the scheduling policy and nice value are per thread
+def lower_thread_priority():
+    try:
+        os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+        return
+    except (AttributeError, OSError):
+        pass
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+    except (AttributeError, OSError):
+        pass
+
+
+# Day of a data or aggregate file name e.g. R_SQM_20260204.csv.rcz -> 20260204, or None if the name has no date
+def file_day(file_name):
+    match = re.search(r'(\d{8})\.', os.path.basename(file_name))
+    return match.group(1) if match else None
+
+
+# Manage the closed day files of a sensor in a low priority background thread. When a day file is closed, its
+# aggregates are built, it is compressed if required, and the tiers are trimmed. The files of each day and their
+# sizes are kept in a manifest file, so the data directory is never rescanned or the files' times checked.
+# The manifest is built from the data directory the first time, and day files closed while the acquisition
+# wasn't running are archived when the manager starts
+class StorageManager():
+
+    def __init__(self, data_dir, name="", keep_days=0, keep_1s_months=0, quota_mb=0, compress=False,
+                 current_file=None, verbose=False):
+        self.data_dir = data_dir
+        self.name = name
+        self.prefix = "R" + ("_" + name + "_" if name else "")
+        self.keep_days = {'raw': keep_days, '1s': keep_1s_months * DAYS_PER_MONTH, '10s': keep_1s_months * DAYS_PER_MONTH,
+                          '1m': 0, '10m': 0}
+        self.quota = quota_mb * 1000000
+        self.compress = compress
+        self.current_file = current_file
+        self.verbose = verbose
+        self.manifest_file = os.path.join(data_dir, self.prefix + "manifest.json")
+        self.manifest = self.read_manifest()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.archive_files, daemon=True)
+        self.thread.start()
+
+    # Queue a closed day file to be archived
+    def day_closed(self, file_name):
+        self.queue.put(file_name)
+
+    def read_manifest(self):
+        try:
+            with open(self.manifest_file) as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest.get('version') == MANIFEST_VERSION:
+                return manifest
+        except (OSError, ValueError):
+            pass
+        return {'version': MANIFEST_VERSION, 'name': self.name, 'days': {}}
+
+    def save_manifest(self):
+        temp_file_name = self.manifest_file + '.tmp'
+        with open(temp_file_name, 'w') as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=1, sort_keys=True)
+        os.replace(temp_file_name, self.manifest_file)
+
+    def archive_files(self):
+        lower_thread_priority()
+        self.catch_up()
+        while True:
+            file_name = self.queue.get()
+            self.archive_day(file_name)
+            self.apply_retention()
+            self.save_manifest()
+
+    # Archive the closed day files that aren't in the manifest, or that need compressing
+    def catch_up(self):
+        days = self.manifest['days']
+        for file_name in radiometer_loader.find_data_files(self.data_dir, self.name):
+            if file_name == self.current_file or file_day(file_name) is None:
+                continue
+            entry = days.get(file_day(file_name), {})
+            compressed = file_name.endswith(('.gz', radiometer_loader.COMPRESSED_EXTENSION))
+            if 'raw' in entry and os.path.basename(file_name) in entry['raw']['files'] and (compressed or not self.compress) and \
+                    all(level in entry for level in aggregates.LEVELS):
+                continue
+            self.archive_day(file_name)
+
+        # Aggregates of days whose day files have been removed
+        listing = sorted(os.listdir(self.data_dir))
+        for level in aggregates.LEVELS:
+            pattern = re.compile(re.escape(self.prefix) + r'\d{8}\.' + level + re.escape(aggregates.AGGREGATE_EXTENSION) + '$')
+            for file_name in listing:
+                if pattern.match(file_name) and level not in days.get(file_day(file_name), {}):
+                    days.setdefault(file_day(file_name), {})[level] = self.tier_record([file_name])
+
+        # Build the missing levels of days whose readings have been removed from their finest level
+        for day, entry in days.items():
+            finest = next((level for level in aggregates.LEVELS if level in entry), None)
+            if 'raw' in entry or finest is None or all(level in entry for level in aggregates.LEVELS if aggregates.LEVELS[level] > aggregates.LEVELS[finest]):
+                continue
+            try:
+                for level, aggregate_name in aggregates.build_aggregate_files(os.path.join(self.data_dir, entry[finest]['files'][0])).items():
+                    entry[level] = self.tier_record([os.path.basename(aggregate_name)])
+            except (OSError, ValueError, IndexError) as e:
+                syslog.syslog(syslog.LOG_WARNING, 'Unable to build aggregates of day: ' + day + ' ' + str(e))
+
+        self.apply_retention()
+        self.save_manifest()
+
+    def tier_record(self, file_names):
+        file_names = [file_name for file_name in file_names if os.path.exists(os.path.join(self.data_dir, file_name))]
+        return {'files': file_names, 'size': sum(os.path.getsize(os.path.join(self.data_dir, file_name)) for file_name in file_names)}
+
+    # Whether a tier of a day is older than its number of days to keep
+    def expired(self, day, tier, today=None):
+        age = ((today or datetime.date.today()) - datetime.datetime.strptime(day, '%Y%m%d').date()).days
+        return self.keep_days[tier] > 0 and age > self.keep_days[tier]
+
+    # Build the aggregates of a closed day file, compress it, and add its files to the manifest. Files that
+    # are about to be removed aren't compressed
+    def archive_day(self, file_name):
+        day = file_day(file_name)
+        if day is None:
+            return
+        entry = self.manifest['days'].setdefault(day, {})
+        try:
+            if any(level not in entry for level in aggregates.LEVELS):
+                for level, aggregate_name in aggregates.build_aggregate_files(file_name).items():
+                    entry[level] = self.tier_record([os.path.basename(aggregate_name)])
+
+            if self.compress and not file_name.endswith(('.gz', radiometer_loader.COMPRESSED_EXTENSION)) and not self.expired(day, 'raw'):
+                file_name = radiometer_compress.compress_file(file_name, self.name, CHUNK_PAUSE)[0]
+                syslog.syslog(syslog.LOG_INFO, 'Compressed file: ' + file_name)
+                if self.verbose:
+                    print("Compressed", file_name)
+        except (OSError, ValueError) as e:
+            syslog.syslog(syslog.LOG_WARNING, 'Unable to archive file: ' + file_name + ' ' + str(e))
+
+        entry['raw'] = self.tier_record([os.path.basename(file_name),
+                                         os.path.basename(radiometer_index.index_file_name(file_name))])
+
+    def remove_tier(self, day, tier):
+        for file_name in self.manifest['days'][day].pop(tier)['files']:
+            try:
+                os.remove(os.path.join(self.data_dir, file_name))
+                syslog.syslog(syslog.LOG_DEBUG, 'Removed file: ' + file_name)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                syslog.syslog(syslog.LOG_DEBUG, 'Unable to remove file: ' + file_name)
+        if not self.manifest['days'][day]:
+            del self.manifest['days'][day]
+
+    # Remove the tiers of the days older than their number of days to keep, then the oldest tiers over the quota.
+    # The aggregates of a day that still has its raw readings aren't removed for their age
+    def apply_retention(self, today=None):
+        today = today or datetime.date.today()
+        days = self.manifest['days']
+        for day in sorted(days):
+            for tier in TIERS:
+                if tier in days.get(day, {}) and self.expired(day, tier, today) and (tier == 'raw' or 'raw' not in days[day]):
+                    self.remove_tier(day, tier)
+
+        if not self.quota:
+            return
+        used = self.used_space()
+        for tier in TIERS:
+            for day in sorted(days):
+                if used <= self.quota:
+                    return
+                if tier in days[day]:
+                    used -= days[day][tier]['size']
+                    self.remove_tier(day, tier)
+
+    # Space used by the closed days of the sensor, in bytes
+    def used_space(self):
+        return sum(record['size'] for entry in self.manifest['days'].values() for record in entry.values())
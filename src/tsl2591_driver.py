@@ -0,0 +1,64 @@
+import adafruit_tsl2591
+
+import interrupt_wait
+import sensor_backend
+
+
+# Add a get_light_levels method to the adafruit_tsl2591 class, with interrupt waits, ADC control and a device reset
+class adafruit_tsl2591_extended(adafruit_tsl2591.TSL2591):
+
+    def get_light_levels(self, disable_exception=False):
+        """Read the sensor and calculate a lux value from both its infrared
+        and visible light channels.
+
+        .. note::
+            :attr:`lux` is not calibrated!
+
+        """
+        channel_0, channel_1 = self.raw_luminosity
+        return sensor_backend.calculate_lux(channel_0, channel_1, self._gain, self._integration_time, disable_exception)
+
+    # Switch off only the ADC_EN
+    def adc_en_off(self):
+        self._write_u8(
+            adafruit_tsl2591._TSL2591_REGISTER_ENABLE,
+            adafruit_tsl2591._TSL2591_ENABLE_POWERON
+            | adafruit_tsl2591.ENABLE_AIEN
+            | adafruit_tsl2591.ENABLE_NPIEN,
+        )
+
+    def reset(self):
+        # Perform a device reset
+        val = 0b10000000
+        # control = self._read_u8(adafruit_tsl2591._TSL2591_REGISTER_CONTROL)
+        # control &= 0b01111111
+        control = val
+
+        # A write to the reset register always generates an exception
+        try:
+            self._write_u8(adafruit_tsl2591._TSL2591_REGISTER_CONTROL, control)
+        except:
+            pass
+
+    def clear_interrupts(self):
+        # Clear ALS interrupts.
+        with self._device as i2c:
+            # Make sure to add command bit and special function bit to write request.
+            sf = 0x07
+            self._BUFFER[0] = (0xE0 | sf) & 0xFF
+            self._BUFFER[1] = 0x00 & 0xFF
+            i2c.write(self._BUFFER, end=2)
+
+    # The strategy used to wait for the end of each reading. The status register is polled over i2c
+    # unless the sensor's INT pin is connected to a GPIO pin
+    wait_strategy = interrupt_wait.PollingWait()
+
+    def wait_interrupt_600(self):
+        # Wait ~600ms for AINT interrupt to signal a reading has completed
+        # Initial sleep 500ms, then poll every 50ms
+        self.wait_strategy.wait(self, 0.5, 0.05)
+
+    def wait_interrupt(self):
+        # Wait for AINT interrupt to signal a reading has completed
+        # Initial sleep 50ms, then poll every 5ms
+        self.wait_strategy.wait(self, 0.05, 0.005)
@@ -0,0 +1,143 @@
+import datetime
+import os
+import re
+import numpy as np
+import ephem
+
+TWILIGHT_HORIZON = '-9.0'     # Set degree below horizon for twilight (astronomical is -18 degrees)
+
+CACHE_DIR = os.path.expanduser('~/.cache/radiometer/')
+
+# Version of the cached intervals, changed when the way they are calculated changes
+CACHE_VERSION = 2
+
+NS_PER_HOUR = 3600 * 1000000000
+NS_PER_DAY = 86400 * 1000000000
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class ConfigReader() :
+    def get_config(self, config_dir) :
+        with open(config_dir + '/.config') as fp:
+            for cnt, line in enumerate(fp):
+                line_words = (re.split("[: ]+", line))
+                if line_words[0] == 'stationID' : self.cameraname = line_words[1]
+                if line_words[0] == 'latitude'  : self.latitude = line_words[1]
+                if line_words[0] == 'longitude' : self.longitude = line_words[1]
+                if line_words[0] == 'elevation' : self.elevation = float(line_words[1])
+
+
+def ephem_to_ns(ephem_date):
+    return (ephem.Date(ephem_date).datetime() - EPOCH) // datetime.timedelta(microseconds=1) * 1000
+
+
+def ns_to_ephem(time_ns):
+    return ephem.Date(EPOCH + datetime.timedelta(microseconds=int(time_ns) // 1000))
+
+
+# UTC times in ns of local wall clock times in ns, such as the times in the data files, using the time zone of
+# this computer. The UTC offset is found for each hour of the times, so a change to or from summer time is followed
+def local_to_utc(times):
+    times = np.asarray(times).astype('datetime64[ns]').astype(np.int64)
+    hours, hour_indices = np.unique(times // NS_PER_HOUR, return_inverse=True)
+    offsets = np.array([(EPOCH + datetime.timedelta(hours=int(hour))).astimezone().utcoffset() // datetime.timedelta(seconds=1)
+                        for hour in hours], dtype=np.int64) * 1000000000
+    return times - offsets[hour_indices].reshape(times.shape)
+
+
+# Class holding the sunset to sunrise intervals for a site. The intervals are calculated once per night
+# and cached to disk, so that times can be checked with a binary search instead of ephem calls.
+# As with ephem, times without a time zone are treated as UTC.
+class TwilightTable():
+
+    def __init__(self, latitude, longitude, elevation, horizon=TWILIGHT_HORIZON, cache_dir=CACHE_DIR):
+        self.location = ephem.Observer()
+        self.location.lat, self.location.long = str(latitude), str(longitude)
+        self.location.elevation = elevation
+        self.location.horizon = horizon
+        self.sun = ephem.Sun()
+
+        self.cache_file = None
+        if cache_dir:
+            self.cache_file = os.path.join(cache_dir, 'twilight_v{0}_{1}_{2}_{3}_{4}.npz'.format(
+                CACHE_VERSION, latitude, longitude, elevation, horizon))
+
+        self.covered_start = self.covered_end = None
+        self.sunsets = self.sunrises = np.zeros(0, dtype=np.int64)
+        self.load_cache()
+
+    @classmethod
+    def from_config(cls, config_dir, **kwargs):
+        config = ConfigReader()
+        config.get_config(config_dir)
+        return cls(config.latitude, config.longitude, config.elevation, **kwargs)
+
+    def load_cache(self):
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return
+        try:
+            with np.load(self.cache_file) as cache:
+                self.sunsets, self.sunrises = cache['sunsets'], cache['sunrises']
+                self.covered_start, self.covered_end = int(cache['covered'][0]), int(cache['covered'][1])
+        except (OSError, KeyError, ValueError):
+            pass
+
+    def save_cache(self):
+        if not self.cache_file:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            temp_file_name = self.cache_file + '.tmp.npz'
+            np.savez(temp_file_name, sunsets=self.sunsets, sunrises=self.sunrises,
+                     covered=np.array([self.covered_start, self.covered_end], dtype=np.int64))
+            os.replace(temp_file_name, self.cache_file)
+        except OSError:
+            pass
+
+    # Calculate the sunset and following sunrise of each night that ends after the start time, up to the end time
+    def calculate_intervals(self, start, end):
+        sunsets = []
+        sunrises = []
+        search_time = ns_to_ephem(start - NS_PER_DAY)
+        end_time = ns_to_ephem(end)
+        never_up = False
+        while search_time < end_time:
+            try:
+                # After a day when the sun never rose, the night carries on until the sun first rises
+                sunset = search_time if never_up else self.location.next_setting(self.sun, start=search_time)
+                sunrise = self.location.next_rising(self.sun, start=sunset)
+                never_up = False
+            except ephem.AlwaysUpError:
+                # No night at this time of year, try the next day
+                search_time = ephem.Date(search_time + 1)
+                continue
+            except ephem.NeverUpError:
+                # The sun stays below the twilight horizon all day
+                sunset, sunrise = search_time, ephem.Date(search_time + 1)
+                never_up = True
+
+            sunsets.append(ephem_to_ns(sunset))
+            sunrises.append(ephem_to_ns(sunrise))
+            search_time = sunrise
+        return np.array(sunsets, dtype=np.int64), np.array(sunrises, dtype=np.int64)
+
+    # Make sure that the table covers the start and end times, extending the cached table if needed
+    def cover(self, start, end):
+        if self.covered_start is not None and start >= self.covered_start and end <= self.covered_end:
+            return
+        if self.covered_start is not None:
+            start, end = min(start, self.covered_start), max(end, self.covered_end)
+        self.sunsets, self.sunrises = self.calculate_intervals(start, end)
+        self.covered_start, self.covered_end = start, end
+        self.save_cache()
+
+    # Return a boolean mask of the times (datetime64 or int64 ns) when the sun is below the twilight horizon
+    def sun_down_mask(self, times):
+        times = np.asarray(times).astype('datetime64[ns]').astype(np.int64)
+        if not len(times):
+            return np.zeros(0, dtype=bool)
+        self.cover(int(times.min()), int(times.max()))
+        if not len(self.sunsets):
+            return np.zeros(len(times), dtype=bool)
+        night = np.searchsorted(self.sunsets, times, side='right') - 1
+        return (night >= 0) & (times < self.sunrises[np.maximum(night, 0)])